@@ -0,0 +1,153 @@
+# accounts/avatars.py
+"""
+Miniatures des avatars.
+
+À chaque nouvel avatar, un pool de threads (hors du thread de la requête)
+produit une miniature WebP carrée pour chaque taille de SIZES. Les fichiers
+sont nommés d'après le contenu de l'original :
+
+    avatars/thumbs/<sha256 tronqué>-<taille>.webp
+
+Un même contenu donne donc toujours la même URL, qui peut être mise en cache
+indéfiniment (voir accounts.views.avatar_thumbnail_view), et deux
+utilisateurs au même avatar partagent les fichiers. ``CustomUser.avatar_thumbnails`` garde la liste des
+miniatures et l'original dont elles proviennent ; tant qu'elles ne sont pas
+prêtes, l'URL de l'original est utilisée.
+
+Les messages, la présence et l'historique utilisent SMALL_SIZE (voir
+accounts/profiles.py).
+"""
+import hashlib
+import io
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import close_old_connections, transaction
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_AVATARS = {
+    'SIZES': (32, 64, 128),
+    'SMALL_SIZE': 64,       # 32 px en haute densité, 45 px sinon
+    'QUALITY': 80,
+    'WORKERS': 2,           # 0 : miniatures calculées dans le thread appelant
+    'MAX_AGE': 365 * 24 * 3600,
+}
+
+THUMBNAIL_DIR = 'avatars/thumbs/'
+DEFAULT_AVATAR_NAME = 'avatars/default.png'
+
+
+def get_avatars_config():
+    return {**DEFAULT_AVATARS, **getattr(settings, 'AVATARS', {})}
+
+
+def thumbnail_url(user, size=None):
+    """URL de la miniature ``size`` (SMALL_SIZE par défaut), sinon de l'original"""
+    from .profiles import DEFAULT_AVATAR_URL
+
+    if not user.avatar:
+        return DEFAULT_AVATAR_URL
+    thumbnails = user.avatar_thumbnails or {}
+    if thumbnails.get('source') == user.avatar.name:
+        name = thumbnails.get('sizes', {}).get(str(size or get_avatars_config()['SMALL_SIZE']))
+        if name:
+            return user.avatar.storage.url(name)
+    return user.avatar.url
+
+
+def needs_thumbnails(user):
+    if not user.avatar or user.avatar.name == DEFAULT_AVATAR_NAME:
+        return False
+    return (user.avatar_thumbnails or {}).get('source') != user.avatar.name
+
+
+def render_thumbnail(image, size, quality):
+    thumbnail = ImageOps.fit(image, (size, size), Image.LANCZOS)
+    output = io.BytesIO()
+    thumbnail.save(output, 'WEBP', quality=quality, method=4)
+    return output.getvalue()
+
+
+def generate_thumbnails(user_id):
+    """Calcule les miniatures de l'avatar actuel de l'utilisateur (appel bloquant)"""
+    from .models import CustomUser
+    from .profiles import get_profile_cache
+
+    config = get_avatars_config()
+    user = CustomUser.objects.only('username', 'avatar', 'avatar_thumbnails').get(id=user_id)
+    if not needs_thumbnails(user):
+        return
+    source = user.avatar.name
+    storage = user.avatar.storage
+    with storage.open(source, 'rb') as original:
+        digest = hashlib.sha256()
+        for chunk in iter(lambda: original.read(64 * 1024), b''):
+            digest.update(chunk)
+        original.seek(0)
+        prefix = f'{THUMBNAIL_DIR}{digest.hexdigest()[:24]}'
+        sizes = {}
+        image = None
+        for size in sorted(config['SIZES'], reverse=True):
+            name = f'{prefix}-{size}.webp'
+            if not storage.exists(name):
+                if image is None:
+                    image = Image.open(original)
+                    # JPEG : décodage directement à l'échelle réduite
+                    image.draft('RGB', (max(config['SIZES']),) * 2)
+                    image = ImageOps.exif_transpose(image)
+                    if image.mode not in ('RGB', 'RGBA'):
+                        image = image.convert('RGBA' if image.has_transparency_data else 'RGB')
+                storage.save(name, ContentFile(render_thumbnail(image, size, config['QUALITY'])))
+            sizes[str(size)] = name
+
+    # Sans effet si l'avatar a encore changé entre-temps
+    updated = CustomUser.objects.filter(id=user_id, avatar=source).update(
+        avatar_thumbnails={'source': source, 'sizes': sizes},
+    )
+    if updated:
+        # update() n'envoie pas post_save
+        get_profile_cache().invalidate(user.username)
+
+
+class ThumbnailPool:
+    """Pool de threads propre au processus ; Pillow libère le GIL pendant le calcul"""
+
+    def __init__(self, workers=2):
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='avatars') if workers else None
+
+    def submit(self, user_id):
+        if self.executor is None:
+            self._run(user_id)
+        else:
+            self.executor.submit(self._run, user_id)
+
+    def _run(self, user_id):
+        try:
+            generate_thumbnails(user_id)
+        except Exception:
+            logger.exception("Échec des miniatures d'avatar de l'utilisateur %s", user_id)
+        finally:
+            if self.executor is not None:
+                close_old_connections()
+
+
+_pool = None
+
+
+def get_thumbnail_pool():
+    """Pool unique (par processus) configuré via settings.AVATARS"""
+    global _pool
+    if _pool is None:
+        _pool = ThumbnailPool(workers=get_avatars_config()['WORKERS'])
+    return _pool
+
+
+def schedule_thumbnails(user):
+    """Après validation de la transaction : l'utilisateur doit être visible du pool"""
+    if needs_thumbnails(user):
+        transaction.on_commit(lambda: get_thumbnail_pool().submit(user.id))
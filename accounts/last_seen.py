@@ -0,0 +1,131 @@
+# accounts/last_seen.py
+"""
+Mises à jour groupées de ``CustomUser.last_seen``.
+
+Une activité n'est retenue que si la valeur connue date de plus de
+THRESHOLD secondes ; les valeurs retenues sont gardées en mémoire et
+écrites en un seul ``bulk_update`` toutes les FLUSH_INTERVAL secondes.
+Le middleware HTTP et le ChatConsumer alimentent le même tampon.
+
+L'écriture est faite par une tâche de fond du worker
+(``start_periodic_flush``), lancée au démarrage ASGI (lifespan) ou à la
+première connexion WebSocket : un worker sans nouveau trafic écrit donc
+quand même ce qu'il a en attente. ``stop_periodic_flush`` écrit le reste à
+l'arrêt ; ``atexit`` sert de dernier recours.
+"""
+import asyncio
+import atexit
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LAST_SEEN = {
+    'THRESHOLD': 60,       # secondes
+    'FLUSH_INTERVAL': 30,  # secondes
+}
+
+
+class LastSeenBuffer:
+
+    def __init__(self, threshold=60, flush_interval=30):
+        self.threshold = timedelta(seconds=threshold)
+        self.flush_interval = flush_interval
+        self.pending = {}  # user_id -> datetime
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+
+    def touch(self, user_id, stored=None, now=None):
+        """
+        Enregistre une activité ; ``stored`` est la valeur connue de l'appelant.
+        Retourne True si une écriture a été mise en attente.
+        """
+        now = now or timezone.now()
+        if stored is not None and now - stored < self.threshold:
+            return False
+        with self._lock:
+            queued = self.pending.get(user_id)
+            if queued is not None and now - queued < self.threshold:
+                return False
+            self.pending[user_id] = now
+        return True
+
+    def flush_due(self):
+        return bool(self.pending) and time.monotonic() - self._last_flush >= self.flush_interval
+
+    def flush(self):
+        """Écrit les valeurs en attente (appel bloquant)"""
+        from .models import CustomUser
+
+        with self._lock:
+            pending, self.pending = self.pending, {}
+            self._last_flush = time.monotonic()
+        if not pending:
+            return 0
+        CustomUser.objects.bulk_update(
+            [CustomUser(id=user_id, last_seen=seen) for user_id, seen in pending.items()],
+            ['last_seen'],
+            batch_size=500,
+        )
+        return len(pending)
+
+
+_buffer = None
+_task = None
+
+
+def get_last_seen_buffer():
+    """Tampon unique (par processus) configuré via settings.LAST_SEEN"""
+    global _buffer
+    if _buffer is None:
+        config = {**DEFAULT_LAST_SEEN, **getattr(settings, 'LAST_SEEN', {})}
+        _buffer = LastSeenBuffer(
+            threshold=config['THRESHOLD'],
+            flush_interval=config['FLUSH_INTERVAL'],
+        )
+        atexit.register(_flush_at_exit)
+    return _buffer
+
+
+def start_periodic_flush():
+    """Lance (une fois par boucle d'événements) l'écriture périodique du tampon"""
+    global _task
+    if _task is None or _task.done() or _task.get_loop() is not asyncio.get_running_loop():
+        _task = asyncio.ensure_future(_flush_periodically(get_last_seen_buffer()))
+    return _task
+
+
+async def stop_periodic_flush():
+    """Arrêt du worker : plus d'écriture périodique, le reste est écrit tout de suite"""
+    global _task
+    if _task is not None:
+        _task.cancel()
+        _task = None
+    if _buffer is not None:
+        await database_sync_to_async(_buffer.flush)()
+
+
+async def _flush_periodically(buffer):
+    while True:
+        await asyncio.sleep(buffer.flush_interval)
+        if not buffer.pending:
+            continue
+        try:
+            await database_sync_to_async(buffer.flush)()
+        except Exception:
+            logger.exception("Impossible d'écrire les last_seen en attente")
+
+
+def _flush_at_exit():
+    if _buffer is None:
+        return
+    try:
+        _buffer.flush()
+    except Exception:
+        logger.exception("Impossible d'écrire les last_seen en attente")
@@ -0,0 +1,33 @@
+# accounts/management/commands/avatar_thumbnails.py
+"""
+Calcule les miniatures manquantes des avatars existants (voir
+accounts/avatars.py), par exemple après la mise en place des miniatures :
+
+    python manage.py avatar_thumbnails
+"""
+from django.core.management.base import BaseCommand
+
+from accounts.avatars import DEFAULT_AVATAR_NAME, generate_thumbnails, needs_thumbnails
+from accounts.models import CustomUser
+
+
+class Command(BaseCommand):
+    help = "Génère les miniatures WebP des avatars qui n'en ont pas encore"
+
+    def handle(self, *args, **options):
+        users = (
+            CustomUser.objects.exclude(avatar='').exclude(avatar__isnull=True)
+            .exclude(avatar=DEFAULT_AVATAR_NAME)
+            .only('id', 'avatar', 'avatar_thumbnails')
+        )
+        count = 0
+        for user in users.iterator():
+            if not needs_thumbnails(user):
+                continue
+            try:
+                generate_thumbnails(user.id)
+            except OSError as e:  # original absent ou illisible
+                self.stderr.write(f'{user.avatar.name} : {e}')
+                continue
+            count += 1
+        self.stdout.write(self.style.SUCCESS(f'{count} avatars traités'))
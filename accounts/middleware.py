@@ -1,5 +1,5 @@
 # accounts/middleware.py
-from django.utils import timezone
+from .last_seen import get_last_seen_buffer
 
 class UpdateLastSeenMiddleware:
     def __init__(self, get_response):
@@ -7,11 +7,15 @@ class UpdateLastSeenMiddleware:
 
     def __call__(self, request):
         response = self.get_response(request)
-        
-        # Mettre à jour last_seen pour les utilisateurs authentifiés
+
+        # Mettre à jour last_seen pour les utilisateurs authentifiés,
+        # seulement si la valeur enregistrée n'est plus assez fraîche
         if request.user.is_authenticated:
-            user = request.user
-            user.last_seen = timezone.now()
-            user.save(update_fields=['last_seen'])
-        
-        return response
\ No newline at end of file
+            buffer = get_last_seen_buffer()
+            buffer.touch(request.user.pk, request.user.last_seen)
+
+            # Écriture groupée de toutes les mises à jour en attente
+            if buffer.flush_due():
+                buffer.flush()
+
+        return response
@@ -0,0 +1,18 @@
+# Generated by Django 6.0.2 on 2026-10-18 14:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0002_customuser_last_seen_alter_customuser_avatar'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customuser',
+            name='avatar_thumbnails',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+    ]
@@ -10,6 +10,8 @@ class CustomUser(AbstractUser):
         blank=True,
         null=True
     )
+    # Miniatures WebP de l'avatar : {'source': nom de l'original, 'sizes': {taille: nom}}
+    avatar_thumbnails = models.JSONField(default=dict, blank=True, editable=False)
     bio = models.TextField(max_length=500, blank=True)
     is_online = models.BooleanField(default=False)
     last_seen = models.DateTimeField(default=timezone.now)  # Nouveau champ
@@ -32,5 +34,11 @@ class CustomUser(AbstractUser):
         related_query_name="customuser",
     )
     
+    @property
+    def avatar_thumbnail_url(self):
+        """Petite miniature de l'avatar (l'original tant qu'elle n'est pas prête)"""
+        from .avatars import thumbnail_url
+        return thumbnail_url(self)
+
     def __str__(self):
         return self.username
\ No newline at end of file
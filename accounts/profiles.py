@@ -0,0 +1,234 @@
+# accounts/profiles.py
+"""
+Cache des profils publics (avatar, bio courte) par nom d'utilisateur.
+
+Deux niveaux :
+- un cache local au processus, borné et à TTL court, lu sans aucun appel
+  bloquant (utilisable directement depuis la boucle d'événements) ;
+- le cache Django ``profiles`` (Redis en production), partagé entre les
+  workers, interrogé seulement en cas d'absence locale.
+
+La base n'est consultée que pour les utilisateurs absents des deux niveaux.
+Toute modification du profil invalide l'entrée (voir accounts/signals.py) :
+dans le cache partagé, dans le cache local, et dans celui des autres workers
+par un événement du channel layer (groupe INVALIDATION_GROUP, auquel chaque
+worker s'abonne à la première connexion WebSocket via ``listen``). Un
+processus sans boucle d'événements (WSGI) garde au plus LOCAL_TTL secondes
+un profil modifié ailleurs.
+"""
+import asyncio
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.cache import caches
+
+from .avatars import thumbnail_url
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_AVATAR_URL = '/media/avatars/default.png'
+BIO_PREVIEW_LENGTH = 50
+
+DEFAULT_PROFILE_CACHE = {
+    'ALIAS': 'profiles',
+    'LOCAL_TTL': 30,        # secondes
+    'LOCAL_MAX_ENTRIES': 5000,
+}
+
+INVALIDATION_GROUP = 'profiles__invalidate'
+# Lecture du canal d'invalidation en échec : nouvel essai après un délai
+# qui double jusqu'au plafond
+RETRY_MIN_DELAY = 0.1
+RETRY_MAX_DELAY = 5.0
+
+
+def avatar_url(user):
+    """Petite miniature de l'avatar : c'est elle qu'affichent messages et présence"""
+    return thumbnail_url(user)
+
+
+def build_profile(user):
+    """Profil public calculé à partir d'une instance déjà chargée"""
+    return {
+        'username': user.username,
+        'avatar': avatar_url(user),
+        'bio': user.bio[:BIO_PREVIEW_LENGTH] if user.bio else '',
+    }
+
+
+class ProfileCache:
+
+    def __init__(self, alias='profiles', local_ttl=30, local_max_entries=5000, channel_layer=None):
+        self.alias = alias
+        self.local_ttl = local_ttl
+        self.local_max_entries = local_max_entries
+        self.local = OrderedDict()  # username -> (expires_at, profile)
+        self._lock = threading.Lock()
+        self._channel_layer = channel_layer
+        self.channel_name = None
+        self._ready = None
+        self._loop = None
+        self._task = None
+
+    @property
+    def shared(self):
+        return caches[self.alias]
+
+    @property
+    def channel_layer(self):
+        return self._channel_layer or get_channel_layer()
+
+    def _key(self, username):
+        return f'profile:{username}'
+
+    def _get_local(self, usernames):
+        found, missing = {}, []
+        now = time.monotonic()
+        with self._lock:
+            for username in usernames:
+                entry = self.local.get(username)
+                if entry is not None and entry[0] > now:
+                    self.local.move_to_end(username)
+                    found[username] = entry[1]
+                else:
+                    missing.append(username)
+        return found, missing
+
+    def _set_local(self, profiles):
+        expires_at = time.monotonic() + self.local_ttl
+        with self._lock:
+            for profile in profiles:
+                self.local[profile['username']] = (expires_at, profile)
+                self.local.move_to_end(profile['username'])
+            while len(self.local) > self.local_max_entries:
+                self.local.popitem(last=False)
+
+    def _load(self, usernames):
+        """Niveau partagé puis base de données (appel bloquant)"""
+        from .models import CustomUser
+
+        shared = self.shared.get_many([self._key(u) for u in usernames])
+        profiles = {p['username']: p for p in shared.values()}
+        missing = [u for u in usernames if u not in profiles]
+        if missing:
+            users = CustomUser.objects.filter(username__in=missing).only(
+                'username', 'avatar', 'avatar_thumbnails', 'bio'
+            )
+            loaded = {user.username: build_profile(user) for user in users}
+            self.shared.set_many({self._key(u): p for u, p in loaded.items()})
+            profiles.update(loaded)
+        self._set_local(profiles.values())
+        return profiles
+
+    def get_many(self, usernames):
+        """Profils {username: profil} depuis du code synchrone (vues)"""
+        found, missing = self._get_local(usernames)
+        if missing:
+            found.update(self._load(missing))
+        return found
+
+    async def aget_many(self, usernames):
+        """Même chose depuis le consumer : aucun thread tant que le cache local répond"""
+        found, missing = self._get_local(usernames)
+        if missing:
+            found.update(await database_sync_to_async(self._load)(missing))
+        return found
+
+    def get_many_loaded(self, users):
+        """Profils d'instances déjà chargées : le cache local, sinon calcul sans requête"""
+        found, missing = self._get_local([user.username for user in users])
+        missing = set(missing)
+        built = [build_profile(user) for user in users if user.username in missing]
+        self._set_local(built)
+        found.update((profile['username'], profile) for profile in built)
+        return found
+
+    def prime(self, user):
+        """Renseigne le cache local depuis une instance fraîchement chargée"""
+        profile = build_profile(user)
+        self._set_local([profile])
+        return profile
+
+    def invalidate(self, username):
+        self._forget(username)
+        self.shared.delete(self._key(username))
+        self._broadcast(username)
+
+    def _forget(self, username):
+        with self._lock:
+            self.local.pop(username, None)
+
+    def _broadcast(self, username):
+        """Les autres workers retirent l'entrée de leur cache local"""
+        channel_layer = self.channel_layer
+        if channel_layer is None:
+            return
+        event = {'type': 'profile.invalidate', 'username': username}
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            try:
+                async_to_sync(channel_layer.group_send)(INVALIDATION_GROUP, event)
+            except Exception:
+                logger.exception("Échec de la diffusion de l'invalidation du profil %s", username)
+        else:
+            # Appel depuis la boucle d'événements : envoi sans l'attendre
+            asyncio.ensure_future(channel_layer.group_send(INVALIDATION_GROUP, event))
+
+    async def listen(self):
+        """
+        Abonne le worker aux invalidations (un canal par boucle d'événements) ;
+        chaque appel prolonge aussi l'expiration de l'abonnement
+        """
+        channel_layer = self.channel_layer
+        if channel_layer is None:
+            return
+        loop = asyncio.get_running_loop()
+        if self._ready is None or self._loop is not loop:
+            self._loop = loop
+            self._ready = asyncio.ensure_future(self._open_channel(channel_layer))
+        await self._ready
+        if self._task.done():
+            # Boucle de lecture arrêtée malgré tout : la relancer
+            self._task = asyncio.ensure_future(self._receive(channel_layer, self.channel_name))
+        await channel_layer.group_add(INVALIDATION_GROUP, self.channel_name)
+
+    async def _open_channel(self, channel_layer):
+        self.channel_name = await channel_layer.new_channel(prefix='profiles.')
+        self._task = asyncio.ensure_future(self._receive(channel_layer, self.channel_name))
+
+    async def _receive(self, channel_layer, channel_name):
+        delay = RETRY_MIN_DELAY
+        while True:
+            try:
+                event = await channel_layer.receive(channel_name)
+            except Exception:
+                logger.exception("Lecture du canal d'invalidation impossible, nouvel essai dans %.1f s", delay)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, RETRY_MAX_DELAY)
+                continue
+            delay = RETRY_MIN_DELAY
+            if event.get('type') == 'profile.invalidate':
+                self._forget(event['username'])
+
+
+_cache = None
+
+
+def get_profile_cache():
+    """Instance unique (par processus) configurée via settings.PROFILE_CACHE"""
+    global _cache
+    if _cache is None:
+        config = {**DEFAULT_PROFILE_CACHE, **getattr(settings, 'PROFILE_CACHE', {})}
+        _cache = ProfileCache(
+            alias=config['ALIAS'],
+            local_ttl=config['LOCAL_TTL'],
+            local_max_entries=config['LOCAL_MAX_ENTRIES'],
+        )
+    return _cache
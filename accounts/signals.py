@@ -0,0 +1,29 @@
+# accounts/signals.py
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .avatars import schedule_thumbnails
+from .models import CustomUser
+from .profiles import get_profile_cache
+
+# Champs dont la modification ne change pas le profil public
+NON_PROFILE_FIELDS = {'last_seen', 'is_online', 'last_login'}
+
+
+@receiver(post_save, sender=CustomUser)
+def invalidate_profile_on_save(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and set(update_fields) <= NON_PROFILE_FIELDS:
+        return
+    get_profile_cache().invalidate(instance.username)
+
+
+@receiver(post_save, sender=CustomUser)
+def generate_avatar_thumbnails(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and 'avatar' not in update_fields:
+        return
+    schedule_thumbnails(instance)
+
+
+@receiver(post_delete, sender=CustomUser)
+def invalidate_profile_on_delete(sender, instance, **kwargs):
+    get_profile_cache().invalidate(instance.username)
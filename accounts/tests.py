@@ -1,3 +1,164 @@
-from django.test import TestCase
+import asyncio
+import io
+import shutil
+import tempfile
+from datetime import timedelta
 
-# Create your tests here.
+from django.core.files.uploadedfile import SimpleUploadedFile
+from asgiref.sync import sync_to_async
+from channels.layers import InMemoryChannelLayer
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from PIL import Image
+
+from . import avatars, last_seen, profiles
+from .models import CustomUser
+
+
+def image_upload(color, size=(800, 600), name='avatar.png'):
+    output = io.BytesIO()
+    Image.new('RGB', size, color).save(output, 'PNG')
+    return SimpleUploadedFile(name, output.getvalue(), content_type='image/png')
+
+
+class AvatarThumbnailTests(TestCase):
+
+    def setUp(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media, ignore_errors=True)
+        settings = override_settings(MEDIA_ROOT=media, AVATARS={'SIZES': (32, 64), 'SMALL_SIZE': 32, 'WORKERS': 0})
+        settings.enable()
+        self.addCleanup(settings.disable)
+        avatars._pool = None
+        self.addCleanup(setattr, avatars, '_pool', None)
+        profiles._cache = None
+        self.addCleanup(setattr, profiles, '_cache', None)
+
+    def create_user(self, username, upload):
+        with self.captureOnCommitCallbacks(execute=True):
+            return CustomUser.objects.create_user(username, password='x', avatar=upload)
+
+    def test_upload_creates_webp_thumbnails_used_by_profiles(self):
+        user = self.create_user('alice', image_upload('red'))
+        user.refresh_from_db()
+
+        sizes = user.avatar_thumbnails['sizes']
+        self.assertEqual(user.avatar_thumbnails['source'], user.avatar.name)
+        for size, name in sizes.items():
+            with user.avatar.storage.open(name) as thumbnail:
+                image = Image.open(thumbnail)
+                self.assertEqual((image.format, image.size), ('WEBP', (int(size), int(size))))
+        profile = profiles.get_profile_cache().get_many(['alice'])['alice']
+        self.assertEqual(profile['avatar'], '/media/' + sizes['32'])
+        self.assertEqual(user.avatar_thumbnail_url, profile['avatar'])
+
+    def test_thumbnail_names_follow_content(self):
+        alice = self.create_user('alice', image_upload('red'))
+        bob = self.create_user('bob', image_upload('red', name='other.png'))
+        alice.refresh_from_db()
+        bob.refresh_from_db()
+        self.assertEqual(alice.avatar_thumbnails['sizes'], bob.avatar_thumbnails['sizes'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            alice.avatar = image_upload('blue')
+            alice.save()
+        alice.refresh_from_db()
+        self.assertNotEqual(alice.avatar_thumbnails['sizes'], bob.avatar_thumbnails['sizes'])
+
+    def test_thumbnails_are_served_with_long_lived_cache_headers(self):
+        user = self.create_user('alice', image_upload('red'))
+        user.refresh_from_db()
+
+        with override_settings(DEBUG=True):
+            response = self.client.get(user.avatar_thumbnail_url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertIn('max-age=31536000', response['Cache-Control'])
+
+        # Production : le serveur web s'en charge, jamais le worker Python
+        self.assertEqual(self.client.get(user.avatar_thumbnail_url).status_code, 404)
+
+
+@override_settings(LAST_SEEN={'THRESHOLD': 60, 'FLUSH_INTERVAL': 0.05})
+class LastSeenFlushTests(TestCase):
+    """Écriture de last_seen sans attendre une nouvelle activité"""
+
+    def setUp(self):
+        last_seen._buffer = None
+        self.addCleanup(setattr, last_seen, '_buffer', None)
+        self.user = CustomUser.objects.create_user('alice', password='x')
+        self.seen = timezone.now() + timedelta(hours=1)
+
+    async def stored(self):
+        user = await CustomUser.objects.aget(id=self.user.id)
+        return user.last_seen
+
+    async def test_quiet_worker_flushes_periodically(self):
+        last_seen.get_last_seen_buffer().touch(self.user.id, now=self.seen)
+        task = last_seen.start_periodic_flush()
+        self.assertIs(last_seen.start_periodic_flush(), task)
+        try:
+            await asyncio.sleep(0.2)
+            self.assertEqual(await self.stored(), self.seen)
+        finally:
+            await last_seen.stop_periodic_flush()
+
+    async def test_lifespan_shutdown_flushes_pending_writes(self):
+        from chat import admission
+
+        self.addCleanup(setattr, admission, '_controller', None)
+        messages = asyncio.Queue()
+        sent = []
+        for message_type in ('lifespan.startup', 'lifespan.shutdown'):
+            messages.put_nowait({'type': message_type})
+
+        async def send(message):
+            sent.append(message['type'])
+            if message['type'] == 'lifespan.startup.complete':
+                # Activité juste avant l'arrêt, avant tout passage périodique
+                last_seen.get_last_seen_buffer().touch(self.user.id, now=self.seen)
+
+        with override_settings(LAST_SEEN={'FLUSH_INTERVAL': 3600}):
+            await admission.AdmissionMiddleware(None)({'type': 'lifespan'}, messages.get, send)
+        self.assertEqual(sent, ['lifespan.startup.complete', 'lifespan.shutdown.complete'])
+        self.assertEqual(await self.stored(), self.seen)
+
+
+class ProfileInvalidationTests(SimpleTestCase):
+    """Une invalidation vide aussi le cache local des autres workers"""
+
+    async def test_invalidation_reaches_other_workers(self):
+        layer = InMemoryChannelLayer()
+        editor = profiles.ProfileCache(channel_layer=layer)
+        worker = profiles.ProfileCache(channel_layer=layer)
+        await worker.listen()
+        for username in ('alice', 'bob'):
+            worker.prime(CustomUser(username=username))
+
+        # Depuis un thread (signal post_save d'une vue) puis depuis la boucle
+        await sync_to_async(editor.invalidate)('alice')
+        editor.invalidate('bob')
+        await asyncio.sleep(0.05)
+
+        found, missing = worker._get_local(['alice', 'bob'])
+        self.assertEqual((found, missing), ({}, ['alice', 'bob']))
+
+    async def test_listener_survives_a_failed_receive(self):
+        class FlakyChannelLayer(InMemoryChannelLayer):
+            failures = 1
+
+            async def receive(self, channel):
+                if self.failures:
+                    self.failures -= 1
+                    raise ConnectionError('déconnecté')
+                return await super().receive(channel)
+
+        layer = FlakyChannelLayer()
+        worker = profiles.ProfileCache(channel_layer=layer)
+        with self.assertLogs('accounts.profiles', 'ERROR'):
+            await worker.listen()
+            worker.prime(CustomUser(username='alice'))
+            profiles.ProfileCache(channel_layer=layer).invalidate('alice')
+            await asyncio.sleep(0.3)
+
+        self.assertEqual(worker._get_local(['alice']), ({}, ['alice']))
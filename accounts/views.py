@@ -1,7 +1,12 @@
+import os
 from django.shortcuts import render, redirect
 from django.contrib.auth import login, authenticate, logout
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
+from django.http import Http404
+from django.views.static import serve
+from django.conf import settings
+from .avatars import THUMBNAIL_DIR, get_avatars_config
 from .forms import CustomUserCreationForm, LoginForm
 from .models import CustomUser
 
@@ -46,4 +51,16 @@ def logout_view(request):
         request.user.save()
     logout(request)
     messages.info(request, 'Vous avez été déconnecté.')
-    return redirect('login')
\ No newline at end of file
+    return redirect('login')
+
+def avatar_thumbnail_view(request, name):
+    """
+    Miniatures d'avatar avec un cache d'un an : leur nom change avec leur contenu.
+    Comme les autres médias, servies par Django seulement en DEBUG ; en
+    production, le serveur web sert MEDIA_URL (avec ces mêmes en-têtes).
+    """
+    if not settings.DEBUG:
+        raise Http404
+    response = serve(request, name, document_root=os.path.join(settings.MEDIA_ROOT, THUMBNAIL_DIR))
+    response['Cache-Control'] = f"public, max-age={get_avatars_config()['MAX_AGE']}, immutable"
+    return response
\ No newline at end of file
@@ -0,0 +1,284 @@
+# chat/admission.py
+"""
+Contrôle d'admission des connexions WebSocket, pour les tempêtes de
+reconnexions (redémarrage d'un worker, coupure réseau).
+
+Une connexion coûte surtout à son ouverture : session et utilisateur
+(AuthMiddlewareStack), salle, historique, présence. ``AdmissionMiddleware``
+limite donc, par worker, le nombre d'ouvertures simultanées
+(MAX_CONCURRENT) ; une ouverture occupe sa place jusqu'à la fin de
+``ChatConsumer.connect()`` (``release_admission``) ou la fermeture.
+
+Au-delà, les ouvertures attendent leur tour au plus QUEUE_TIMEOUT secondes,
+les reprises (``resume_after`` : le client a déjà la page) avant les
+nouvelles arrivées. File pleine ou attente trop longue : la connexion est
+acceptée puis aussitôt fermée (code 1013) après une trame
+``{"type": "reconnect", "retry_after": <s>}``, avec une part aléatoire pour
+que les clients refusés ne reviennent pas tous ensemble.
+
+Arrêt du worker (``lifespan.shutdown``, serveurs ASGI qui le gèrent) : plus
+aucune admission, et chaque connexion ouverte reçoit une trame ``reconnect``
+avec un délai réparti sur DRAIN_WINDOW secondes avant d'être fermée (1012),
+pour que les clients rejoignent les autres workers par vagues.
+"""
+import asyncio
+import logging
+import random
+import weakref
+from collections import deque
+from urllib.parse import parse_qs
+
+from django.conf import settings
+
+from accounts.last_seen import start_periodic_flush, stop_periodic_flush
+
+from . import metrics
+from .protocol import negotiate
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ADMISSION = {
+    'MAX_CONCURRENT': 32,   # ouvertures simultanées par worker
+    'MAX_QUEUE': 1000,      # ouvertures en attente
+    'QUEUE_TIMEOUT': 5,     # secondes d'attente au plus
+    'RETRY_AFTER': 2,       # délai minimal indiqué aux clients refusés
+    'RETRY_JITTER': 8,      # + délai aléatoire entre 0 et RETRY_JITTER
+    'DRAIN_WINDOW': 30,     # secondes sur lesquelles répartir les reconnexions
+}
+
+TRY_AGAIN_LATER = 1013
+SERVICE_RESTART = 1012
+
+connecting = metrics.gauge('chat_admission_connecting', 'Ouvertures de connexion en cours')
+waiting = metrics.gauge('chat_admission_waiting', "Ouvertures en attente d'admission")
+rejected = metrics.counter('chat_admission_rejected_total', "Ouvertures refusées (file pleine, attente, arrêt)")
+wait_seconds = metrics.histogram(
+    'chat_admission_wait_seconds', "Attente avant admission", buckets=(0.01, 0.1, 0.5, 1, 2, 5),
+)
+
+
+def get_admission_config():
+    return {**DEFAULT_ADMISSION, **getattr(settings, 'CHAT_ADMISSION', {})}
+
+
+class Rejected(Exception):
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+
+def granted(future):
+    """Place effectivement transmise à une ouverture en attente"""
+    return future.done() and not future.cancelled() and future.exception() is None
+
+
+class Ticket:
+    """Place occupée par une ouverture ; libérée une seule fois"""
+
+    def __init__(self, controller):
+        self.controller = controller
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.controller._release()
+
+
+class AdmissionController:
+
+    def __init__(self, max_concurrent=32, max_queue=1000, queue_timeout=5,
+                 retry_after=2, retry_jitter=8, drain_window=30):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.retry_jitter = retry_jitter
+        self.drain_window = drain_window
+        self.active = 0
+        self.resumes = deque()  # futures en attente, servies en premier
+        self.joins = deque()
+        self.draining = False
+        self.consumers = weakref.WeakSet()  # connexions ouvertes, pour l'arrêt
+
+    def retry_delay(self):
+        return self.retry_after + random.uniform(0, self.retry_jitter)
+
+    async def admit(self, resume=False):
+        """Ticket d'admission ; Rejected si le worker est saturé ou s'arrête"""
+        if self.draining:
+            raise Rejected('draining')
+        if self.active < self.max_concurrent and not self.resumes and not self.joins:
+            self.active += 1
+            connecting.set(self.active)
+            return Ticket(self)
+        if len(self.resumes) + len(self.joins) >= self.max_queue:
+            raise Rejected('busy')
+
+        queue = self.resumes if resume else self.joins
+        future = asyncio.get_running_loop().create_future()
+        queue.append(future)
+        waiting.inc()
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.queue_timeout)
+        except asyncio.TimeoutError:
+            if granted(future):
+                wait_seconds.observe(loop.time() - started)
+                return Ticket(self)  # admis au dernier moment
+            future.cancel()
+            raise Rejected('busy')
+        except asyncio.CancelledError:
+            # Client parti pendant l'attente : rendre la place si elle venait d'être donnée
+            if granted(future):
+                self._release()
+            future.cancel()
+            raise
+        finally:
+            waiting.dec()
+            if future in queue:
+                queue.remove(future)
+        if self.draining:
+            self._release()
+            raise Rejected('draining')
+        wait_seconds.observe(loop.time() - started)
+        return Ticket(self)
+
+    def _release(self):
+        # La place passe directement à la prochaine ouverture en attente
+        for queue in (self.resumes, self.joins):
+            while queue:
+                future = queue.popleft()
+                if not future.done():
+                    future.set_result(None)
+                    return
+        self.active -= 1
+        connecting.set(self.active)
+
+    def track(self, consumer):
+        self.consumers.add(consumer)
+
+    def untrack(self, consumer):
+        self.consumers.discard(consumer)
+
+    async def drain(self):
+        """Arrêt du worker : refuse les ouvertures, renvoie les clients par vagues"""
+        self.draining = True
+        for queue in (self.resumes, self.joins):
+            while queue:
+                future = queue.popleft()
+                if not future.done():
+                    future.set_exception(Rejected('draining'))
+        consumers = list(self.consumers)
+        random.shuffle(consumers)
+        step = self.drain_window / max(len(consumers), 1)
+        logger.info('Arrêt : %d connexions renvoyées sur %ss', len(consumers), self.drain_window)
+        await asyncio.gather(
+            *(consumer.drain(index * step) for index, consumer in enumerate(consumers)),
+            return_exceptions=True,
+        )
+
+
+_controller = None
+
+
+def get_admission_controller():
+    """Contrôleur unique (par processus) configuré via settings.CHAT_ADMISSION"""
+    global _controller
+    if _controller is None:
+        config = get_admission_config()
+        _controller = AdmissionController(
+            max_concurrent=config['MAX_CONCURRENT'],
+            max_queue=config['MAX_QUEUE'],
+            queue_timeout=config['QUEUE_TIMEOUT'],
+            retry_after=config['RETRY_AFTER'],
+            retry_jitter=config['RETRY_JITTER'],
+            drain_window=config['DRAIN_WINDOW'],
+        )
+    return _controller
+
+
+def release_admission(scope):
+    """Ouverture terminée (fin de connect()) : la place passe à la suivante"""
+    ticket = scope.get('admission')
+    if ticket is not None:
+        ticket.release()
+
+
+def is_resume(scope):
+    query = parse_qs(scope.get('query_string', b'').decode())
+    try:
+        int(query['resume_after'][0])
+    except (KeyError, ValueError):
+        return False
+    return True
+
+
+class AdmissionMiddleware:
+    """
+    Middleware ASGI placé autour du ProtocolTypeRouter (WebSocket et
+    lifespan ; le lifespan démarre et arrête aussi l'écriture de last_seen)
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'websocket':
+            return await self.app(scope, receive, send)
+
+        controller = get_admission_controller()
+        try:
+            ticket = await controller.admit(resume=is_resume(scope))
+        except Rejected as e:
+            rejected.inc()
+            return await self.reject(scope, receive, send, e.reason, controller.retry_delay())
+
+        async def releasing_send(message):
+            # Fermée avant la fin de connect() : la place est rendue tout de suite
+            if message['type'] == 'websocket.close':
+                ticket.release()
+            await send(message)
+
+        try:
+            return await self.app(dict(scope, admission=ticket), receive, releasing_send)
+        finally:
+            ticket.release()
+
+    async def reject(self, scope, receive, send, reason, retry_after):
+        """Accepte pour pouvoir indiquer quand revenir, puis ferme (1013)"""
+        message = await receive()
+        if message['type'] != 'websocket.connect':
+            return
+        subprotocol, protocol = negotiate(scope.get('subprotocols'))
+        if protocol is None:
+            await send({'type': 'websocket.close'})
+            return
+        await send({'type': 'websocket.accept', 'subprotocol': subprotocol})
+        frame = {'type': 'reconnect', 'retry_after': round(retry_after, 1), 'reason': reason}
+        for payload in protocol.encode(frame):
+            key = 'bytes' if isinstance(payload, bytes) else 'text'
+            await send({'type': 'websocket.send', key: payload})
+        await send({'type': 'websocket.close', 'code': TRY_AGAIN_LATER})
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                # Tâches de fond du worker
+                start_periodic_flush()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                try:
+                    await get_admission_controller().drain()
+                except Exception:
+                    logger.exception("Échec de l'arrêt progressif des connexions")
+                try:
+                    await stop_periodic_flush()
+                except Exception:
+                    logger.exception("Impossible d'écrire les last_seen en attente")
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
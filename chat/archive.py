@@ -0,0 +1,384 @@
+# chat/archive.py
+"""
+Archivage des anciens messages en segments compressés, par salle.
+
+Les messages plus vieux que l'horizon de leur salle (``retention_days``, ou
+DEFAULT_RETENTION_DAYS) quittent la table ``chat_message`` pour des
+fichiers en ajout seul :
+
+    <ROOT>/<room_id>/<n>.seg   blocs zlib de BLOCK_MESSAGES messages (JSON :
+                               id, timestamp, auteur, texte [, pièce jointe])
+    <ROOT>/<room_id>/<n>.idx   un enregistrement de taille fixe par bloc :
+                               (premier ts, dernier ts, premier id,
+                               dernier id, position, longueur) ; les
+                               ts sont des microsecondes entières depuis
+                               l'époque, pour des comparaisons exactes
+
+Les segments d'une salle ne se chevauchent pas et suivent l'ordre
+(timestamp, id) de l'historique. La lecture (fetch_page, quand la table est
+épuisée) projette l'index et le segment en mémoire (mmap), cherche le bloc
+par dichotomie et ne décompresse que les blocs nécessaires.
+
+Reprise après incident : le .idx est écrit en dernier, puis les messages
+sont supprimés de la table. Un passage interrompu entre les deux est
+rattrapé au suivant, qui supprime d'abord ce que l'index couvre déjà (et
+le compte dans ``archived_message_count``).
+
+Les messages archivés ne sont plus dans l'index de recherche.
+
+L'archivage est désactivé par défaut (DEFAULT_RETENTION_DAYS à None) et
+l'écriture verrouille chaque salle avec fcntl.flock : systèmes POSIX
+seulement. Ailleurs, la lecture des archives existantes fonctionne, mais
+archive_room lève ArchiveUnavailable.
+"""
+import json
+import logging
+import mmap
+import os
+import shutil
+import struct
+import zlib
+from datetime import datetime, timedelta, timezone as dt_timezone
+from pathlib import Path
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from accounts.profiles import DEFAULT_AVATAR_URL, get_profile_cache
+
+from . import metrics
+from .attachments import describe
+
+try:
+    import fcntl
+except ImportError:  # Windows : pas de verrou de fichier POSIX
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ARCHIVE = {
+    'ROOT': None,                   # défaut : MEDIA_ROOT/chat_archive
+    'DEFAULT_RETENTION_DAYS': None, # None : pas d'archivage sans retention_days
+    'BLOCK_MESSAGES': 256,
+    'BATCH_SIZE': 5000,             # messages lus et supprimés par transaction
+}
+
+RECORD = struct.Struct('<qqqqQQ')
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+MICROSECOND = timedelta(microseconds=1)
+
+archived_messages = metrics.counter('chat_archived_messages_total', 'Messages déplacés vers les archives')
+archive_reads = metrics.counter('chat_archive_block_reads_total', "Blocs d'archive décompressés")
+
+
+def get_archive_config():
+    config = {**DEFAULT_ARCHIVE, **getattr(settings, 'CHAT_ARCHIVE', {})}
+    if config['ROOT'] is None:
+        config['ROOT'] = os.path.join(settings.MEDIA_ROOT, 'chat_archive')
+    return config
+
+
+class ArchiveUnavailable(RuntimeError):
+    """Écriture des archives impossible sur cette plateforme (pas de fcntl)"""
+
+
+def to_micros(moment):
+    """Microsecondes depuis l'époque, sans passer par un flottant"""
+    return (moment - EPOCH) // MICROSECOND
+
+
+def from_micros(micros):
+    return EPOCH + micros * MICROSECOND
+
+
+def sort_key(timestamp, message_id):
+    return (to_micros(timestamp), message_id)
+
+
+class Segment:
+    """Un couple .seg / .idx, ouvert en lecture seule via mmap"""
+
+    def __init__(self, base):
+        self.base = base
+
+    def __enter__(self):
+        self._files = [open(f'{self.base}.idx', 'rb'), open(f'{self.base}.seg', 'rb')]
+        self.index, self.data = (
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) for f in self._files
+        )
+        self.blocks = len(self.index) // RECORD.size
+        return self
+
+    def __exit__(self, *exc):
+        self.index.close()
+        self.data.close()
+        for f in self._files:
+            f.close()
+
+    def record(self, number):
+        return RECORD.unpack_from(self.index, number * RECORD.size)
+
+    def last_key(self):
+        first_ts, last_ts, first_id, last_id, _, _ = self.record(self.blocks - 1)
+        return (last_ts, last_id)
+
+    def block_before(self, key):
+        """Dernier bloc dont le premier message précède ``key`` (None : aucun)"""
+        low, high = 0, self.blocks
+        while low < high:
+            middle = (low + high) // 2
+            first_ts, _, first_id, _, _, _ = self.record(middle)
+            if (first_ts, first_id) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low - 1 if low else None
+
+    def read_block(self, number):
+        _, _, _, _, offset, length = self.record(number)
+        archive_reads.inc()
+        return json.loads(zlib.decompress(self.data[offset:offset + length]))
+
+
+class MessageArchive:
+
+    def __init__(self, root, block_messages=256, batch_size=5000):
+        self.root = Path(root)
+        self.block_messages = block_messages
+        self.batch_size = batch_size
+        self._listing = {}  # room_id -> (mtime du dossier, segments)
+
+    def room_dir(self, room_id):
+        return self.root / str(room_id)
+
+    def segments(self, room_id):
+        """Chemins (sans extension) des segments complets, du plus ancien au plus récent"""
+        directory = self.room_dir(room_id)
+        try:
+            mtime = directory.stat().st_mtime_ns
+        except FileNotFoundError:
+            return []
+        cached = self._listing.get(room_id)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        numbers = sorted(
+            int(name[:-4]) for name in os.listdir(directory)
+            if name.endswith('.idx') and name[:-4].isdigit()
+        )
+        segments = [str(directory / f'{number:08d}') for number in numbers]
+        self._listing[room_id] = (mtime, segments)
+        return segments
+
+    def last_archived_key(self, room_id):
+        segments = self.segments(room_id)
+        if not segments:
+            return None
+        with Segment(segments[-1]) as segment:
+            return segment.last_key()
+
+    # -- Lecture -------------------------------------------------------------
+
+    def page_before(self, room_id, before=None, limit=50):
+        """
+        Messages archivés strictement antérieurs à ``before`` ((timestamp, id)
+        ou None), du plus ancien au plus récent, et s'il en reste d'autres.
+        Même forme que history.serialize_rows.
+        """
+        key = sort_key(*before) if before is not None else (float('inf'), 0)
+        found = []  # du plus récent au plus ancien
+        has_more = False
+        for base in reversed(self.segments(room_id)):
+            with Segment(base) as segment:
+                number = segment.block_before(key)
+                while number is not None and number >= 0:
+                    block = segment.read_block(number)
+                    for message in reversed(block):
+                        if sort_key(datetime.fromisoformat(message[1]), message[0]) >= key:
+                            continue
+                        if len(found) == limit:
+                            has_more = True
+                            break
+                        found.append(message)
+                    if has_more:
+                        break
+                    number -= 1
+            if has_more:
+                break
+        return self.serialize(reversed(found)), has_more
+
+    def iter_messages(self, room_id, since=None, until=None):
+        """Tous les messages archivés d'une salle, dans l'ordre (pour l'export)"""
+        for base in self.segments(room_id):
+            with Segment(base) as segment:
+                for number in range(segment.blocks):
+                    first_ts, last_ts, _, _, _, _ = segment.record(number)
+                    if since is not None and last_ts < to_micros(since):
+                        continue
+                    if until is not None and first_ts >= to_micros(until):
+                        return
+                    for message_id, timestamp, username, content, *_ in segment.read_block(number):
+                        moment = datetime.fromisoformat(timestamp)
+                        if (since is None or moment >= since) and (until is None or moment < until):
+                            yield {
+                                'id': message_id,
+                                'timestamp': timestamp,
+                                'username': username,
+                                'content': content,
+                            }
+
+    def serialize(self, rows):
+        rows = list(rows)
+        profiles = get_profile_cache().get_many({row[2] for row in rows})
+        messages = []
+        for message_id, timestamp, username, content, *attachment in rows:
+            message = {
+                'id': message_id,
+                'content': content,
+                'username': username,
+                'avatar': profiles.get(username, {}).get('avatar', DEFAULT_AVATAR_URL),
+                'timestamp': timestamp,
+            }
+            if attachment:
+                message['attachment'] = describe(*attachment[0])
+            messages.append(message)
+        return messages
+
+    # -- Écriture ------------------------------------------------------------
+
+    def archive_room(self, room, horizon, dry_run=False):
+        """Déplace les messages de ``room`` antérieurs à ``horizon`` ; retourne leur nombre"""
+        from .models import ChatRoom, Message
+
+        if fcntl is None:
+            raise ArchiveUnavailable(
+                "L'archivage des messages nécessite fcntl (Linux, macOS...) : "
+                "laissez DEFAULT_RETENTION_DAYS et retention_days vides sur cette plateforme."
+            )
+        directory = self.room_dir(room.id)
+        directory.mkdir(parents=True, exist_ok=True)
+        with open(directory / '.lock', 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                logger.info('Archivage de %s déjà en cours, salle ignorée', room.name)
+                return 0
+
+            queryset = Message.objects.filter(room=room, timestamp__lt=horizon)
+            if dry_run:
+                return queryset.count()
+            # Passage précédent interrompu après l'écriture de l'index
+            last_key = self.last_archived_key(room.id)
+            if last_key is not None:
+                last_ts = from_micros(last_key[0])
+                with transaction.atomic():
+                    _, deleted = queryset.filter(
+                        Q(timestamp__lt=last_ts) | Q(timestamp=last_ts, id__lte=last_key[1])
+                    ).delete()
+                    recovered = deleted.get(Message._meta.label, 0)
+                    if recovered:
+                        ChatRoom.objects.filter(id=room.id).update(
+                            archived_message_count=F('archived_message_count') + recovered,
+                        )
+
+            total = 0
+            while True:
+                rows = list(
+                    queryset.order_by('timestamp', 'id')
+                    .values_list(
+                        'id', 'timestamp', 'user__username', 'content', 'attachment_id',
+                        'attachment__filename', 'attachment__size', 'attachment__content_type',
+                    )[:self.batch_size]
+                )
+                if not rows:
+                    break
+                self._write_segment(directory, rows)
+                with transaction.atomic():
+                    Message.objects.filter(id__in=[row[0] for row in rows]).delete()
+                    ChatRoom.objects.filter(id=room.id).update(
+                        archived_message_count=F('archived_message_count') + len(rows),
+                    )
+                archived_messages.inc(len(rows))
+                total += len(rows)
+            return total
+
+    @staticmethod
+    def _entry(message_id, timestamp, username, content, attachment_id=None, *attachment):
+        entry = [message_id, timestamp.isoformat(), username, content]
+        if attachment_id is not None:
+            # Métadonnées seulement : le fichier reste dans MEDIA_ROOT/attachments
+            entry.append([str(attachment_id), *attachment])
+        return entry
+
+    def _write_segment(self, directory, rows):
+        numbers = [int(name[:-4]) for name in os.listdir(directory) if name.endswith('.idx')]
+        base = directory / f'{max(numbers, default=0) + 1:08d}'
+        index = bytearray()
+        offset = 0
+        with open(f'{base}.seg.tmp', 'wb') as data:
+            for start in range(0, len(rows), self.block_messages):
+                block = rows[start:start + self.block_messages]
+                payload = zlib.compress(json.dumps(
+                    [self._entry(*row) for row in block],
+                    separators=(',', ':'),
+                ).encode())
+                data.write(payload)
+                index += RECORD.pack(
+                    to_micros(block[0][1]), to_micros(block[-1][1]),
+                    block[0][0], block[-1][0], offset, len(payload),
+                )
+                offset += len(payload)
+            data.flush()
+            os.fsync(data.fileno())
+        with open(f'{base}.idx.tmp', 'wb') as idx:
+            idx.write(index)
+            idx.flush()
+            os.fsync(idx.fileno())
+        # L'index rend le segment visible : il est renommé en dernier
+        os.replace(f'{base}.seg.tmp', f'{base}.seg')
+        os.replace(f'{base}.idx.tmp', f'{base}.idx')
+
+    def delete_room(self, room_id):
+        shutil.rmtree(self.room_dir(room_id), ignore_errors=True)
+        self._listing.pop(room_id, None)
+
+
+_archive = None
+
+
+def get_archive():
+    """Archive unique (par processus) configurée via settings.CHAT_ARCHIVE"""
+    global _archive
+    if _archive is None:
+        config = get_archive_config()
+        _archive = MessageArchive(
+            root=config['ROOT'],
+            block_messages=config['BLOCK_MESSAGES'],
+            batch_size=config['BATCH_SIZE'],
+        )
+    return _archive
+
+
+def archive_expired_messages(room_names=None, dry_run=False, now=None):
+    """
+    Tâche d'archivage, à planifier (cron, Celery beat...) ou lancée par
+    ``manage.py archive_messages``. Retourne {nom de salle: messages archivés}.
+    """
+    from .models import ChatRoom
+
+    archive = get_archive()
+    default_days = get_archive_config()['DEFAULT_RETENTION_DAYS']
+    now = now or timezone.now()
+    rooms = ChatRoom.objects.all()
+    if room_names:
+        rooms = rooms.filter(name__in=room_names)
+    results = {}
+    for room in rooms.iterator():
+        days = room.retention_days if room.retention_days is not None else default_days
+        if days is None:
+            continue
+        count = archive.archive_room(room, now - timedelta(days=days), dry_run=dry_run)
+        if count:
+            results[room.name] = count
+    return results
@@ -0,0 +1,361 @@
+# chat/attachments.py
+"""
+Pièces jointes envoyées par morceaux, avec reprise.
+
+1. ``POST /chat/<salle>/attachments/`` (nom, taille, type) crée l'envoi ;
+2. chaque morceau est un ``PUT /chat/attachments/<id>/`` avec un en-tête
+   ``Content-Range: bytes <début>-<fin>/<taille>``, d'au plus CHUNK_SIZE
+   octets : une requête courte, qui n'occupe jamais longtemps un worker ASGI
+   ni la boucle du consumer. ``GET`` sur la même URL donne la position
+   atteinte, d'où le client reprend après une coupure ;
+3. le dernier morceau reçu, le fichier est rangé sous
+   MEDIA_ROOT/attachments/<2 premiers caractères>/<empreinte SHA-256> : deux
+   envois identiques partagent le même fichier. L'empreinte est calculée au
+   fil des morceaux (état gardé par le worker) ; le fichier n'est relu que
+   si des morceaux sont passés par un autre worker ;
+4. le client envoie alors ``{"message": ..., "attachment": "<id>"}`` sur le
+   WebSocket. La trame diffusée ne contient que les métadonnées (nom,
+   taille, type, URL) : le contenu ne passe jamais par la couche de canaux.
+
+Les téléchargements acceptent ``Range`` ; avec SENDFILE_HEADER (par exemple
+``X-Accel-Redirect`` derrière nginx), le serveur frontal envoie lui-même le
+fichier.
+
+Nettoyage (``manage.py cleanup_attachments``, à planifier avec
+archive_messages) : envois restés incomplets plus de UPLOAD_TTL secondes,
+morceaux et fichiers qu'aucune pièce jointe ne référence plus.
+"""
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.conf import settings
+from django.urls import reverse
+from django.utils import timezone
+
+DEFAULT_ATTACHMENTS = {
+    'MAX_SIZE': 50 * 1024 * 1024,
+    'CHUNK_SIZE': 1024 * 1024,        # taille maximale d'un morceau
+    'SENDFILE_HEADER': None,          # 'X-Accel-Redirect', 'X-Sendfile'...
+    'SENDFILE_PREFIX': '/protected/', # préfixe interne du serveur frontal
+    'UPLOAD_TTL': 24 * 3600,          # secondes pour terminer un envoi
+}
+
+STORAGE_DIR = 'attachments'
+PARTIAL_DIR = 'partial'
+COPY_BUFFER = 64 * 1024
+
+# Empreintes en cours (id -> (octets hachés, état sha256)), propres au worker
+MAX_HASH_STATES = 256
+_hash_states = OrderedDict()
+_hash_lock = threading.Lock()
+
+CONTENT_RANGE_RE = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class UploadConflict(Exception):
+    """Morceau qui ne commence pas là où l'envoi s'est arrêté"""
+
+    def __init__(self, received):
+        super().__init__(f'Reprendre à {received}')
+        self.received = received
+
+
+def get_attachments_config():
+    return {**DEFAULT_ATTACHMENTS, **getattr(settings, 'CHAT_ATTACHMENTS', {})}
+
+
+def partial_path(attachment):
+    return os.path.join(settings.MEDIA_ROOT, STORAGE_DIR, PARTIAL_DIR, f'{attachment.id.hex}.part')
+
+
+def blob_name(sha256):
+    return f'{STORAGE_DIR}/{sha256[:2]}/{sha256}'
+
+
+def blob_path(sha256):
+    return os.path.join(settings.MEDIA_ROOT, blob_name(sha256))
+
+
+def describe(attachment_id, filename, size, content_type):
+    """Métadonnées diffusées avec le message (jamais le contenu)"""
+    return {
+        'id': str(attachment_id),
+        'name': filename,
+        'size': size,
+        'content_type': content_type,
+        'url': reverse('chat:attachment_download', args=[attachment_id]),
+    }
+
+
+def describe_attachment(attachment):
+    return describe(attachment.id, attachment.filename, attachment.size, attachment.content_type)
+
+
+def create_upload(user, room, filename, size, content_type):
+    """Nouvel envoi ; ValueError si la taille ou le nom ne conviennent pas"""
+    from .models import Attachment
+
+    try:
+        size = int(size)
+    except (TypeError, ValueError):
+        raise ValueError('Taille invalide')
+    if not 0 < size <= get_attachments_config()['MAX_SIZE']:
+        raise ValueError('Fichier vide ou trop volumineux')
+    filename = os.path.basename(str(filename or '')).strip()[:255]
+    if not filename:
+        raise ValueError('Nom de fichier requis')
+    return Attachment.objects.create(
+        room=room,
+        user=user,
+        filename=filename,
+        size=size,
+        content_type=(content_type or 'application/octet-stream')[:100],
+    )
+
+
+def upload_expired(attachment, now=None):
+    ttl = timedelta(seconds=get_attachments_config()['UPLOAD_TTL'])
+    return (now or timezone.now()) - attachment.created_at > ttl
+
+
+def _hash_state(attachment_id, offset):
+    """Copie de l'empreinte des ``offset`` premiers octets, si ce worker l'a"""
+    if offset == 0:
+        return hashlib.sha256()
+    with _hash_lock:
+        state = _hash_states.get(attachment_id)
+    if state is None or state[0] != offset:
+        return None
+    return state[1].copy()
+
+
+def _keep_hash_state(attachment_id, offset, digest):
+    with _hash_lock:
+        _hash_states[attachment_id] = (offset, digest)
+        _hash_states.move_to_end(attachment_id)
+        while len(_hash_states) > MAX_HASH_STATES:
+            _hash_states.popitem(last=False)
+
+
+def _pop_hash_state(attachment_id):
+    with _hash_lock:
+        return _hash_states.pop(attachment_id, None)
+
+
+def parse_content_range(header, size):
+    """(début, fin exclue) d'un en-tête Content-Range ; ValueError si invalide"""
+    match = CONTENT_RANGE_RE.match(header or '')
+    if match is None:
+        raise ValueError('En-tête Content-Range invalide')
+    start, last, total = (int(value) for value in match.groups())
+    if total != size or start > last or last >= size:
+        raise ValueError('Plage hors du fichier')
+    return start, last + 1
+
+
+def append_chunk(attachment, content_range, stream):
+    """
+    Écrit un morceau lu en flux depuis ``stream`` (la requête) ; retourne la
+    position atteinte. UploadConflict si le morceau ne suit pas le précédent,
+    ValueError si la plage est invalide.
+    """
+    from .models import Attachment
+
+    if attachment.is_complete:
+        raise UploadConflict(attachment.size)
+    if upload_expired(attachment):
+        raise ValueError('Envoi expiré')
+    start, end = parse_content_range(content_range, attachment.size)
+    if start != attachment.received:
+        raise UploadConflict(attachment.received)
+    if end - start > get_attachments_config()['CHUNK_SIZE']:
+        raise ValueError('Morceau trop grand')
+
+    path = partial_path(attachment)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    digest = _hash_state(attachment.id, start)
+    written = 0
+    with open(path, 'r+b' if start else 'wb') as part:
+        part.seek(start)
+        part.truncate()
+        while written < end - start:
+            data = stream.read(min(COPY_BUFFER, end - start - written))
+            if not data:
+                break
+            part.write(data)
+            if digest is not None:
+                digest.update(data)
+            written += len(data)
+    if written != end - start:
+        raise ValueError('Morceau incomplet')
+
+    # Deux morceaux concurrents au même endroit : un seul avance
+    if not Attachment.objects.filter(id=attachment.id, received=start).update(received=end):
+        attachment.refresh_from_db(fields=['received'])
+        raise UploadConflict(attachment.received)
+    attachment.received = end
+    if digest is not None:
+        _keep_hash_state(attachment.id, end, digest)
+    if end == attachment.size:
+        finalize(attachment)
+    return end
+
+
+def finalize(attachment):
+    """Rangement (ou dédoublonnage) sous l'empreinte du contenu"""
+    path = partial_path(attachment)
+    state = _pop_hash_state(attachment.id)
+    if state is not None and state[0] == attachment.size:
+        digest = state[1]
+    else:
+        # Morceaux reçus en partie par un autre worker : relecture en flux
+        digest = hashlib.sha256()
+        with open(path, 'rb') as part:
+            for data in iter(lambda: part.read(COPY_BUFFER), b''):
+                digest.update(data)
+    sha256 = digest.hexdigest()
+    target = blob_path(sha256)
+    if os.path.exists(target):
+        os.remove(path)
+        # Fichier de nouveau utilisé : le nettoyage ne le croit plus orphelin
+        os.utime(target)
+    else:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(path, target)
+    attachment.sha256 = sha256
+    attachment.completed_at = timezone.now()
+    attachment.save(update_fields=['sha256', 'completed_at'])
+
+
+def find_sendable(user, room_id, attachment_id):
+    """Métadonnées d'une pièce jointe complète de ``user`` dans la salle, ou None"""
+    from .models import Attachment
+
+    attachment = (
+        Attachment.objects.filter(
+            id=attachment_id, user=user, room_id=room_id, completed_at__isnull=False,
+        )
+        .only('id', 'filename', 'size', 'content_type')
+        .first()
+    )
+    return describe_attachment(attachment) if attachment is not None else None
+
+
+def parse_range(header, size):
+    """(début, fin exclue) d'un en-tête Range à une seule plage, sinon None"""
+    match = RANGE_RE.match(header or '')
+    if match is None or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if first == '':
+        start, end = max(0, size - int(last)), size
+    else:
+        start = int(first)
+        end = min(size, int(last) + 1) if last else size
+    if start >= end:
+        raise ValueError('Plage non satisfaisable')
+    return start, end
+
+
+def read_range(path, start, end):
+    with open(path, 'rb') as blob:
+        blob.seek(start)
+        remaining = end - start
+        while remaining:
+            data = blob.read(min(COPY_BUFFER, remaining))
+            if not data:
+                return
+            remaining -= len(data)
+            yield data
+
+
+def sendfile_path(sha256):
+    """Chemin interne transmis au serveur frontal (SENDFILE_HEADER)"""
+    return get_attachments_config()['SENDFILE_PREFIX'] + blob_name(sha256)
+
+
+def cleanup_attachments(now=None, dry_run=False):
+    """
+    Supprime les envois incomplets depuis plus de UPLOAD_TTL secondes, puis
+    les morceaux et fichiers orphelins (salle supprimée...) plus vieux que
+    UPLOAD_TTL. Retourne {'uploads': n, 'partials': n, 'blobs': n}.
+    """
+    from .models import Attachment
+
+    now = now or timezone.now()
+    ttl = timedelta(seconds=get_attachments_config()['UPLOAD_TTL'])
+    cutoff = (now - ttl).timestamp()
+    results = {'uploads': 0, 'partials': 0, 'blobs': 0}
+
+    expired = list(Attachment.objects.filter(completed_at__isnull=True, created_at__lt=now - ttl))
+    results['uploads'] = len(expired)
+    if not dry_run:
+        for attachment in expired:
+            _remove(partial_path(attachment))
+            _pop_hash_state(attachment.id)
+        Attachment.objects.filter(id__in=[attachment.id for attachment in expired]).delete()
+
+    # Morceaux sans envoi en cours (supprimé ci-dessus ou avec sa salle)
+    partial_dir = os.path.join(settings.MEDIA_ROOT, STORAGE_DIR, PARTIAL_DIR)
+    stale = {
+        name[:-len('.part')]: os.path.join(partial_dir, name)
+        for name in _listdir(partial_dir)
+        if re.fullmatch(r'[0-9a-f]{32}\.part', name)
+        and _older_than(os.path.join(partial_dir, name), cutoff)
+    }
+    pending = {
+        attachment_id.hex for attachment_id in Attachment.objects.filter(
+            id__in=list(stale), completed_at__isnull=True,
+        ).values_list('id', flat=True)
+    }
+    for name, path in stale.items():
+        if name not in pending:
+            results['partials'] += 1
+            if not dry_run:
+                _remove(path)
+
+    # Fichiers complets qu'aucune pièce jointe ne référence plus, un dossier à la fois
+    storage_dir = os.path.join(settings.MEDIA_ROOT, STORAGE_DIR)
+    for prefix in _listdir(storage_dir):
+        directory = os.path.join(storage_dir, prefix)
+        if prefix == PARTIAL_DIR or not os.path.isdir(directory):
+            continue
+        names = [
+            name for name in _listdir(directory)
+            if _older_than(os.path.join(directory, name), cutoff)
+        ]
+        referenced = set(
+            Attachment.objects.filter(sha256__in=names).values_list('sha256', flat=True)
+        )
+        for name in names:
+            if name not in referenced:
+                results['blobs'] += 1
+                if not dry_run:
+                    _remove(os.path.join(directory, name))
+    return results
+
+
+def _listdir(directory):
+    try:
+        return os.listdir(directory)
+    except FileNotFoundError:
+        return []
+
+
+def _older_than(path, cutoff):
+    try:
+        return os.stat(path).st_mtime < cutoff
+    except FileNotFoundError:
+        return False
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -1,267 +1,573 @@
 import json
 import asyncio
+import time
+import uuid
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
 from django.contrib.auth.models import AnonymousUser
 from django.utils import timezone
 from datetime import timedelta
-from .models import ChatRoom, Message, CustomUser
+from .models import ChatRoom
+from accounts.profiles import get_profile_cache
+from accounts.last_seen import get_last_seen_buffer, start_periodic_flush
+from .presence import get_presence_store, get_presence_broadcaster, member_list
+from .history import get_history_cache, wire_message, fetch_page, fetch_after, fetch_latest, history_batch_frame
+from .protocol import negotiate
+from .ingest import get_ingest_queue, PendingMessage
+from .attachments import find_sendable
+from .receipts import get_receipt_aggregator, STATUSES as RECEIPT_STATUSES
+from .outbound import OutboundQueue, get_backpressure_config, rejected_frames, slow_consumers
+from .relay import get_room_relay, room_group_send
+from .instrumentation import database_sync_to_async, handler_seconds
+from .admission import SERVICE_RESTART, get_admission_controller, release_admission
+
+# Taille des pages d'historique demandées par load_before
+HISTORY_PAGE_SIZE = 50
+HISTORY_PAGE_MAX = 100
+
+# Au-delà de ce nombre de messages manqués, le client recharge la page
+RESUME_MAX_GAP = 200
+
+# Seule différence entre destinataires d'un chat_message : ajoutée à la
+# trame encodée une fois par l'expéditeur, sans repasser par json.dumps
+CURRENT_USER_SUFFIX = ', "is_current_user": true}'
+OTHER_USER_SUFFIX = ', "is_current_user": false}'
+
+
+def chat_message_frame(event):
+    frame = {
+        'type': 'chat_message',
+        'id': event['id'],
+        'cid': event['cid'],
+        'message': event['message'],
+        'username': event['username'],
+        'avatar': event['avatar'],
+        'timestamp': event['timestamp'],
+    }
+    # Métadonnées seulement : le fichier ne passe pas par la couche de canaux
+    if event.get('attachment'):
+        frame['attachment'] = event['attachment']
+    return frame
+
+
+def encode_chat_message(event):
+    """Trame chat_message commune à tous les destinataires (sans is_current_user)"""
+    return json.dumps(chat_message_frame(event))
+
+
+def personalize_chat_message(text, is_current_user, client_id=None):
+    """
+    Ajoute is_current_user (et, pour l'expéditeur, son client_id) à une trame
+    déjà encodée (remplace l'accolade finale)
+    """
+    suffix = CURRENT_USER_SUFFIX if is_current_user else OTHER_USER_SUFFIX
+    if client_id is not None:
+        suffix = ', "client_id": ' + json.dumps(client_id) + suffix
+    return text[:-1] + suffix
+
 
 class ChatConsumer(AsyncWebsocketConsumer):
-    # Stocker les connexions actives par salle
-    active_connections = {}
-    
+    # Registre des connexions actives par salle (partagé entre les workers)
+    presence = None
+    # Cache des derniers messages par salle (propre au worker)
+    history = None
+    # File d'envoi bornée de la connexion (créée après accept)
+    outbound = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # cid attribué par le serveur -> identifiant choisi par le client,
+        # prêt avant connect() pour les handlers appelés sans connexion
+        self.client_ids = {}
+
     async def connect(self):
         self.room_name = self.scope['url_route']['kwargs']['room_name']
         self.room_group_name = f'chat_{self.room_name}'
         self.user = self.scope['user']
         
+        # Fonctionnalités annoncées par le client : ?features=history_batch,...
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        self.features = {
+            feature
+            for value in query.get('features', [])
+            for feature in value.split(',')
+        }
+        # Reprise : dernier id de message déjà affiché par le client
+        try:
+            self.resume_after = int(query['resume_after'][0])
+        except (KeyError, ValueError):
+            self.resume_after = None
+        
+        # Protocole négocié (JSON par défaut) : chat.v1.json, chat.v1.compact...
+        self.subprotocol, self.protocol = negotiate(self.scope.get('subprotocols'))
+        
         # Vérifier si l'utilisateur est authentifié
-        if self.user == AnonymousUser():
+        if self.user == AnonymousUser() or self.protocol is None:
+            await self.close()
+            return
+        
+        # Résoudre la salle une seule fois pour toute la connexion
+        self.room_id = await self.get_room_id()
+        if self.room_id is None:
             await self.close()
             return
         
+        self.presence = get_presence_store()
+        self.ingest = get_ingest_queue()
+        
         # Rejoindre le groupe
         await self.channel_layer.group_add(
             self.room_group_name,
             self.channel_name
         )
         
-        await self.accept()
+        await self.accept(subprotocol=self.subprotocol)
         
-        # Ajouter l'utilisateur aux connexions actives
-        if self.room_name not in self.active_connections:
-            self.active_connections[self.room_name] = {}
+        # Connexions ouvertes, renvoyées par vagues à l'arrêt du worker
+        get_admission_controller().track(self)
+        
+        # Toutes les trames sortantes passent par une file bornée
+        self.limits = get_backpressure_config()
+        self.outbound = OutboundQueue(
+            self.write_frame,
+            max_frames=self.limits['MAX_QUEUE_FRAMES'],
+            max_bytes=self.limits['MAX_QUEUE_BYTES'],
+            send_timeout=self.limits['SEND_TIMEOUT'],
+            # Trames regroupées aux heures de pointe, si le client sait les lire
+            join=self.protocol.join if 'batch' in self.features else None,
+            batch_rate=self.limits['BATCH_RATE'],
+            batch_delay=self.limits['BATCH_DELAY'],
+            batch_max=self.limits['BATCH_MAX_FRAMES'],
+        )
+        
+        # Grandes salles : diffusion par le relais du worker (voir chat/relay.py)
+        self.relay = get_room_relay()
+        await self.relay.attach(self.room_name, self)
         
-        self.active_connections[self.room_name][self.user.username] = {
-            'channel_name': self.channel_name,
-            'avatar': self.user.avatar.url if self.user.avatar else '/media/avatars/default.png',
-            'joined_at': timezone.now()
+        # Profil public calculé une fois pour toute la connexion
+        # (l'utilisateur vient d'être chargé par AuthMiddlewareStack)
+        profiles = get_profile_cache()
+        self.profile = profiles.prime(self.user)
+        # Invalidations des profils modifiés via les autres workers
+        await profiles.listen()
+        
+        # Ajouter l'utilisateur aux connexions actives
+        presence_info = {
+            'avatar': self.profile['avatar'],
+            'bio': self.profile['bio'],
+            'joined_at': timezone.now().isoformat(),
         }
+        first_connection = await self.presence.add(
+            self.room_name,
+            self.channel_name,
+            self.user.username,
+            presence_info
+        )
         
         # Récupérer les 50 derniers messages AVEC LES HEURES RÉELLES
-        messages = await self.get_last_messages()
-        for message in messages:
-            await self.send(text_data=json.dumps({
-                'type': 'old_message',
-                'id': message['id'],
-                'message': message['content'],
-                'username': message['username'],
-                'avatar': message['avatar'],
-                'timestamp': message['timestamp'],
-            }))
+        # (depuis le cache du worker si la salle est chaude)
+        self.history = get_history_cache()
+        self.history.attach(self.room_name)
+        messages = await self.history.get_or_load(self.room_name, self.get_last_messages)
+        last_id = max((m['id'] or 0 for m in messages), default=0)
+        if self.resume_after is not None:
+            # Le client a déjà l'historique : seulement les messages manqués
+            await self.send_resume(messages)
+        elif not self.protocol.is_json:
+            # Protocoles compacts : toujours une seule trame
+            await self.send_frame(history_batch_frame(messages), last_id=last_id)
+        elif 'history_batch' in self.features:
+            # Une seule trame pré-encodée pour tout l'historique
+            await self.send(
+                text_data=self.history.get_batch_frame(self.room_name, messages),
+                last_id=last_id,
+            )
+        else:
+            # Anciens clients : un message par trame
+            for message in messages:
+                await self.send_frame({
+                    'type': 'old_message',
+                    **wire_message(message),
+                })
         
-        # Envoyer la liste des utilisateurs en ligne dans cette salle
+        # Envoyer la liste des utilisateurs en ligne au nouvel arrivant seulement
         await self.send_online_users()
+        await self.touch_last_seen()
         
-        # Notifier que l'utilisateur a rejoint
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'user_joined',
-                'username': self.user.username,
-                'avatar': self.user.avatar.url if self.user.avatar else '/media/avatars/default.png',
-            }
-        )
+        # Notifier les autres (delta regroupé, pas une liste complète par arrivée)
+        if first_connection:
+            get_presence_broadcaster().joined(self.room_name, self.user.username, presence_info)
+        
+        # Ouverture terminée : place à la suivante (voir chat/admission.py)
+        release_admission(self.scope)
 
     async def disconnect(self, close_code):
+        if self.outbound is not None:
+            self.outbound.close()
+            await self.relay.detach(self.room_name, self)
+            get_admission_controller().untrack(self)
+        
         # Quitter le groupe
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
         
-        # Retirer l'utilisateur des connexions actives
-        if self.room_name in self.active_connections:
-            if self.user.username in self.active_connections[self.room_name]:
-                del self.active_connections[self.room_name][self.user.username]
-            
-            # Supprimer la salle si vide
-            if not self.active_connections[self.room_name]:
-                del self.active_connections[self.room_name]
-        
-        # Envoyer la liste mise à jour
-        await self.send_online_users()
+        # Retirer la connexion du registre (la salle vide disparaît d'elle-même)
+        if self.presence is None:
+            return
+        last_connection = await self.presence.remove(self.room_name, self.channel_name)
+        if self.history is not None:
+            self.history.detach(self.room_name)
         
-        # Notifier que l'utilisateur a quitté
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'user_left',
-                'username': self.user.username,
-            }
-        )
+        # Notifier que l'utilisateur a quitté (delta regroupé)
+        if last_connection:
+            get_presence_broadcaster().left(self.room_name, self.user.username)
+        await self.touch_last_seen()
 
-    async def receive(self, text_data):
-        data = json.loads(text_data)
-        message_content = data['message']
-        username = self.user.username
-        avatar = self.user.avatar.url if self.user.avatar else '/media/avatars/default.png'
+    async def receive(self, text_data=None, bytes_data=None):
+        # Taille en octets vérifiée avant tout décodage ; un caractère fait
+        # au plus 4 octets en UTF-8, le texte n'est encodé que s'il peut dépasser
+        limit = self.limits['MAX_FRAME_BYTES']
+        if text_data is not None:
+            size = len(text_data)
+            if size * 4 > limit:
+                size = len(text_data.encode())
+        else:
+            size = len(bytes_data)
+        if size > limit:
+            rejected_frames.inc()
+            await self.close(code=1009)  # Message Too Big
+            return
+        try:
+            data = self.protocol.decode(text_data, bytes_data)
+        except (TypeError, ValueError):
+            data = None
+        if not isinstance(data, dict):
+            await self.send_frame({'type': 'error', 'error': 'invalid_frame'})
+            return
         
-        # Sauvegarder le message dans la base de données
-        message = await self.save_message(message_content)
-        message_id = message.id
-        timestamp = message.timestamp.isoformat()
+        # Commandes du client (autres que l'envoi d'un message)
+        if data.get('type') == 'load_before':
+            await self.load_before(data.get('cursor'), data.get('limit'))
+            return
+        if data.get('type') == 'receipt':
+            self.record_receipt(data.get('status'), data.get('up_to'))
+            return
         
-        # COMPTEUR d'utilisateurs dans la salle (pour statut)
-        users_in_room = 0
-        if self.room_name in self.active_connections:
-            users_in_room = len(self.active_connections[self.room_name])
+        message_content = data.get('message', '')
+        attachment = None
+        if data.get('attachment') is not None:
+            # Pièce jointe déjà envoyée en HTTP (voir chat/attachments.py)
+            attachment = await self.get_attachment(data['attachment'])
+            if attachment is None:
+                await self.send_frame({'type': 'error', 'error': 'invalid_attachment'})
+                return
+        if not isinstance(message_content, str) or not (message_content.strip() or attachment):
+            await self.send_frame({'type': 'error', 'error': 'invalid_frame'})
+            return
+        if len(message_content) > self.limits['MAX_MESSAGE_LENGTH']:
+            await self.send_frame({'type': 'error', 'error': 'message_too_long'})
+            return
+        username = self.user.username
+        avatar = self.profile['avatar']
         
-        # NE PAS envoyer le message à l'expéditeur ici
-        # Le client affichera le message de manière optimiste
+        # Identifiant provisoire : l'id en base n'est connu qu'après l'écriture.
+        # Toujours attribué ici (diffusé à toute la salle, il ne doit pas pouvoir
+        # désigner le message d'un autre) ; le client_id éventuel n'est renvoyé
+        # qu'à l'expéditeur
+        cid = uuid.uuid4().hex
+        if data.get('client_id') is not None:
+            self.client_ids[cid] = str(data['client_id'])[:64]
+        timestamp = timezone.now()
         
         # Envoyer le message à TOUS les utilisateurs (y compris l'expéditeur)
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'chat_message_all',
-                'id': message_id,
-                'message': message_content,
-                'username': username,
-                'avatar': avatar,
-                'timestamp': timestamp,
-                'sender_channel': self.channel_name,
-            }
-        )
+        # sans attendre la base de données ; la trame est encodée une seule fois ici
+        event = {
+            'type': 'chat_message_all',
+            'id': None,
+            'cid': cid,
+            'message': message_content,
+            'username': username,
+            'avatar': avatar,
+            'timestamp': timestamp.isoformat(),
+            'sender_channel': self.channel_name,
+        }
+        if attachment is not None:
+            event['attachment'] = attachment
+        event['text'] = encode_chat_message(event)
+        await room_group_send(self.room_name, event)
         
-        # Mettre à jour le statut après délai
-        if users_in_room > 1:
-            asyncio.create_task(self.update_message_status_delayed(message_id, username, 1))
+        # Écriture différée, groupée avec les autres messages du worker
+        self.ingest.submit(PendingMessage(
+            room_id=self.room_id,
+            room_name=self.room_name,
+            user_id=self.user.id,
+            content=message_content,
+            timestamp=timestamp,
+            cid=cid,
+            attachment_id=attachment['id'] if attachment else None,
+        ))
+        await self.touch_last_seen()
 
-    async def update_message_status_delayed(self, message_id, username, delay):
-        """Met à jour le statut après un délai"""
-        await asyncio.sleep(delay)
-        
-        # Envoyer la mise à jour du statut à l'expéditeur
-        if self.room_name in self.active_connections and username in self.active_connections[self.room_name]:
-            sender_channel = self.active_connections[self.room_name][username]['channel_name']
-            await self.channel_layer.send(
-                sender_channel,
-                {
-                    'type': 'message_status_update',
-                    'message_id': message_id,
-                    'status': 'delivered',
-                }
-            )
-        
-        # Après 2 secondes supplémentaires, marquer comme 'seen' (simulation Instagram)
-        await asyncio.sleep(2)
-        if self.room_name in self.active_connections and username in self.active_connections[self.room_name]:
-            sender_channel = self.active_connections[self.room_name][username]['channel_name']
-            await self.channel_layer.send(
-                sender_channel,
-                {
-                    'type': 'message_status_update',
-                    'message_id': message_id,
-                    'status': 'seen',
-                }
+    async def send_frame(self, frame, memo_key=None, text=None, ephemeral=False, last_id=None):
+        """Envoie une trame dans le protocole négocié (texte ou binaire)"""
+        payloads = self.protocol.encode(frame, memo_key, text)
+        for index, payload in enumerate(payloads):
+            # Définitions d'utilisateurs (trames "us") jamais abandonnées : la
+            # session les considère déjà comme connues du client
+            last = index == len(payloads) - 1
+            options = {'ephemeral': ephemeral and last, 'last_id': last_id if last else None}
+            if isinstance(payload, bytes):
+                await self.send(bytes_data=payload, **options)
+            else:
+                await self.send(text_data=payload, **options)
+
+    async def send(self, text_data=None, bytes_data=None, close=False, ephemeral=False, last_id=None):
+        """
+        Dépose la trame dans la file d'envoi. ``ephemeral`` : trame abandonnable
+        en cas de retard ; ``last_id`` : plus grand id de message qu'elle contient.
+        """
+        if self.outbound is None:
+            await super().send(text_data=text_data, bytes_data=bytes_data, close=close)
+            return
+        payload = text_data if text_data is not None else bytes_data
+        if not self.outbound.put(payload, ephemeral, last_id):
+            await self.slow_consumer()
+        elif close:
+            await self.close(close)
+
+    async def write_frame(self, payload):
+        """Écriture réelle d'une trame, appelée par la file d'envoi"""
+        if isinstance(payload, bytes):
+            await super().send(bytes_data=payload)
+        else:
+            await super().send(text_data=payload)
+
+    async def close(self, code=None, reason=None):
+        # Fermeture volontaire : laisser partir les trames déjà en file
+        if self.outbound is not None and not self.outbound.closed:
+            await self.outbound.drain()
+            self.outbound.close()
+        await super().close(code, reason)
+
+    async def slow_consumer(self):
+        """Client trop lent : fermer avec le dernier id reçu, pour reprendre ensuite"""
+        if self.outbound.closed:
+            return
+        slow_consumers.inc()
+        resume_after = self.outbound.last_written_id
+        self.outbound.close()
+        # Dernière trame écrite directement, sans attendre derrière la file
+        frames = self.protocol.encode({'type': 'slow_consumer', 'resume_after': resume_after})
+        try:
+            await asyncio.wait_for(self.write_frame(frames[-1]), timeout=1)
+        except Exception:
+            pass
+        await self.close(code=4008)
+
+    async def drain(self, retry_after):
+        """Arrêt du worker : indiquer au client quand se reconnecter, puis fermer"""
+        if self.outbound is None or self.outbound.closed:
+            return
+        await self.send_frame({
+            'type': 'reconnect',
+            'retry_after': round(retry_after, 1),
+            'reason': 'restart',
+        })
+        await self.close(code=SERVICE_RESTART)
+
+    async def touch_last_seen(self):
+        """Activité WebSocket : même tampon last_seen que le middleware HTTP"""
+        buffer = get_last_seen_buffer()
+        now = timezone.now()
+        if buffer.touch(self.user.pk, self.user.last_seen, now):
+            self.user.last_seen = now
+        # Écriture par la tâche de fond du worker (démarrée ici sans lifespan)
+        start_periodic_flush()
+
+    def record_receipt(self, status, up_to):
+        """Accusé du client : tous les messages jusqu'à up_to sont livrés / vus"""
+        if status not in RECEIPT_STATUSES:
+            return
+        try:
+            up_to = int(up_to)
+        except (TypeError, ValueError):
+            return
+        if up_to > 0:
+            get_receipt_aggregator().record(
+                self.room_id, self.room_name, self.user.id, status, up_to
             )
+
+    async def send_resume(self, cached):
+        """Trame ``resume`` (messages après resume_after) ou ``resync_required``"""
+        if not cached or cached[0]['id'] <= self.resume_after:
+            # Le cache du worker couvre tout l'écart : aucune requête
+            gap = [m for m in cached if m['id'] > self.resume_after]
+        else:
+            gap = await self.get_messages_after(self.resume_after, RESUME_MAX_GAP + 1)
+        if len(gap) > RESUME_MAX_GAP:
+            await self.send_frame({'type': 'resync_required'})
+            return
+        await self.send_frame({
+            'type': 'resume',
+            'messages': [wire_message(message) for message in gap],
+        }, last_id=gap[-1]['id'] if gap else None)
+
+    async def load_before(self, cursor, limit):
+        """Renvoie la page d'historique antérieure au curseur"""
+        try:
+            limit = max(1, min(int(limit or HISTORY_PAGE_SIZE), HISTORY_PAGE_MAX))
+            messages, next_cursor = await self.get_history_page(cursor, limit)
+        except (TypeError, ValueError):
+            await self.send_frame({
+                'type': 'error',
+                'error': 'invalid_cursor',
+            })
+            return
+        await self.send_frame({
+            'type': 'history_page',
+            'messages': [wire_message(message) for message in messages],
+            'next_cursor': next_cursor,
+        })
+
+    async def dispatch(self, message):
+        started = time.perf_counter()
+        try:
+            await super().dispatch(message)
+        finally:
+            handler_seconds.observe(time.perf_counter() - started, message['type'])
+
+    async def relay_event(self, event):
+        """Événement distribué par le relais du worker (même handlers que le groupe direct)"""
+        handler = getattr(self, event['type'], None)
+        if handler is not None:
+            started = time.perf_counter()
+            try:
+                await handler(event)
+            finally:
+                handler_seconds.observe(time.perf_counter() - started, event['type'])
+
     async def chat_message_all(self, event):
         """Envoie le message à TOUS les utilisateurs"""
-        await self.send(text_data=json.dumps({
-            'type': 'chat_message',
-            'id': event['id'],
-            'message': event['message'],
+        # Tenir le cache à jour, y compris pour les messages écrits par un autre worker
+        pending = {
+            'content': event['message'],
             'username': event['username'],
             'avatar': event['avatar'],
-            'timestamp': event['timestamp'],
-            'is_current_user': event['sender_channel'] == self.channel_name,
-        }))
+        }
+        if event.get('attachment'):
+            pending['attachment'] = event['attachment']
+        self.history.add_pending(self.room_name, event['cid'], pending)
+        is_current_user = event['sender_channel'] == self.channel_name
+        client_id = self.client_ids.pop(event['cid'], None) if is_current_user else None
+        if not self.protocol.is_json:
+            # Protocoles compacts : trame encodée une fois par worker,
+            # is_current_user est calculé par le client
+            if client_id is not None:
+                await self.send_frame({**chat_message_frame(event), 'client_id': client_id})
+                return
+            await self.send_frame(
+                chat_message_frame(event), memo_key=('chat_message', event['cid']),
+            )
+            return
+        # Trame pré-encodée par l'expéditeur (les événements d'anciens workers n'en ont pas)
+        text = event.get('text') or encode_chat_message(event)
+        await self.send(text_data=personalize_chat_message(text, is_current_user, client_id))
 
     async def chat_message_others(self, event):
         # Envoyer le message aux autres utilisateurs (sauf l'expéditeur)
         if event['sender_channel'] != self.channel_name:
-            await self.send(text_data=json.dumps({
+            await self.send_frame({
                 'type': 'chat_message',
                 'id': event['id'],
                 'message': event['message'],
                 'username': event['username'],
                 'avatar': event['avatar'],
                 'timestamp': event['timestamp'],
-            }))
+            })
 
-    async def message_status_update(self, event):
-        """Met à jour le statut d'un message (sent → delivered → seen)"""
-        await self.send(text_data=json.dumps({
-            'type': 'message_status_update',
-            'message_id': event['message_id'],
-            'status': event['status'],
-        }))
+    async def messages_committed(self, event):
+        """Lot écrit en base : id définitifs, et accusé durable pour l'expéditeur"""
+        self.history.commit(self.room_name, event['messages'])
+        await self.send_frame(
+            {'type': 'messages_committed', 'messages': event['messages']},
+            memo_key=('messages_committed', event['messages'][0]['cid']),
+            text=event.get('text'),
+            last_id=max(m['id'] for m in event['messages']),
+        )
+
+    async def messages_failed(self, event):
+        """Lot non écrit : les clients retirent ou signalent ces messages"""
+        cids = [m['cid'] for m in event['messages']]
+        self.history.discard_pending(self.room_name, cids)
+        await self.send_frame({
+            'type': 'messages_failed',
+            'cids': cids,
+        })
+
+    async def message_status_batch(self, event):
+        """Statuts regroupés : tous mes messages jusqu'à up_to sont livrés / vus"""
+        # Éphémère : la trame suivante porte un id au moins aussi grand
+        await self.send_frame({
+            'type': 'message_status_batch',
+            'updates': event['updates'],
+        }, ephemeral=True)
 
     async def chat_message(self, event):
         # Cette méthode n'est plus utilisée directement
         pass
 
-    async def user_joined(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'user_joined',
-            'username': event['username'],
-            'avatar': event['avatar'],
-        }))
-        await self.send_online_users()
+    async def room_deleted(self, event):
+        """La salle a été supprimée : vider le cache du worker et fermer"""
+        self.history.invalidate(self.room_name)
+        await self.send_frame({
+            'type': 'room_deleted',
+        })
+        await self.close()
 
-    async def user_left(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'user_left',
-            'username': event['username'],
-        }))
-        await self.send_online_users()
+    async def presence_delta(self, event):
+        """Arrivées/départs regroupés, avec parfois la liste complète"""
+        if self.outbound.shed and len(self.outbound) < self.outbound.max_frames // 2:
+            # Des deltas ont été abandonnés : repartir d'une liste complète
+            self.outbound.shed = False
+            await self.send_online_users()
+            return
+        await self.send_frame({
+            'type': 'presence_delta',
+            'joined': event['joined'],
+            'left': event['left'],
+            'snapshot': event['snapshot'],
+        }, memo_key=('presence_delta', event['key']) if 'key' in event else None,
+            text=event.get('text'), ephemeral=True)
 
     async def send_online_users(self):
-        """Envoyer la liste des utilisateurs en ligne dans la salle"""
-        if self.room_name in self.active_connections:
-            online_users = list(self.active_connections[self.room_name].keys())
-            users_with_avatars = await self.get_users_with_avatars(online_users)
-            
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'online_users_list',
-                    'online_users': users_with_avatars,
-                }
-            )
-
-    async def online_users_list(self, event):
-        await self.send(text_data=json.dumps({
+        """Envoyer la liste des utilisateurs en ligne à cette connexion"""
+        members = await self.presence.members(self.room_name)
+        await self.send_frame({
             'type': 'online_users',
-            'online_users': event['online_users'],
-        }))
+            'online_users': member_list(members),
+        })
 
     @database_sync_to_async
-    def save_message(self, content):
-        room = ChatRoom.objects.get(name=self.room_name)
-        message = Message.objects.create(
-            room=room,
-            user=self.user,
-            content=content
-        )
-        return message
+    def get_room_id(self):
+        return ChatRoom.objects.filter(name=self.room_name).values_list('id', flat=True).first()
+
+    @database_sync_to_async
+    def get_attachment(self, attachment_id):
+        try:
+            return find_sendable(self.user, self.room_id, uuid.UUID(str(attachment_id)))
+        except ValueError:
+            return None
 
     @database_sync_to_async
     def get_last_messages(self):
-        room = ChatRoom.objects.get(name=self.room_name)
-        messages = Message.objects.filter(room=room).select_related('user').order_by('-timestamp')[:50]
-        
-        return [
-            {
-                'id': msg.id,
-                'content': msg.content,
-                'username': msg.user.username,
-                'avatar': msg.user.avatar.url if msg.user.avatar else '/media/avatars/default.png',
-                'timestamp': msg.timestamp.isoformat()
-            }
-            for msg in reversed(messages)  # Plus ancien en premier
-        ]
+        return fetch_latest(self.room_id, self.history.messages_per_room)  # Plus ancien en premier
+
+    @database_sync_to_async
+    def get_messages_after(self, after_id, limit):
+        return fetch_after(self.room_id, after_id, limit)
 
     @database_sync_to_async
-    def get_users_with_avatars(self, usernames):
-        users = CustomUser.objects.filter(username__in=usernames)
-        return [
-            {
-                'username': user.username,
-                'avatar': user.avatar.url if user.avatar else '/media/avatars/default.png',
-                'bio': user.bio[:50] if user.bio else ''
-            }
-            for user in users
-        ]
\ No newline at end of file
+    def get_history_page(self, cursor, limit):
+        return fetch_page(self.room_id, before=cursor, limit=limit)
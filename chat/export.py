@@ -0,0 +1,159 @@
+# chat/export.py
+"""
+Export intégral de l'historique d'une salle (conformité), en flux.
+
+Les messages archivés (voir chat/archive.py) sont relus segment par segment,
+puis ceux de la table par pages de CHUNK_SIZE lignes, chacune reprenant
+après la clé (timestamp, id) de la précédente (index (room, timestamp, id)).
+Aucun curseur ne reste ouvert entre deux pages : sous ASGI, la connexion du
+thread des vues peut être fermée entre deux morceaux (close_old_connections
+d'une autre requête ou d'un consumer) sans interrompre l'export. Le nom de
+l'auteur vient de la même requête (jointure), jamais d'une requête par message.
+Les lignes sont regroupées en morceaux de CHUNK_BYTES, éventuellement
+compressés en gzip au fil de l'eau : la mémoire reste la même quelle que
+soit la taille de la salle.
+
+Formats : JSONL (un objet par ligne) ou CSV (id, timestamp, username, content).
+"""
+import csv
+import json
+import zlib
+from datetime import datetime, time
+
+from asgiref.sync import sync_to_async
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from .archive import from_micros, get_archive
+
+FORMATS = {
+    'jsonl': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+FIELDS = ('id', 'timestamp', 'username', 'content')
+
+# Lignes lues par aller-retour avec la base
+CHUNK_SIZE = 2000
+# Taille des morceaux envoyés au client (avant compression)
+CHUNK_BYTES = 64 * 1024
+
+
+def parse_bound(value):
+    """Date (minuit) ou date et heure ISO 8601 ; heure locale si sans fuseau"""
+    if not value:
+        return None
+    moment = parse_datetime(value)
+    if moment is None:
+        day = parse_date(value)
+        if day is None:
+            raise ValueError(f'Date invalide : {value}')
+        moment = datetime.combine(day, time.min)
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
+
+
+def iter_messages(room, since=None, until=None, chunk_size=None):
+    """Messages de la salle dans l'ordre (archives puis table), ``until`` exclu"""
+    from .models import Message
+
+    chunk_size = chunk_size or CHUNK_SIZE
+    archive = get_archive()
+    yield from archive.iter_messages(room.id, since, until)
+
+    queryset = Message.objects.filter(room=room)
+    if since is not None:
+        queryset = queryset.filter(timestamp__gte=since)
+    if until is not None:
+        queryset = queryset.filter(timestamp__lt=until)
+    rows = queryset.order_by('timestamp', 'id').values_list('id', 'timestamp', 'user__username', 'content')
+    # Un archivage interrompu peut laisser en table des messages déjà archivés :
+    # la lecture commence après le dernier message archivé
+    last_key = archive.last_archived_key(room.id)
+    after = (from_micros(last_key[0]), last_key[1]) if last_key is not None else None
+    while True:
+        page = rows
+        if after is not None:
+            page = rows.filter(Q(timestamp__gt=after[0]) | Q(timestamp=after[0], id__gt=after[1]))
+        page = list(page[:chunk_size])
+        for message_id, timestamp, username, content in page:
+            yield {
+                'id': message_id,
+                'timestamp': timestamp.isoformat(),
+                'username': username,
+                'content': content,
+            }
+        if len(page) < chunk_size:
+            return
+        after = (page[-1][1], page[-1][0])
+
+
+class Echo:
+    """Pseudo-fichier pour csv.writer : rend la ligne au lieu de l'écrire"""
+
+    def write(self, value):
+        return value
+
+
+def encode_jsonl(messages):
+    for message in messages:
+        yield json.dumps(message, ensure_ascii=False) + '\n'
+
+
+def encode_csv(messages):
+    writer = csv.writer(Echo())
+    yield writer.writerow(FIELDS)
+    for message in messages:
+        yield writer.writerow([message[field] for field in FIELDS])
+
+
+ENCODERS = {'jsonl': encode_jsonl, 'csv': encode_csv}
+
+
+def buffered(lines, size=None):
+    """Regroupe les lignes en morceaux d'environ ``size`` octets (CHUNK_BYTES)"""
+    size = size or CHUNK_BYTES
+    parts, length = [], 0
+    for line in lines:
+        data = line.encode()
+        parts.append(data)
+        length += len(data)
+        if length >= size:
+            yield b''.join(parts)
+            parts, length = [], 0
+    if parts:
+        yield b''.join(parts)
+
+
+def gzipped(chunks):
+    compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)  # en-tête gzip
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def stream_export(room, export_format='jsonl', since=None, until=None, compress=False):
+    """Morceaux (bytes) de l'export ; ValueError si le format est inconnu"""
+    if export_format not in ENCODERS:
+        raise ValueError(f"Format d'export inconnu : {export_format}")
+    chunks = buffered(ENCODERS[export_format](iter_messages(room, since, until)))
+    return gzipped(chunks) if compress else chunks
+
+
+async def as_async(chunks):
+    """
+    Version asynchrone pour ASGI : Django consommerait sinon tout l'itérateur
+    synchrone en mémoire avant d'envoyer la réponse. Chaque morceau est lu
+    dans le thread des vues ; iter_messages ne garde aucun curseur ouvert
+    d'un morceau à l'autre.
+    """
+    sentinel = object()
+    read = sync_to_async(next)
+    try:
+        while (chunk := await read(chunks, sentinel)) is not sentinel:
+            yield chunk
+    finally:
+        await sync_to_async(chunks.close)()
@@ -0,0 +1,395 @@
+# chat/history.py
+"""
+Cache des derniers messages de chaque salle.
+
+Chaque salle garde un tampon circulaire de messages déjà sérialisés, pour
+que les reconnexions (après un déploiement par exemple) ne refassent pas
+la même requête SQL des milliers de fois. Les salles froides sont évincées
+en LRU dès que le plafond de salles ou de mémoire est atteint.
+
+Le cache est propre au processus : il n'est considéré comme à jour que pour
+les salles qui ont au moins une connexion locale, puisque c'est par elles
+que le worker reçoit les messages écrits par les autres workers.
+"""
+import asyncio
+import base64
+import binascii
+import bisect
+import json
+import threading
+from collections import OrderedDict, deque
+from datetime import datetime
+
+from django.conf import settings
+from django.db.models import Q
+
+from accounts.profiles import DEFAULT_AVATAR_URL, get_profile_cache
+
+from .archive import get_archive
+from .attachments import describe
+
+DEFAULT_HISTORY_CACHE = {
+    'MESSAGES_PER_ROOM': 50,
+    'MAX_ROOMS': 500,
+    'MAX_BYTES': 8 * 1024 * 1024,
+}
+
+# Surcoût approximatif d'un dict de message en mémoire
+MESSAGE_OVERHEAD = 400
+
+# Messages diffusés mais pas encore écrits en base, par salle
+MAX_UNCOMMITTED = 1000
+
+
+def estimate_size(message):
+    return MESSAGE_OVERHEAD + sum(
+        len(value) for value in message.values() if isinstance(value, str)
+    )
+
+
+# Colonnes lues pour sérialiser un message (l'avatar vient du cache de profils)
+MESSAGE_FIELDS = (
+    'id', 'content', 'timestamp', 'user__username',
+    'attachment_id', 'attachment__filename', 'attachment__size', 'attachment__content_type',
+)
+
+
+def serialize_rows(rows):
+    """
+    Forme sérialisée de messages lus avec ``values(*MESSAGE_FIELDS)``, telle
+    qu'envoyée aux clients. Les avatars sont résolus en un seul appel au
+    cache de profils.
+    """
+    rows = list(rows)
+    profiles = get_profile_cache().get_many({row['user__username'] for row in rows})
+    messages = []
+    for row in rows:
+        message = {
+            'id': row['id'],
+            'content': row['content'],
+            'username': row['user__username'],
+            'avatar': profiles.get(row['user__username'], {}).get('avatar', DEFAULT_AVATAR_URL),
+            'timestamp': row['timestamp'].isoformat(),
+        }
+        if row['attachment_id'] is not None:
+            message['attachment'] = describe(
+                row['attachment_id'], row['attachment__filename'],
+                row['attachment__size'], row['attachment__content_type'],
+            )
+        messages.append(message)
+    return messages
+
+
+def wire_message(message):
+    """Message du cache au format attendu par les clients (clé ``message``)"""
+    wire = {
+        'id': message['id'],
+        'message': message['content'],
+        'username': message['username'],
+        'avatar': message['avatar'],
+        'timestamp': message['timestamp'],
+    }
+    if 'attachment' in message:
+        wire['attachment'] = message['attachment']
+    return wire
+
+
+def encode_cursor(message):
+    """Curseur opaque (timestamp, id) pointant juste avant ``message``"""
+    raw = f"{message['timestamp']}|{message['id']}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Inverse de encode_cursor ; lève ValueError si le curseur est invalide"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        timestamp, message_id = raw.rsplit('|', 1)
+        return datetime.fromisoformat(timestamp), int(message_id)
+    except (binascii.Error, UnicodeError, ValueError) as exc:
+        raise ValueError(f'Curseur invalide : {cursor!r}') from exc
+
+
+def fetch_page(room_id, before=None, limit=50):
+    """
+    Page de messages strictement antérieurs au curseur ``before``.
+
+    Pagination par clé (keyset) sur l'index (room, timestamp, id) : le coût
+    ne dépend pas de la profondeur de la page. Au-delà de la table, la page
+    est complétée depuis les archives (chat/archive.py). Retourne les messages du plus
+    ancien au plus récent et le curseur de la page suivante (ou None).
+    """
+    from .models import Message
+
+    queryset = Message.objects.filter(room_id=room_id)
+    position = None
+    if before is not None:
+        position = decode_cursor(before)
+        timestamp, message_id = position
+        queryset = queryset.filter(
+            Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=message_id)
+        )
+    rows = list(
+        queryset.order_by('-timestamp', '-id').values(*MESSAGE_FIELDS)[:limit + 1]
+    )
+    has_more = len(rows) > limit
+    messages = serialize_rows(reversed(rows[:limit]))
+    if not has_more:
+        # Table épuisée : la suite vient des segments d'archive
+        if rows:
+            position = (rows[-1]['timestamp'], rows[-1]['id'])
+        archived, has_more = get_archive().page_before(room_id, position, limit - len(rows))
+        messages = archived + messages
+    next_cursor = encode_cursor(messages[0]) if has_more else None
+    return messages, next_cursor
+
+
+def fetch_latest(room_id, limit):
+    """
+    Derniers messages de la salle pour remplir le cache, du plus ancien au
+    plus récent dans l'ordre des id (celui de HistoryCache.append) : un
+    horodatage en désaccord avec l'id (horloges, écriture groupée) ne
+    désordonne pas le tampon. Complété depuis les archives si besoin.
+    """
+    from .models import Message
+
+    rows = list(
+        Message.objects.filter(room_id=room_id)
+        .order_by('-id')
+        .values(*MESSAGE_FIELDS)[:limit]
+    )
+    messages = serialize_rows(reversed(rows))
+    if len(rows) < limit:
+        position = (rows[-1]['timestamp'], rows[-1]['id']) if rows else None
+        archived, _ = get_archive().page_before(room_id, position, limit - len(rows))
+        messages = archived + messages
+    return messages
+
+
+def fetch_after(room_id, after_id, limit):
+    """
+    Messages d'id strictement supérieur à ``after_id`` (reprise après
+    reconnexion), du plus ancien au plus récent, via l'index (room, id).
+    """
+    from .models import Message
+
+    rows = (
+        Message.objects.filter(room_id=room_id, id__gt=after_id)
+        .order_by('id')
+        .values(*MESSAGE_FIELDS)[:limit]
+    )
+    return serialize_rows(rows)
+
+
+def history_batch_frame(messages):
+    """Trame unique ``history_batch`` contenant tout l'historique"""
+    return {
+        'type': 'history_batch',
+        'next_cursor': encode_cursor(messages[0]) if messages else None,
+        'messages': [wire_message(message) for message in messages],
+    }
+
+
+def encode_history_batch(messages):
+    return json.dumps(history_batch_frame(messages))
+
+
+class HistoryCache:
+    """Tampons circulaires par salle avec éviction LRU"""
+
+    def __init__(self, messages_per_room=50, max_rooms=500, max_bytes=8 * 1024 * 1024):
+        self.messages_per_room = messages_per_room
+        self.max_rooms = max_rooms
+        self.max_bytes = max_bytes
+        self.rooms = OrderedDict()   # room_name -> deque de messages
+        self.sizes = {}              # room_name -> taille estimée
+        self.total_bytes = 0
+        self.local_consumers = {}    # room_name -> nb de connexions locales
+        self._loading = {}           # room_name -> Future du chargement en cours
+        self._pending = {}           # room_name -> messages arrivés pendant le chargement
+        self.frames = {}             # room_name -> trame history_batch déjà encodée
+        self.uncommitted = {}        # room_name -> OrderedDict(cid -> message sans id)
+        # Les vues synchrones (suppression de salle) invalident depuis un autre thread
+        self._lock = threading.RLock()
+
+    def get(self, room_name):
+        """Copie des messages en cache, ou None si la salle n'est pas chargée"""
+        with self._lock:
+            messages = self.rooms.get(room_name)
+            if messages is None:
+                return None
+            self.rooms.move_to_end(room_name)
+            return list(messages)
+
+    def get_batch_frame(self, room_name, messages):
+        """
+        Trame ``history_batch`` de la salle, encodée une seule fois tant que
+        l'historique en cache ne change pas.
+        """
+        with self._lock:
+            frame = self.frames.get(room_name)
+            if frame is not None:
+                return frame
+            frame = encode_history_batch(messages)
+            if room_name in self.rooms:
+                self.frames[room_name] = frame
+            return frame
+
+    def fill(self, room_name, messages):
+        with self._lock:
+            self._drop(room_name)
+            pending = self._pending.pop(room_name, [])
+            last_id = messages[-1]['id'] if messages else 0
+            buffer = deque(maxlen=self.messages_per_room)
+            buffer.extend(messages)
+            buffer.extend(m for m in pending if m['id'] > last_id)
+            self.rooms[room_name] = buffer
+            self.sizes[room_name] = sum(estimate_size(m) for m in buffer)
+            self.total_bytes += self.sizes[room_name]
+            self._evict()
+
+    def append(self, room_name, message):
+        """Ajoute un message écrit en base, à sa place dans l'ordre des id"""
+        with self._lock:
+            if room_name in self._pending:
+                self._pending[room_name].append(message)
+            buffer = self.rooms.get(room_name)
+            if buffer is None:
+                return
+            position = len(buffer)
+            if buffer and buffer[-1]['id'] >= message['id']:
+                # Lot validé par un autre worker qui arrive en retard
+                ids = [m['id'] for m in buffer]
+                position = bisect.bisect_left(ids, message['id'])
+                if position < len(ids) and ids[position] == message['id']:
+                    return  # déjà reçu
+                if position == 0 and len(buffer) == buffer.maxlen:
+                    return  # plus ancien que tout le tampon
+            if len(buffer) == buffer.maxlen:
+                removed = estimate_size(buffer.popleft())
+                self.sizes[room_name] -= removed
+                self.total_bytes -= removed
+                position -= 1
+            buffer.insert(position, message)
+            self.frames.pop(room_name, None)
+            added = estimate_size(message)
+            self.sizes[room_name] += added
+            self.total_bytes += added
+            self._evict()
+
+    def add_pending(self, room_name, cid, message):
+        """Message diffusé, en attente de son id définitif"""
+        with self._lock:
+            if room_name not in self.rooms and room_name not in self._pending:
+                return
+            uncommitted = self.uncommitted.setdefault(room_name, OrderedDict())
+            uncommitted[cid] = message
+            while len(uncommitted) > MAX_UNCOMMITTED:
+                uncommitted.popitem(last=False)
+
+    def commit(self, room_name, committed):
+        """Passe les messages validés (cid -> id, timestamp) dans l'historique"""
+        with self._lock:
+            uncommitted = self.uncommitted.get(room_name)
+            if not uncommitted:
+                return
+            for entry in committed:
+                message = uncommitted.pop(entry['cid'], None)
+                if message is not None:
+                    self.append(room_name, {
+                        **message,
+                        'id': entry['id'],
+                        'timestamp': entry['timestamp'],
+                    })
+            if not uncommitted:
+                del self.uncommitted[room_name]
+
+    def discard_pending(self, room_name, cids):
+        with self._lock:
+            uncommitted = self.uncommitted.get(room_name, {})
+            for cid in cids:
+                uncommitted.pop(cid, None)
+
+    def invalidate(self, room_name):
+        with self._lock:
+            self._drop(room_name)
+            self._pending.pop(room_name, None)
+            self.uncommitted.pop(room_name, None)
+
+    def attach(self, room_name):
+        with self._lock:
+            self.local_consumers[room_name] = self.local_consumers.get(room_name, 0) + 1
+
+    def detach(self, room_name):
+        """Plus aucune connexion locale : le cache ne serait plus tenu à jour"""
+        with self._lock:
+            count = self.local_consumers.get(room_name, 0) - 1
+            if count > 0:
+                self.local_consumers[room_name] = count
+            else:
+                self.local_consumers.pop(room_name, None)
+                self.invalidate(room_name)
+
+    async def get_or_load(self, room_name, loader):
+        """
+        Retourne l'historique depuis le cache, sinon le charge via ``loader``.
+
+        Les connexions simultanées sur une salle froide attendent le même
+        chargement au lieu de lancer chacune leur requête.
+        """
+        messages = self.get(room_name)
+        if messages is not None:
+            return messages
+        loading = self._loading.get(room_name)
+        if loading is not None:
+            return list(await asyncio.shield(loading))
+        loading = asyncio.get_running_loop().create_future()
+        self._loading[room_name] = loading
+        with self._lock:
+            self._pending[room_name] = []
+        try:
+            messages = await loader()
+        except Exception as exc:
+            loading.set_exception(exc)
+            loading.exception()  # évite l'avertissement si personne n'attend
+            with self._lock:
+                self._pending.pop(room_name, None)
+            raise
+        else:
+            if room_name in self.local_consumers:
+                self.fill(room_name, messages)
+            else:
+                with self._lock:
+                    self._pending.pop(room_name, None)
+            loading.set_result(messages)
+            return list(messages)
+        finally:
+            self._loading.pop(room_name, None)
+
+    def _drop(self, room_name):
+        self.frames.pop(room_name, None)
+        if self.rooms.pop(room_name, None) is not None:
+            self.total_bytes -= self.sizes.pop(room_name)
+
+    def _evict(self):
+        while self.rooms and (
+            len(self.rooms) > self.max_rooms or self.total_bytes > self.max_bytes
+        ):
+            room_name = next(iter(self.rooms))
+            self._drop(room_name)
+
+
+_cache = None
+
+
+def get_history_cache():
+    """Instance unique (par processus) du cache d'historique"""
+    global _cache
+    if _cache is None:
+        config = {**DEFAULT_HISTORY_CACHE, **getattr(settings, 'CHAT_HISTORY_CACHE', {})}
+        _cache = HistoryCache(
+            messages_per_room=config['MESSAGES_PER_ROOM'],
+            max_rooms=config['MAX_ROOMS'],
+            max_bytes=config['MAX_BYTES'],
+        )
+    return _cache
@@ -0,0 +1,187 @@
+# chat/ingest.py
+"""
+Écriture différée et groupée des messages entrants.
+
+``receive()`` diffuse le message immédiatement puis le dépose dans la file
+du worker. Une tâche de fond regroupe les messages en ``bulk_create`` (dès
+que BATCH_SIZE messages attendent, ou après FLUSH_INTERVAL secondes) et,
+une fois la transaction validée, envoie à chaque salle concernée un
+événement ``messages_committed`` qui sert d'accusé de réception durable.
+"""
+import asyncio
+import json
+import logging
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional
+
+from django.conf import settings
+from collections import Counter
+
+from django.db import connection, transaction
+from django.db.models import Case, Count, F, OuterRef, Subquery, Value, When
+from django.db.models.functions import Coalesce
+
+from . import metrics
+from .instrumentation import database_sync_to_async
+from .models import Message, RoomReadState
+from .relay import room_group_send
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_INGEST = {
+    'BATCH_SIZE': 200,
+    'FLUSH_INTERVAL': 0.005,  # secondes
+}
+
+queue_depth = metrics.gauge('chat_ingest_queue_depth', "Messages en attente d'écriture")
+batches_written = metrics.counter('chat_ingest_batches_total', 'Lots écrits en base')
+messages_written = metrics.counter('chat_ingest_messages_total', 'Messages écrits en base')
+messages_failed = metrics.counter('chat_ingest_failed_total', "Messages perdus sur erreur d'écriture")
+
+
+@dataclass
+class PendingMessage:
+    room_id: int
+    room_name: str
+    user_id: int
+    content: str
+    timestamp: datetime
+    cid: str  # identifiant provisoire, connu des clients avant l'écriture
+    attachment_id: Optional[str] = None  # pièce jointe déjà envoyée
+
+
+class MessageIngestQueue:
+    """File d'écriture propre au worker"""
+
+    def __init__(self, batch_size=200, flush_interval=0.005):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self._full = None
+        self._task = None
+
+    def submit(self, pending):
+        """Dépose un message ; ne bloque jamais la boucle d'événements"""
+        self.buffer.append(pending)
+        queue_depth.set(len(self.buffer))
+        if self._task is None or self._task.done():
+            self._full = asyncio.Event()
+            self._task = asyncio.ensure_future(self._run())
+        if len(self.buffer) >= self.batch_size:
+            self._full.set()
+
+    async def _run(self):
+        while self.buffer:
+            if len(self.buffer) < self.batch_size:
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            self._full.clear()
+            batch = self.buffer[:self.batch_size]
+            self.buffer = self.buffer[self.batch_size:]
+            queue_depth.set(len(self.buffer))
+            await self._flush(batch)
+
+    async def _flush(self, batch):
+        try:
+            committed = await self._write(batch)
+        except Exception:
+            logger.exception("Échec de l'écriture d'un lot de %d messages", len(batch))
+            messages_failed.inc(len(batch))
+            await self._notify(batch, 'messages_failed', lambda pending, message: {
+                'cid': pending.cid,
+            })
+            return
+        batches_written.inc()
+        messages_written.inc(len(batch))
+        await self._notify(batch, 'messages_committed', lambda pending, message: {
+            'cid': pending.cid,
+            'id': message.id,
+            'timestamp': message.timestamp.isoformat(),
+        }, committed)
+
+    async def _notify(self, batch, event_type, describe, committed=None):
+        """Un seul événement par salle et par lot"""
+        by_room = {}
+        for index, pending in enumerate(batch):
+            message = committed[index] if committed else None
+            by_room.setdefault(pending.room_name, []).append(describe(pending, message))
+        for room_name, messages in by_room.items():
+            event = {'type': event_type, 'messages': messages}
+            if event_type == 'messages_committed':
+                # Trame identique pour tous les membres : encodée une seule fois
+                event['text'] = json.dumps(event)
+            await room_group_send(room_name, event)
+
+    @database_sync_to_async
+    def _write(self, batch):
+        messages = [
+            Message(
+                room_id=pending.room_id,
+                user_id=pending.user_id,
+                content=pending.content,
+                timestamp=pending.timestamp,
+                attachment_id=pending.attachment_id,
+            )
+            for pending in batch
+        ]
+        with transaction.atomic():
+            if connection.features.can_return_rows_from_bulk_insert:
+                Message.objects.bulk_create(messages)
+            else:
+                # Pas de RETURNING (MySQL...) : il faut les id un par un
+                for message in messages:
+                    message.save(force_insert=True)
+            count_unread(batch, messages)
+        return messages
+
+
+def count_unread(batch, messages):
+    """
+    Non-lus des membres ayant une position de lecture : une requête par
+    salle du lot, chacun recevant les messages des autres. Une position déjà
+    au-delà du premier message du lot (accusé arrivé avant l'écriture) est
+    recomptée depuis la position plutôt qu'incrémentée.
+    """
+    by_room = {}
+    for pending, message in zip(batch, messages):
+        room = by_room.setdefault(pending.room_id, {'senders': Counter(), 'first_id': message.id})
+        room['senders'][pending.user_id] += 1
+        room['first_id'] = min(room['first_id'], message.id)
+    for room_id, room in by_room.items():
+        total = sum(room['senders'].values())
+        recount = (
+            Message.objects
+            .filter(room_id=room_id, id__gt=OuterRef('last_read_message_id'))
+            .exclude(user_id=OuterRef('user_id'))
+            .order_by()
+            .values('room')
+            .annotate(count=Count('id'))
+            .values('count')
+        )
+        RoomReadState.objects.filter(room_id=room_id).update(
+            unread_count=Case(
+                When(last_read_message_id__lt=room['first_id'], then=F('unread_count') + Case(
+                    *(When(user_id=user_id, then=Value(total - sent)) for user_id, sent in room['senders'].items()),
+                    default=Value(total),
+                )),
+                default=Coalesce(Subquery(recount), 0),
+            ),
+        )
+
+
+_queue = None
+
+
+def get_ingest_queue():
+    """File unique (par processus) configurée via settings.CHAT_INGEST"""
+    global _queue
+    if _queue is None:
+        config = {**DEFAULT_INGEST, **getattr(settings, 'CHAT_INGEST', {})}
+        _queue = MessageIngestQueue(
+            batch_size=config['BATCH_SIZE'],
+            flush_interval=config['FLUSH_INTERVAL'],
+        )
+    return _queue
@@ -0,0 +1,178 @@
+# chat/instrumentation.py
+"""
+Instrumentation de l'application ASGI : d'où vient la latence ?
+
+- ``MetricsMiddleware`` enveloppe le ProtocolTypeRouter (chat_project/asgi.py) :
+  connexions WebSocket, trames entrantes et sortantes, durée des requêtes
+  HTTP ; il démarre aussi la mesure du retard de la boucle d'événements.
+- ``database_sync_to_async`` remplace celui de channels : temps d'attente
+  d'un thread du pool, puis temps passé dans la fonction (base de données
+  comprise), par fonction.
+- ``handler_seconds`` est alimenté par ChatConsumer.dispatch et relay_event :
+  durée de chaque handler, par type d'événement.
+
+Chaque mesure coûte deux appels à perf_counter et un observe() : le tout
+reste actif en production. Les valeurs sont exposées par la vue
+``metrics_view`` (format Prometheus).
+"""
+import asyncio
+import contextvars
+import functools
+import time
+import weakref
+
+from channels.db import DatabaseSyncToAsync
+from django.conf import settings
+
+from . import metrics
+
+DEFAULT_METRICS = {
+    'TOKEN': '',                 # jeton Bearer accepté par /metrics (en plus du staff)
+    'LOOP_LAG_INTERVAL': 0.5,    # secondes entre deux mesures du retard de la boucle
+}
+
+ws_connects = metrics.counter('chat_ws_connects_total', 'Connexions WebSocket acceptées')
+ws_disconnects = metrics.counter('chat_ws_disconnects_total', 'Connexions WebSocket terminées')
+ws_open = metrics.gauge('chat_ws_open_connections', 'Connexions WebSocket ouvertes')
+ws_messages_in = metrics.counter('chat_ws_messages_in_total', 'Trames WebSocket reçues')
+ws_messages_out = metrics.counter('chat_ws_messages_out_total', 'Trames WebSocket envoyées')
+ws_payload_out = metrics.counter(
+    'chat_ws_payload_out_total', 'Taille des trames envoyées (octets, ou caractères pour le texte)',
+)
+http_seconds = metrics.histogram('chat_http_request_seconds', 'Durée des requêtes HTTP')
+handler_seconds = metrics.histogram(
+    'chat_consumer_handler_seconds', 'Durée des handlers du consumer', labelnames=('handler',),
+)
+pool_wait_seconds = metrics.histogram(
+    'chat_threadpool_wait_seconds', "Attente d'un thread pour database_sync_to_async",
+    labelnames=('function',),
+)
+db_seconds = metrics.histogram(
+    'chat_db_call_seconds', 'Durée des appels database_sync_to_async', labelnames=('function',),
+)
+loop_lag_seconds = metrics.histogram(
+    'chat_event_loop_lag_seconds', "Retard de réveil de la boucle d'événements",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+loop_lag = metrics.gauge('chat_event_loop_lag_last_seconds', 'Dernier retard mesuré de la boucle')
+
+
+def get_metrics_config():
+    return {**DEFAULT_METRICS, **getattr(settings, 'CHAT_METRICS', {})}
+
+
+_submitted_at = contextvars.ContextVar('chat_sync_submitted_at', default=None)
+
+
+class InstrumentedDatabaseSyncToAsync(DatabaseSyncToAsync):
+    """
+    DatabaseSyncToAsync mesuré. L'heure de soumission voyage dans le contexte
+    copié vers le thread : l'écart avec le début de l'exécution est l'attente
+    dans le pool (thread unique en mode thread_sensitive).
+    """
+
+    def __init__(self, func, *args, **kwargs):
+        name = getattr(func, '__qualname__', repr(func))
+
+        @functools.wraps(func)
+        def timed(*call_args, **call_kwargs):
+            started = time.perf_counter()
+            submitted = _submitted_at.get()
+            if submitted is not None:
+                pool_wait_seconds.observe(started - submitted, name)
+            try:
+                return func(*call_args, **call_kwargs)
+            finally:
+                db_seconds.observe(time.perf_counter() - started, name)
+
+        super().__init__(timed, *args, **kwargs)
+
+    async def __call__(self, *args, **kwargs):
+        token = _submitted_at.set(time.perf_counter())
+        try:
+            return await super().__call__(*args, **kwargs)
+        finally:
+            _submitted_at.reset(token)
+
+
+database_sync_to_async = InstrumentedDatabaseSyncToAsync
+
+
+class LoopLagMonitor:
+    """Dort ``interval`` secondes en boucle ; le dépassement est le retard de la boucle"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._loops = weakref.WeakSet()
+
+    def ensure_started(self):
+        loop = asyncio.get_running_loop()
+        if loop in self._loops:
+            return
+        self._loops.add(loop)
+        loop.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.perf_counter() - started - self.interval)
+            loop_lag_seconds.observe(lag)
+            loop_lag.set(round(lag, 6))
+
+
+_monitor = None
+
+
+def get_loop_monitor():
+    global _monitor
+    if _monitor is None:
+        _monitor = LoopLagMonitor(get_metrics_config()['LOOP_LAG_INTERVAL'])
+    return _monitor
+
+
+class MetricsMiddleware:
+    """Middleware ASGI placé autour du ProtocolTypeRouter"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        get_loop_monitor().ensure_started()
+        if scope['type'] == 'websocket':
+            return await self.websocket(scope, receive, send)
+        if scope['type'] == 'http':
+            started = time.perf_counter()
+            try:
+                return await self.app(scope, receive, send)
+            finally:
+                http_seconds.observe(time.perf_counter() - started)
+        return await self.app(scope, receive, send)
+
+    async def websocket(self, scope, receive, send):
+        accepted = False
+
+        async def counting_receive():
+            message = await receive()
+            if message['type'] == 'websocket.receive':
+                ws_messages_in.inc()
+            return message
+
+        async def counting_send(message):
+            nonlocal accepted
+            kind = message['type']
+            if kind == 'websocket.send':
+                ws_messages_out.inc()
+                ws_payload_out.inc(len(message.get('bytes') or message.get('text') or ''))
+            elif kind == 'websocket.accept' and not accepted:
+                accepted = True
+                ws_connects.inc()
+                ws_open.inc()
+            await send(message)
+
+        try:
+            return await self.app(scope, counting_receive, counting_send)
+        finally:
+            if accepted:
+                ws_disconnects.inc()
+                ws_open.dec()
@@ -0,0 +1,29 @@
+# chat/management/commands/archive_messages.py
+"""
+Déplace les messages plus anciens que l'horizon de leur salle vers les
+segments d'archive (voir chat/archive.py). À lancer régulièrement (cron) :
+
+    python manage.py archive_messages
+    python manage.py archive_messages --room general --dry-run
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.archive import ArchiveUnavailable, archive_expired_messages
+
+
+class Command(BaseCommand):
+    help = "Archive les messages plus anciens que la durée de conservation de leur salle"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--room', action='append', dest='rooms', help='salle (répétable)')
+        parser.add_argument('--dry-run', action='store_true', help='compter sans rien déplacer')
+
+    def handle(self, *args, **options):
+        try:
+            results = archive_expired_messages(room_names=options['rooms'], dry_run=options['dry_run'])
+        except ArchiveUnavailable as e:
+            raise CommandError(str(e))
+        verb = 'à archiver' if options['dry_run'] else 'archivés'
+        for room_name, count in sorted(results.items()):
+            self.stdout.write(f'{room_name} : {count} messages {verb}')
+        self.stdout.write(self.style.SUCCESS(f'Total : {sum(results.values())} messages {verb}'))
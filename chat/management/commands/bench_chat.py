@@ -0,0 +1,262 @@
+# chat/management/commands/bench_chat.py
+"""
+Banc de charge du chemin WebSocket (ChatConsumer complet, dans ce processus).
+
+Simule ``--rooms`` salles de ``--users`` utilisateurs connectés via
+channels.testing.WebsocketCommunicator ; chaque utilisateur envoie
+``--rate`` messages par seconde pendant ``--duration`` secondes. Le tout
+tourne sur une base de test jetable.
+
+Mesures (JSON sur la sortie standard ou dans ``--output``) :
+- latence de connexion (connect + premières trames) p50/p95/p99 ;
+- latence de diffusion de bout en bout, envoi -> réception par chaque membre ;
+- trames reçues et requêtes SQL par message envoyé ;
+- RSS du processus et temps CPU.
+
+    python manage.py bench_chat --rooms 4 --users 50 --rate 0.5 --duration 10
+    python manage.py bench_chat --layer redis --redis-url redis://localhost:6379/0
+
+Clients et serveur partagent la même boucle : les chiffres servent à
+comparer deux versions du code entre elles, pas à dimensionner la prod.
+"""
+import asyncio
+import json
+import math
+import resource
+import sys
+import time
+
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.test.utils import override_settings
+
+from chat import metrics
+from chat.protocol import JSON, make_codec
+
+
+class UserScopeMiddleware:
+    """Remplace AuthMiddlewareStack : l'utilisateur est injecté dans le scope"""
+
+    def __init__(self, app, user):
+        self.app, self.user = app, user
+
+    async def __call__(self, scope, receive, send):
+        return await self.app(dict(scope, user=self.user), receive, send)
+
+
+class QueryCounter:
+    """Compte les requêtes SQL de tous les threads (database_sync_to_async compris)"""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+    def install(self, sender=None, connection=None, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+
+def percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+
+    def pick(p):
+        return round(values[max(0, math.ceil(p / 100 * len(values)) - 1)], 3)
+
+    return {
+        'count': len(values),
+        'p50': pick(50),
+        'p95': pick(95),
+        'p99': pick(99),
+        'max': round(values[-1], 3),
+    }
+
+
+def rss_kb():
+    """RSS courante (Linux : /proc) et maximale du processus, en Ko"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak //= 1024
+    try:
+        with open('/proc/self/statm') as statm:
+            current = int(statm.read().split()[1]) * resource.getpagesize() // 1024
+    except OSError:
+        current = None
+    return {'current': current, 'peak': peak}
+
+
+class Client:
+    def __init__(self, communicator, codec, index):
+        self.communicator = communicator
+        self.codec = codec
+        self.index = index
+        self.frames = 0
+        self.reader = None
+
+    async def read(self, sent_at, latencies):
+        """Lit toutes les trames sans délai d'attente (receive_output annulerait l'application)"""
+        while True:
+            output = await self.communicator.output_queue.get()
+            if output['type'] != 'websocket.send':
+                return
+            self.frames += 1
+            frame = self.codec.loads(output.get('text'), output.get('bytes'))
+            if frame.get('type') == 'chat_message':
+                # Le cid est attribué par le serveur : repérage par le texte
+                started = sent_at.get(frame.get('message'))
+                if started is not None:
+                    latencies.append((time.perf_counter() - started) * 1000)
+
+
+class Command(BaseCommand):
+    help = "Banc de charge WebSocket : latences, trames et requêtes par message, RSS"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', type=int, default=2)
+        parser.add_argument('--users', type=int, default=20, help='utilisateurs par salle')
+        parser.add_argument('--rate', type=float, default=0.5, help='messages/s par utilisateur')
+        parser.add_argument('--duration', type=float, default=5.0, help='secondes')
+        parser.add_argument('--protocol', default=JSON, help='sous-protocole (chat.v1.json, chat.v1.compact...)')
+        parser.add_argument('--layer', choices=['memory', 'redis'], default='memory')
+        parser.add_argument('--redis-url', default='redis://localhost:6379/0')
+        parser.add_argument('--output', help='fichier JSON (sortie standard par défaut)')
+
+    def handle(self, *args, **options):
+        layers = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer',
+                              'CONFIG': {'capacity': 10000}}}
+        presence = {}
+        if options['layer'] == 'redis':
+            layers = {'default': {'BACKEND': 'channels_redis.core.RedisChannelLayer',
+                                  'CONFIG': {'hosts': [options['redis_url']], 'capacity': 10000}}}
+            presence = {'BACKEND': 'chat.presence.RedisPresenceStore',
+                        'OPTIONS': {'url': options['redis_url'], 'prefix': 'bench-presence'}}
+
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            with override_settings(CHANNEL_LAYERS=layers, **({'CHAT_PRESENCE': presence} if presence else {})):
+                result = asyncio.run(self.run(options))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        result['config'] = {key: options[key] for key in
+                            ('rooms', 'users', 'rate', 'duration', 'protocol', 'layer')}
+        output = json.dumps(result, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        else:
+            self.stdout.write(output)
+
+    async def run(self, options):
+        from asgiref.sync import sync_to_async
+
+        from chat.routing import websocket_urlpatterns
+
+        queries = QueryCounter()
+        connection_created.connect(queries.install)
+        # Connexion du thread qui exécute database_sync_to_async
+        await sync_to_async(queries.install)(connection=connection)
+        rooms, users = await sync_to_async(self.create_fixtures)(options['rooms'], options['users'])
+        cpu_started = time.process_time()
+
+        sent_at = {}
+        latencies = []
+        connect_ms = []
+        clients = []
+        for index, (room, user) in enumerate(
+            (room, user) for room in rooms for user in users[room.id]
+        ):
+            app = UserScopeMiddleware(URLRouter(websocket_urlpatterns), user)
+            communicator = WebsocketCommunicator(
+                app, f'/ws/chat/{room.name}/?features=history_batch',
+                subprotocols=[options['protocol']],
+            )
+            started = time.perf_counter()
+            connected, _ = await communicator.connect(timeout=10)
+            if not connected:
+                raise RuntimeError(f'Connexion refusée pour {user.username}')
+            # Historique et liste des membres
+            await communicator.output_queue.get()
+            connect_ms.append((time.perf_counter() - started) * 1000)
+            client = Client(communicator, make_codec(options['protocol']), index)
+            client.reader = asyncio.ensure_future(client.read(sent_at, latencies))
+            clients.append(client)
+
+        queries_before = queries.count
+        frames_before = sum(client.frames for client in clients)
+        sent = 0
+        interval = 1 / options['rate'] if options['rate'] > 0 else None
+        deadline = time.perf_counter() + options['duration']
+
+        async def sender(client):
+            nonlocal sent
+            codec = client.codec
+            # Départs étalés pour ne pas envoyer tous en même temps
+            await asyncio.sleep(interval * (client.index % 97) / 97)
+            sequence = 0
+            while time.perf_counter() < deadline:
+                cid = f'{client.index}-{sequence}'
+                sequence += 1
+                frame = {'message': f'bench {cid}', 'client_id': cid}
+                sent_at[frame['message']] = time.perf_counter()
+                if codec.name != JSON:
+                    frame = {'m': frame['message'], 'ci': cid}
+                payload = codec.dumps(frame)
+                if isinstance(payload, bytes):
+                    await client.communicator.send_to(bytes_data=payload)
+                else:
+                    await client.communicator.send_to(text_data=payload)
+                sent += 1
+                await asyncio.sleep(interval)
+
+        if interval is not None:
+            await asyncio.gather(*(sender(client) for client in clients))
+        # Laisser arriver les derniers messages et les écritures groupées
+        await asyncio.sleep(1.0)
+
+        frames = sum(client.frames for client in clients) - frames_before
+        db_queries = queries.count - queries_before
+        for client in clients:
+            client.reader.cancel()
+            await client.communicator.disconnect()
+        connection_created.disconnect(queries.install)
+
+        return {
+            'connect_ms': percentiles(connect_ms),
+            'fanout_ms': percentiles(latencies),
+            'messages_sent': sent,
+            'deliveries': len(latencies),
+            'frames_received': frames,
+            'frames_per_message': round(frames / sent, 2) if sent else None,
+            'db_queries': db_queries,
+            'db_queries_per_message': round(db_queries / sent, 3) if sent else None,
+            'rss_kb': rss_kb(),
+            'cpu_seconds': round(time.process_time() - cpu_started, 3),
+            'metrics': metrics.snapshot(),
+        }
+
+    def create_fixtures(self, room_count, user_count):
+        from accounts.models import CustomUser
+        from chat.models import ChatRoom
+
+        ChatRoom.objects.bulk_create(
+            [ChatRoom(name=f'bench_{index}') for index in range(room_count)]
+        )
+        rooms = list(ChatRoom.objects.filter(name__startswith='bench_').order_by('id'))
+        users = {}
+        for room in rooms:
+            CustomUser.objects.bulk_create([
+                CustomUser(username=f'{room.name}_u{index}', password='!')
+                for index in range(user_count)
+            ])
+            users[room.id] = list(
+                CustomUser.objects.filter(username__startswith=f'{room.name}_u').order_by('id')
+            )
+        return rooms, users
@@ -0,0 +1,127 @@
+# chat/management/commands/bench_fanout.py
+"""
+Coût CPU de la diffusion d'un message dans une grande salle.
+
+Compare, sur les mêmes consumers en mémoire (sans réseau ni channel layer) :
+- ``legacy`` : chaque destinataire reconstruit le dict et appelle json.dumps ;
+- ``encoded`` : ChatConsumer.chat_message_all sur une trame encodée une fois ;
+- ``compact`` : même chose avec le protocole chat.v1.compact (mémo par worker).
+
+    python manage.py bench_fanout --members 2000 --messages 200
+"""
+import asyncio
+import json
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from chat.consumers import ChatConsumer, encode_chat_message
+from chat.history import HistoryCache
+from chat.protocol import COMPACT, JSON, ProtocolSession, make_codec
+
+
+class SinkConsumer(ChatConsumer):
+    """Consumer sans connexion : les trames sont seulement comptées"""
+
+    def __init__(self, room_name, channel_name, history):
+        super().__init__()
+        self.room_name = room_name
+        self.channel_name = channel_name
+        self.history = history
+        self.protocol = ProtocolSession(make_codec(JSON))
+        self.frames = 0
+        self.bytes_sent = 0
+
+    async def send(self, text_data=None, bytes_data=None, close=False, ephemeral=False, last_id=None):
+        self.frames += 1
+        self.bytes_sent += len(text_data or bytes_data or '')
+
+
+async def legacy_chat_message_all(consumer, event):
+    """Ancien chemin : un json.dumps complet par destinataire"""
+    consumer.history.add_pending(consumer.room_name, event['cid'], {
+        'content': event['message'],
+        'username': event['username'],
+        'avatar': event['avatar'],
+    })
+    await consumer.send(text_data=json.dumps({
+        'type': 'chat_message',
+        'id': event['id'],
+        'cid': event['cid'],
+        'message': event['message'],
+        'username': event['username'],
+        'avatar': event['avatar'],
+        'timestamp': event['timestamp'],
+        'is_current_user': event['sender_channel'] == consumer.channel_name,
+    }))
+
+
+class Command(BaseCommand):
+    help = "Mesure le coût CPU par message de la diffusion dans une grande salle"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--members', type=int, default=2000)
+        parser.add_argument('--messages', type=int, default=200)
+        parser.add_argument('--size', type=int, default=200, help='taille du texte (caractères)')
+
+    def handle(self, *args, **options):
+        results = asyncio.run(self.run(options['members'], options['messages'], options['size']))
+        legacy, encoded = results['legacy'], results['encoded']
+        for name, result in results.items():
+            self.stdout.write(
+                f"{name:8} {result['cpu_per_message_ms']:8.3f} ms CPU/message  "
+                f"{result['cpu_per_recipient_us']:6.2f} µs/destinataire  "
+                f"{result['frames']} trames  {result['bytes'] / result['frames']:.0f} octets/trame"
+            )
+        self.stdout.write(self.style.SUCCESS(
+            f"gain : x{legacy['cpu_per_message_ms'] / encoded['cpu_per_message_ms']:.1f}"
+        ))
+
+    async def run(self, members, messages, size):
+        room_name = 'bench'
+        history = HistoryCache(messages_per_room=50, max_rooms=10, max_bytes=8 * 1024 * 1024)
+        consumers = [
+            SinkConsumer(room_name, f'bench.{index}', history)
+            for index in range(members)
+        ]
+        paths = {
+            'legacy': lambda consumer, event: legacy_chat_message_all(consumer, event),
+            'encoded': lambda consumer, event: consumer.chat_message_all(event),
+            'compact': lambda consumer, event: consumer.chat_message_all(event),
+        }
+        results = {}
+        for name, handler in paths.items():
+            protocol = COMPACT if name == 'compact' else JSON
+            for consumer in consumers:
+                consumer.frames = 0
+                consumer.bytes_sent = 0
+                consumer.protocol = ProtocolSession(make_codec(protocol))
+            cpu = 0.0
+            for index in range(messages):
+                started = time.process_time()
+                event = {
+                    'type': 'chat_message_all',
+                    'id': None,
+                    'cid': uuid.uuid4().hex,
+                    'message': 'x' * size,
+                    'username': 'bench',
+                    'avatar': '/media/avatars/default.png',
+                    'timestamp': timezone.now().isoformat(),
+                    'sender_channel': consumers[index % members].channel_name,
+                }
+                if name != 'legacy':
+                    # Coût payé une fois par l'expéditeur
+                    event['text'] = encode_chat_message(event)
+                for consumer in consumers:
+                    await handler(consumer, event)
+                cpu += time.process_time() - started
+                history.invalidate(room_name)
+            results[name] = {
+                'cpu_per_message_ms': cpu / messages * 1000,
+                'cpu_per_recipient_us': cpu / messages / members * 1e6,
+                'frames': sum(consumer.frames for consumer in consumers),
+                'bytes': sum(consumer.bytes_sent for consumer in consumers),
+            }
+        return results
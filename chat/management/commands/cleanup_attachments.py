@@ -0,0 +1,26 @@
+# chat/management/commands/cleanup_attachments.py
+"""
+Supprime les envois de pièces jointes abandonnés et les fichiers qu'aucune
+pièce jointe ne référence plus (voir chat/attachments.py). À lancer
+régulièrement (cron), comme archive_messages :
+
+    python manage.py cleanup_attachments
+    python manage.py cleanup_attachments --dry-run
+"""
+from django.core.management.base import BaseCommand
+
+from chat.attachments import cleanup_attachments
+
+
+class Command(BaseCommand):
+    help = "Supprime les envois incomplets expirés et les fichiers de pièces jointes orphelins"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='compter sans rien supprimer')
+
+    def handle(self, *args, **options):
+        results = cleanup_attachments(dry_run=options['dry_run'])
+        verb = 'à supprimer' if options['dry_run'] else 'supprimés'
+        self.stdout.write(f"Envois incomplets {verb} : {results['uploads']}")
+        self.stdout.write(f"Morceaux orphelins {verb} : {results['partials']}")
+        self.stdout.write(self.style.SUCCESS(f"Fichiers orphelins {verb} : {results['blobs']}"))
@@ -0,0 +1,47 @@
+# chat/management/commands/export_room.py
+"""
+Exporte tout l'historique d'une salle, archives comprises (voir chat/export.py) :
+
+    python manage.py export_room general > general.jsonl
+    python manage.py export_room general --format csv --since 2026-01-01 --gzip -o general.csv.gz
+"""
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.export import FORMATS, parse_bound, stream_export
+from chat.models import ChatRoom
+
+
+class Command(BaseCommand):
+    help = "Exporte l'historique d'une salle en JSONL ou CSV, sans le charger en mémoire"
+
+    def add_arguments(self, parser):
+        parser.add_argument('room', help='nom de la salle')
+        parser.add_argument('--format', choices=sorted(FORMATS), default='jsonl')
+        parser.add_argument('--since', help='date ou date et heure ISO 8601 (incluse)')
+        parser.add_argument('--until', help='date ou date et heure ISO 8601 (exclue)')
+        parser.add_argument('--gzip', action='store_true', help='compresser la sortie')
+        parser.add_argument('-o', '--output', help='fichier de sortie (défaut : sortie standard)')
+
+    def handle(self, *args, **options):
+        try:
+            room = ChatRoom.objects.get(name=options['room'])
+        except ChatRoom.DoesNotExist:
+            raise CommandError(f"La salle {options['room']} n'existe pas")
+        try:
+            since = parse_bound(options['since'])
+            until = parse_bound(options['until'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        chunks = stream_export(room, options['format'], since, until, options['gzip'])
+        output = open(options['output'], 'wb') if options['output'] else sys.stdout.buffer
+        try:
+            for chunk in chunks:
+                output.write(chunk)
+        finally:
+            if output is not sys.stdout.buffer:
+                output.close()
+            else:
+                output.flush()
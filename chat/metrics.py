@@ -0,0 +1,153 @@
+# chat/metrics.py
+"""
+Métriques internes du chat (compteurs, jauges et histogrammes, par processus).
+
+Volontairement minimal : des valeurs en mémoire, lisibles via
+``snapshot()`` ou au format texte de Prometheus via ``render_prometheus()``.
+Les mises à jour passent par un verrou par métrique : les histogrammes de
+chat/instrumentation.py sont aussi alimentés depuis les threads de
+database_sync_to_async, où ``+=`` perdrait des valeurs. Chaque worker expose ses
+propres valeurs ; l'agrégation se fait côté Prometheus.
+"""
+import threading
+from bisect import bisect_left
+
+# Secondes : de la milliseconde à la dizaine de secondes
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Counter:
+    """Valeur qui ne fait qu'augmenter"""
+
+    def __init__(self, name, help_text=''):
+        self.name = name
+        self.help_text = help_text
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class Gauge:
+    """Valeur instantanée (profondeur de file, connexions ouvertes...)"""
+
+    def __init__(self, name, help_text=''):
+        self.name = name
+        self.help_text = help_text
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+
+
+class Histogram:
+    """
+    Distribution d'une durée, éventuellement par étiquettes (``labelnames``).
+    observe() coûte une recherche dichotomique : assez peu pour rester actif
+    en production.
+    """
+
+    def __init__(self, name, help_text='', labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.series = {}  # valeurs des étiquettes -> [compteurs par seuil, somme, nombre]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def collect(self):
+        """Copie cohérente des séries : [(étiquettes, compteurs, somme, nombre)]"""
+        with self._lock:
+            return [
+                (labels, list(counts), total, count)
+                for labels, (counts, total, count) in self.series.items()
+            ]
+
+    @property
+    def value(self):
+        return {
+            ','.join(labels): {'count': count, 'sum': round(total, 6)}
+            for labels, _, total, count in self.collect()
+        }
+
+
+_registry = {}
+
+
+def _get_or_create(cls, name, help_text, **options):
+    metric = _registry.get(name)
+    if metric is None:
+        metric = _registry[name] = cls(name, help_text, **options)
+    return metric
+
+
+def counter(name, help_text=''):
+    return _get_or_create(Counter, name, help_text)
+
+
+def gauge(name, help_text=''):
+    return _get_or_create(Gauge, name, help_text)
+
+
+def histogram(name, help_text='', labelnames=(), buckets=DEFAULT_BUCKETS):
+    return _get_or_create(Histogram, name, help_text, labelnames=labelnames, buckets=buckets)
+
+
+def snapshot():
+    """Valeurs courantes de toutes les métriques : {nom: valeur}"""
+    return {name: metric.value for name, metric in _registry.items()}
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs
+    )
+    return '{' + ','.join(escaped) + '}'
+
+
+def render_prometheus():
+    """Toutes les métriques au format d'exposition texte de Prometheus (0.0.4)"""
+    lines = []
+    for name, metric in _registry.items():
+        kind = {Counter: 'counter', Gauge: 'gauge', Histogram: 'histogram'}[type(metric)]
+        if metric.help_text:
+            lines.append(f'# HELP {name} {metric.help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        if kind != 'histogram':
+            lines.append(f'{name} {metric.value}')
+            continue
+        for labels, counts, total, count in metric.collect():
+            cumulative = 0
+            for bound, bucket in zip(metric.buckets + ('+Inf',), counts):
+                cumulative += bucket
+                le = _labels(metric.labelnames, labels, [('le', bound)])
+                lines.append(f'{name}_bucket{le} {cumulative}')
+            suffix = _labels(metric.labelnames, labels)
+            lines.append(f'{name}_sum{suffix} {total}')
+            lines.append(f'{name}_count{suffix} {count}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,78 @@
+# Generated by Django 6.0.2 on 2026-10-18 13:05
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def copy_seen_by(apps, schema_editor):
+    """Une position de lecture par (utilisateur, salle) : le plus grand message vu"""
+    Message = apps.get_model('chat', 'Message')
+    RoomReadState = apps.get_model('chat', 'RoomReadState')
+    through = Message.seen_by.through
+    rows = (
+        through.objects
+        .values('customuser_id', 'message__room_id')
+        .annotate(last_read=Max('message_id'))
+        .iterator(chunk_size=2000)
+    )
+    batch = []
+    for row in rows:
+        batch.append(RoomReadState(
+            user_id=row['customuser_id'],
+            room_id=row['message__room_id'],
+            last_read_message_id=row['last_read'],
+        ))
+        if len(batch) >= 1000:
+            RoomReadState.objects.bulk_create(batch, ignore_conflicts=True)
+            batch = []
+    RoomReadState.objects.bulk_create(batch, ignore_conflicts=True)
+
+
+def restore_seen_by(apps, schema_editor):
+    """Retour arrière : tous les messages sous la position de lecture sont marqués vus"""
+    Message = apps.get_model('chat', 'Message')
+    RoomReadState = apps.get_model('chat', 'RoomReadState')
+    through = Message.seen_by.through
+    for state in RoomReadState.objects.iterator(chunk_size=500):
+        ids = (
+            Message.objects
+            .filter(room_id=state.room_id, id__lte=state.last_read_message_id)
+            .exclude(user_id=state.user_id)
+            .values_list('id', flat=True)
+        )
+        through.objects.bulk_create(
+            [through(message_id=message_id, customuser_id=state.user_id) for message_id in ids],
+            ignore_conflicts=True,
+            batch_size=1000,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_alter_message_timestamp'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RoomReadState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_read_message_id', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_states', to='chat.chatroom')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_states', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('user', 'room'), name='chat_readstate_user_room_uniq')],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['room', 'id'], name='chat_msg_room_id_idx'),
+        ),
+        migrations.RunPython(copy_seen_by, restore_seen_by),
+    ]
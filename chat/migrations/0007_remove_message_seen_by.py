@@ -0,0 +1,17 @@
+# Generated by Django 6.0.2 on 2026-10-18 13:05
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_roomreadstate'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='message',
+            name='seen_by',
+        ),
+    ]
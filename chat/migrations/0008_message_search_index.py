@@ -0,0 +1,88 @@
+"""
+Index plein texte des messages (voir chat/search.py).
+
+- SQLite : table FTS5 à contenu externe ``chat_message_fts`` tenue à jour
+  par des triggers, donc aussi pour les bulk_create de l'écriture groupée.
+- PostgreSQL : colonne générée ``search_vector`` et index GIN, construit
+  sans bloquer les écritures (CREATE INDEX CONCURRENTLY, d'où atomic=False).
+- Autres bases : rien, la recherche se rabat sur un filtre icontains.
+
+Attention sous SQLite : une migration qui reconstruit chat_message (la
+plupart des ALTER) supprime les triggers ; il faut alors les recréer.
+"""
+from django.db import migrations
+
+SQLITE_FORWARD = [
+    """
+    CREATE VIRTUAL TABLE chat_message_fts USING fts5(
+        content,
+        content='chat_message',
+        content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER chat_message_fts_insert AFTER INSERT ON chat_message BEGIN
+        INSERT INTO chat_message_fts(rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+    """
+    CREATE TRIGGER chat_message_fts_delete AFTER DELETE ON chat_message BEGIN
+        INSERT INTO chat_message_fts(chat_message_fts, rowid, content)
+        VALUES ('delete', old.id, old.content);
+    END
+    """,
+    """
+    CREATE TRIGGER chat_message_fts_update AFTER UPDATE OF content ON chat_message BEGIN
+        INSERT INTO chat_message_fts(chat_message_fts, rowid, content)
+        VALUES ('delete', old.id, old.content);
+        INSERT INTO chat_message_fts(rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+    # Messages existants
+    "INSERT INTO chat_message_fts(chat_message_fts) VALUES ('rebuild')",
+]
+
+SQLITE_BACKWARD = [
+    'DROP TRIGGER IF EXISTS chat_message_fts_update',
+    'DROP TRIGGER IF EXISTS chat_message_fts_delete',
+    'DROP TRIGGER IF EXISTS chat_message_fts_insert',
+    'DROP TABLE IF EXISTS chat_message_fts',
+]
+
+POSTGRES_FORWARD = [
+    """
+    ALTER TABLE chat_message ADD COLUMN search_vector tsvector
+        GENERATED ALWAYS AS (to_tsvector('simple', coalesce(content, ''))) STORED
+    """,
+    'CREATE INDEX CONCURRENTLY chat_msg_search_idx ON chat_message USING GIN (search_vector)',
+]
+
+POSTGRES_BACKWARD = [
+    'DROP INDEX CONCURRENTLY IF EXISTS chat_msg_search_idx',
+    'ALTER TABLE chat_message DROP COLUMN IF EXISTS search_vector',
+]
+
+
+def run(statements):
+    def operation(apps, schema_editor):
+        vendor = schema_editor.connection.vendor
+        for sql in statements.get(vendor, ()):
+            schema_editor.execute(sql)
+    return operation
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('chat', '0007_remove_message_seen_by'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            run({'sqlite': SQLITE_FORWARD, 'postgresql': POSTGRES_FORWARD}),
+            run({'sqlite': SQLITE_BACKWARD, 'postgresql': POSTGRES_BACKWARD}),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 6.0.2 on 2026-10-18 14:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0008_message_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroom',
+            name='archived_message_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='retention_days',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 6.0.2 on 2026-10-18 17:40
+
+from django.db import migrations, models
+
+
+def count_unread(apps, schema_editor):
+    """Compteurs initiaux : messages des autres au-delà de chaque position de lecture"""
+    Message = apps.get_model('chat', 'Message')
+    RoomReadState = apps.get_model('chat', 'RoomReadState')
+    for state in RoomReadState.objects.iterator(chunk_size=500):
+        unread = (
+            Message.objects
+            .filter(room_id=state.room_id, id__gt=state.last_read_message_id)
+            .exclude(user_id=state.user_id)
+            .count()
+        )
+        if unread:
+            RoomReadState.objects.filter(id=state.id).update(unread_count=unread)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0010_message_attachment'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='roomreadstate',
+            name='unread_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RemoveIndex(
+            model_name='message',
+            name='chat_msg_room_id_idx',
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['room', 'id', 'user'], name='chat_msg_room_id_user_idx'),
+        ),
+        migrations.RunPython(count_unread, migrations.RunPython.noop),
+    ]
@@ -1,5 +1,8 @@
 # chat/models.py
+import uuid
+
 from django.db import models
+from django.utils import timezone
 from accounts.models import CustomUser
 
 class ChatRoom(models.Model):
@@ -14,6 +17,10 @@ class ChatRoom(models.Model):
         blank=True,
         related_name='created_rooms'
     )
+    # Messages plus anciens déplacés vers les segments d'archive (voir
+    # chat/archive.py) ; vide : durée par défaut de settings.CHAT_ARCHIVE
+    retention_days = models.PositiveIntegerField(null=True, blank=True)
+    archived_message_count = models.PositiveIntegerField(default=0, editable=False)
     
     def __str__(self):
         return self.name
@@ -26,7 +33,7 @@ class ChatRoom(models.Model):
         return self.name.replace('_', ' ').title()
     
     def get_message_count(self):
-        return self.messages.count()
+        return self.messages.count() + self.archived_message_count
     
     class Meta:
         ordering = ['-created_at']
@@ -35,18 +42,86 @@ class Message(models.Model):
     room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='messages')
     user = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
     content = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
-    seen_by = models.ManyToManyField(
-        CustomUser, 
-        related_name='seen_messages',
-        blank=True
+    # Pièce jointe (voir chat/attachments.py) ; content peut alors être vide
+    attachment = models.ForeignKey(
+        'Attachment',
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='messages',
     )
+    # Fixé à la réception (et non à l'écriture différée) pour que l'heure
+    # diffusée aux clients soit celle enregistrée
+    timestamp = models.DateTimeField(default=timezone.now)
     
     class Meta:
         ordering = ['timestamp']
+        indexes = [
+            # Pagination par curseur (timestamp, id) dans une salle
+            models.Index(fields=['room', 'timestamp', 'id'], name='chat_msg_room_ts_id_idx'),
+            # Comptage des non-lus : messages des autres au-delà d'un id
+            # (l'auteur est dans l'index, exclude(user=...) ne relit pas la table)
+            models.Index(fields=['room', 'id', 'user'], name='chat_msg_room_id_user_idx'),
+        ]
     
     def __str__(self):
         return f'{self.user.username}: {self.content[:50]}'
     
     def is_seen_by(self, user):
-        return self.seen_by.filter(id=user.id).exists()
\ No newline at end of file
+        if user.id == self.user_id:
+            return True
+        return RoomReadState.objects.filter(
+            user=user,
+            room_id=self.room_id,
+            last_read_message_id__gte=self.id,
+        ).exists()
+
+
+class RoomReadState(models.Model):
+    """
+    Position de lecture d'un utilisateur dans une salle : tous les messages
+    d'id inférieur ou égal à last_read_message_id sont considérés comme vus.
+    Une ligne par (utilisateur, salle), quel que soit le nombre de messages.
+    ``unread_count`` (messages des autres au-delà de cette position) est tenu
+    à jour par l'écriture groupée (chat/ingest.py) et les accusés
+    (chat/receipts.py) : le lobby le lit sans rien compter.
+    """
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='read_states')
+    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='read_states')
+    last_read_message_id = models.BigIntegerField(default=0)
+    unread_count = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'room'], name='chat_readstate_user_room_uniq'),
+        ]
+    
+    def __str__(self):
+        return f'{self.user_id} @ {self.room_id}: {self.last_read_message_id}'
+
+
+class Attachment(models.Model):
+    """
+    Fichier envoyé par morceaux dans une salle (voir chat/attachments.py).
+    ``received`` avance à chaque morceau ; une fois le fichier complet, son
+    contenu est rangé sous son empreinte SHA-256, partagée par tous les
+    envois identiques.
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='attachments')
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='attachments')
+    filename = models.CharField(max_length=255)
+    content_type = models.CharField(max_length=100)
+    size = models.PositiveBigIntegerField()
+    received = models.PositiveBigIntegerField(default=0)
+    sha256 = models.CharField(max_length=64, blank=True, db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+    
+    @property
+    def is_complete(self):
+        return self.completed_at is not None
+    
+    def __str__(self):
+        return f'{self.filename} ({self.received}/{self.size})'
@@ -0,0 +1,185 @@
+# chat/outbound.py
+"""
+File d'envoi bornée par connexion WebSocket.
+
+Les handlers du consumer ne font que déposer leurs trames ici : le consumer
+continue donc de vider sa file du channel layer même si le client lit
+lentement, et c'est cette file, bornée en trames et en octets, qui absorbe
+le retard. Au-delà des limites :
+1. les trames éphémères (présence, statuts de lecture) en attente sont
+   abandonnées, les plus anciennes d'abord ;
+2. si cela ne suffit pas, ou si une écriture reste bloquée plus de
+   SEND_TIMEOUT secondes, la connexion est déclarée lente : le consumer la
+   ferme avec une indication de reprise (voir ChatConsumer.slow_consumer).
+
+Un client lent coûte donc au plus MAX_QUEUE_BYTES au worker.
+
+Regroupement (clients annonçant la fonctionnalité ``batch``) : au-delà de
+BATCH_RATE trames par seconde vers la connexion, l'écriture attend
+BATCH_DELAY secondes puis envoie en une seule trame ``batch`` tout ce qui
+est arrivé entre-temps (au plus BATCH_MAX_FRAMES trames). En dessous, chaque
+trame part aussitôt, comme sans regroupement.
+"""
+import asyncio
+import math
+import time
+from collections import deque
+
+from django.conf import settings
+
+from . import metrics
+
+DEFAULT_BACKPRESSURE = {
+    'MAX_QUEUE_FRAMES': 1000,
+    'MAX_QUEUE_BYTES': 1024 * 1024,
+    'SEND_TIMEOUT': 10,              # secondes pour écrire une trame
+    'MAX_FRAME_BYTES': 64 * 1024,    # trame entrante
+    'MAX_MESSAGE_LENGTH': 4000,      # caractères d'un message de chat
+    'BATCH_RATE': 50,                # trames/s vers une connexion avant regroupement
+    'BATCH_DELAY': 0.005,            # secondes d'attente des trames suivantes
+    'BATCH_MAX_FRAMES': 100,         # trames par trame batch
+}
+
+# Constante de temps (secondes) de l'estimation du débit d'une connexion
+RATE_WINDOW = 1.0
+
+queued_frames = metrics.gauge('chat_outbound_queue_frames', "Trames en attente d'envoi (toutes connexions)")
+queued_bytes = metrics.gauge('chat_outbound_queue_bytes', "Octets en attente d'envoi (toutes connexions)")
+dropped_frames = metrics.counter('chat_outbound_dropped_total', 'Trames éphémères abandonnées')
+slow_consumers = metrics.counter('chat_slow_consumer_disconnects_total', 'Connexions fermées car trop lentes')
+rejected_frames = metrics.counter('chat_inbound_rejected_total', 'Trames entrantes refusées (taille)')
+batch_frames = metrics.histogram(
+    'chat_outbound_batch_frames', 'Trames regroupées par trame batch', buckets=(2, 5, 10, 25, 50, 100),
+)
+
+
+def get_backpressure_config():
+    return {**DEFAULT_BACKPRESSURE, **getattr(settings, 'CHAT_BACKPRESSURE', {})}
+
+
+class OutboundQueue:
+
+    def __init__(self, write, max_frames=1000, max_bytes=1024 * 1024, send_timeout=10,
+                 join=None, batch_rate=50, batch_delay=0.005, batch_max=100):
+        self.write = write  # coroutine qui envoie réellement une trame
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self.send_timeout = send_timeout
+        self.join = join    # trames encodées -> trame batch ; None : pas de regroupement
+        self.batch_rate = batch_rate
+        self.batch_delay = batch_delay
+        self.batch_max = batch_max
+        self.rate = 0.0     # trames reçues, décroissance exponentielle sur RATE_WINDOW
+        self.rate_at = time.monotonic()
+        self.frames = deque()  # (payload, taille, éphémère, dernier id de message)
+        self.bytes = 0
+        self.shed = False      # des trames éphémères ont été abandonnées
+        self.last_written_id = 0
+        self.writing_since = None
+        self.closed = False
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.ensure_future(self._run())
+
+    def __len__(self):
+        return len(self.frames)
+
+    def put(self, payload, ephemeral=False, last_id=None):
+        """
+        Dépose une trame. Retourne False si la connexion est trop lente
+        (file pleine de trames durables ou écriture bloquée).
+        """
+        if self.closed:
+            return True
+        if self.join is not None:
+            now = time.monotonic()
+            self.rate = self.current_rate(now) + 1
+            self.rate_at = now
+        size = len(payload)
+        self.frames.append((payload, size, ephemeral, last_id))
+        self.bytes += size
+        queued_frames.inc()
+        queued_bytes.inc(size)
+        if self.over_limit():
+            self._shed_ephemeral()
+        self._wakeup.set()
+        return not self.over_limit() and not self.stalled()
+
+    def current_rate(self, now=None):
+        """Trames par seconde environ, sur la dernière seconde"""
+        now = time.monotonic() if now is None else now
+        return self.rate * math.exp((self.rate_at - now) / RATE_WINDOW)
+
+    def busy(self):
+        return self.join is not None and self.current_rate() >= self.batch_rate
+
+    def over_limit(self):
+        return len(self.frames) > self.max_frames or self.bytes > self.max_bytes
+
+    def stalled(self):
+        return (
+            self.writing_since is not None
+            and time.monotonic() - self.writing_since > self.send_timeout
+        )
+
+    def _shed_ephemeral(self):
+        kept = deque()
+        count = len(self.frames)
+        for frame in self.frames:
+            if frame[2] and (count > self.max_frames or self.bytes > self.max_bytes):
+                self._forget(frame)
+                count -= 1
+                dropped_frames.inc()
+                self.shed = True
+            else:
+                kept.append(frame)
+        self.frames = kept
+
+    def _forget(self, frame):
+        self.bytes -= frame[1]
+        queued_frames.dec()
+        queued_bytes.dec(frame[1])
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while self.frames:
+                batch = self.busy()
+                if batch and len(self.frames) < self.batch_max:
+                    # Connexion très sollicitée : laisser arriver les trames suivantes
+                    await asyncio.sleep(self.batch_delay)
+                frames = [self.frames.popleft()]
+                while batch and self.frames and len(frames) < self.batch_max:
+                    frames.append(self.frames.popleft())
+                for frame in frames:
+                    self._forget(frame)
+                if len(frames) == 1:
+                    payload = frames[0][0]
+                else:
+                    payload = self.join([frame[0] for frame in frames])
+                    batch_frames.observe(len(frames))
+                self.writing_since = time.monotonic()
+                try:
+                    await self.write(payload)
+                except Exception:
+                    # Connexion déjà fermée côté serveur : plus rien à envoyer
+                    self.close()
+                    return
+                self.writing_since = None
+                last_id = max((frame[3] for frame in frames if frame[3]), default=None)
+                if last_id:
+                    self.last_written_id = max(self.last_written_id, last_id)
+
+    async def drain(self, timeout=1.0):
+        """Attend que la file soit vide (avant une fermeture volontaire)"""
+        deadline = time.monotonic() + timeout
+        while (self.frames or self.writing_since is not None) and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+
+    def close(self):
+        """Abandonne les trames restantes et arrête l'écriture"""
+        self.closed = True
+        if self._task is not asyncio.current_task():
+            self._task.cancel()
+        while self.frames:
+            self._forget(self.frames.popleft())
@@ -0,0 +1,454 @@
+# chat/presence.py
+"""
+Registre de présence des salles, partagé entre les workers.
+
+Chaque connexion WebSocket est enregistrée avec une date d'expiration
+rafraîchie par un battement de cœur périodique. Si un worker plante, ses
+connexions ne sont plus rafraîchies et disparaissent d'elles-mêmes après
+le TTL, sans laisser d'utilisateurs fantômes.
+
+Les arrivées et départs sont diffusés sous forme de deltas regroupés par
+salle sur une courte fenêtre (``PresenceBroadcaster``), avec de temps en
+temps la liste complète pour corriger toute dérive.
+
+Le backend est choisi via ``settings.CHAT_PRESENCE`` :
+
+    CHAT_PRESENCE = {
+        'BACKEND': 'chat.presence.RedisPresenceStore',
+        'OPTIONS': {'ttl': 30, 'heartbeat_interval': 10},
+        'DEBOUNCE': 0.25,
+        'SNAPSHOT_INTERVAL': 30,
+    }
+"""
+import asyncio
+import json
+import logging
+import time
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PRESENCE = {
+    'BACKEND': 'chat.presence.MemoryPresenceStore',
+    'OPTIONS': {},
+    'DEBOUNCE': 0.25,
+    'SNAPSHOT_INTERVAL': 30,
+}
+
+
+def member_list(members):
+    """Liste publique des présents, telle qu'envoyée aux clients"""
+    return [
+        {
+            'username': username,
+            'avatar': info.get('avatar'),
+            'bio': info.get('bio', ''),
+        }
+        for username, info in members.items()
+    ]
+
+
+class BasePresenceStore:
+    """Interface commune des registres de présence"""
+
+    def __init__(self, ttl=30, heartbeat_interval=10):
+        self.ttl = ttl
+        self.heartbeat_interval = heartbeat_interval
+        # Connexions locales à ce worker : channel_name -> room_name
+        self.local_connections = {}
+        self._heartbeat_task = None
+
+    async def add(self, room_name, channel_name, username, info):
+        """Enregistre une connexion ; True si c'est la première de l'utilisateur"""
+        self.local_connections[channel_name] = room_name
+        first = await self._add(room_name, channel_name, username, info)
+        self._ensure_heartbeat()
+        return bool(first)
+
+    async def remove(self, room_name, channel_name):
+        """Retire une connexion ; True si l'utilisateur a quitté la salle"""
+        self.local_connections.pop(channel_name, None)
+        return bool(await self._remove(room_name, channel_name))
+
+    async def heartbeat(self):
+        """Rafraîchit toutes les connexions locales de ce worker"""
+        by_room = {}
+        for channel_name, room_name in list(self.local_connections.items()):
+            by_room.setdefault(room_name, []).append(channel_name)
+        for room_name, channel_names in by_room.items():
+            await self._refresh(room_name, channel_names)
+
+    def _ensure_heartbeat(self):
+        if self._heartbeat_task is None or self._heartbeat_task.done():
+            self._heartbeat_task = asyncio.ensure_future(self._heartbeat_loop())
+
+    async def _heartbeat_loop(self):
+        while self.local_connections:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                await self.heartbeat()
+            except Exception:
+                logger.exception('Échec du battement de cœur de présence')
+
+    async def members(self, room_name):
+        """Utilisateurs présents : {username: info}"""
+        raise NotImplementedError
+
+    async def count(self, room_name):
+        """Nombre d'utilisateurs distincts présents dans la salle"""
+        raise NotImplementedError
+
+    async def channels_for(self, room_name, username):
+        """Canaux ouverts par un utilisateur dans la salle"""
+        raise NotImplementedError
+
+    async def _add(self, room_name, channel_name, username, info):
+        raise NotImplementedError
+
+    async def _remove(self, room_name, channel_name):
+        raise NotImplementedError
+
+    async def _refresh(self, room_name, channel_names):
+        raise NotImplementedError
+
+
+class MemoryPresenceStore(BasePresenceStore):
+    """
+    Registre en mémoire, propre à un processus.
+
+    Suffisant avec un seul worker (et l'InMemoryChannelLayer), ou comme
+    doublure locale dans les tests.
+    """
+
+    def __init__(self, **options):
+        super().__init__(**options)
+        # room_name -> OrderedDict(channel_name -> (username, expires_at)),
+        # trié par expiration puisque tous les TTL sont identiques
+        self.connections = {}
+        # room_name -> {username: {'count': n, 'info': {...}}}
+        self.users = {}
+
+    def _prune(self, room_name):
+        connections = self.connections.get(room_name)
+        if not connections:
+            return
+        now = time.monotonic()
+        while connections:
+            channel_name, (username, expires_at) = next(iter(connections.items()))
+            if expires_at > now:
+                break
+            del connections[channel_name]
+            self._release(room_name, username)
+
+    def _release(self, room_name, username):
+        users = self.users.get(room_name, {})
+        entry = users.get(username)
+        if entry is not None:
+            entry['count'] -= 1
+            if entry['count'] <= 0:
+                del users[username]
+        if not users:
+            self.users.pop(room_name, None)
+        if not self.connections.get(room_name):
+            self.connections.pop(room_name, None)
+
+    async def _add(self, room_name, channel_name, username, info):
+        self._prune(room_name)
+        connections = self.connections.setdefault(room_name, OrderedDict())
+        users = self.users.setdefault(room_name, {})
+        first = False
+        if channel_name not in connections:
+            entry = users.setdefault(username, {'count': 0, 'info': info})
+            entry['count'] += 1
+            entry['info'] = info
+            first = entry['count'] == 1
+        connections[channel_name] = (username, time.monotonic() + self.ttl)
+        connections.move_to_end(channel_name)
+        return first
+
+    async def _remove(self, room_name, channel_name):
+        connections = self.connections.get(room_name)
+        if connections and channel_name in connections:
+            username, _ = connections.pop(channel_name)
+            self._release(room_name, username)
+            return username not in self.users.get(room_name, {})
+        return False
+
+    async def _refresh(self, room_name, channel_names):
+        connections = self.connections.get(room_name)
+        if not connections:
+            return
+        expires_at = time.monotonic() + self.ttl
+        for channel_name in channel_names:
+            if channel_name in connections:
+                username, _ = connections[channel_name]
+                connections[channel_name] = (username, expires_at)
+                connections.move_to_end(channel_name)
+
+    async def members(self, room_name):
+        self._prune(room_name)
+        return {
+            username: entry['info']
+            for username, entry in self.users.get(room_name, {}).items()
+        }
+
+    async def count(self, room_name):
+        self._prune(room_name)
+        return len(self.users.get(room_name, {}))
+
+    async def channels_for(self, room_name, username):
+        self._prune(room_name)
+        return [
+            channel_name
+            for channel_name, (owner, _) in self.connections.get(room_name, {}).items()
+            if owner == username
+        ]
+
+
+# Scripts Lua : chaque opération est atomique côté Redis, quel que soit le
+# nombre de workers qui y accèdent en même temps.
+#   KEYS = conns (zset canal -> expiration), chan (hash canal -> username),
+#          users (hash username -> nb de connexions), info (hash username -> json)
+_PRUNE_LUA = """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+for _, channel in ipairs(expired) do
+    local username = redis.call('HGET', KEYS[2], channel)
+    redis.call('ZREM', KEYS[1], channel)
+    redis.call('HDEL', KEYS[2], channel)
+    if username then
+        if redis.call('HINCRBY', KEYS[3], username, -1) <= 0 then
+            redis.call('HDEL', KEYS[3], username)
+            redis.call('HDEL', KEYS[4], username)
+        end
+    end
+end
+return #expired
+"""
+
+_ADD_LUA = """
+local first = 0
+if redis.call('ZSCORE', KEYS[1], ARGV[1]) == false then
+    redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+    if redis.call('HINCRBY', KEYS[3], ARGV[2], 1) == 1 then
+        first = 1
+    end
+end
+redis.call('HSET', KEYS[4], ARGV[2], ARGV[3])
+redis.call('ZADD', KEYS[1], ARGV[4], ARGV[1])
+for i = 1, 4 do
+    redis.call('PEXPIRE', KEYS[i], ARGV[5])
+end
+return first
+"""
+
+_REMOVE_LUA = """
+if redis.call('ZREM', KEYS[1], ARGV[1]) == 1 then
+    local username = redis.call('HGET', KEYS[2], ARGV[1])
+    redis.call('HDEL', KEYS[2], ARGV[1])
+    if username and redis.call('HINCRBY', KEYS[3], username, -1) <= 0 then
+        redis.call('HDEL', KEYS[3], username)
+        redis.call('HDEL', KEYS[4], username)
+        return 1
+    end
+end
+return 0
+"""
+
+_SCRIPTS = {'prune': _PRUNE_LUA, 'add': _ADD_LUA, 'remove': _REMOVE_LUA}
+
+
+class RedisPresenceStore(BasePresenceStore):
+    """
+    Registre partagé dans Redis (le même que celui du channel layer par défaut).
+
+    Les requêtes "combien" et "qui" lisent des hashes indexés par salle :
+    HLEN et HGETALL ne dépendent pas du nombre total de connexions.
+    """
+
+    def __init__(self, url=None, prefix='presence', **options):
+        super().__init__(**options)
+        self.url = url or _channel_layer_redis_url()
+        self.prefix = prefix
+        self._client = None
+        self._scripts = {}
+
+    @property
+    def client(self):
+        if self._client is None:
+            import redis.asyncio as redis
+            self._client = redis.from_url(self.url, decode_responses=True)
+        return self._client
+
+    def _script(self, name):
+        if name not in self._scripts:
+            self._scripts[name] = self.client.register_script(_SCRIPTS[name])
+        return self._scripts[name]
+
+    def _keys(self, room_name):
+        base = f'{self.prefix}:{room_name}'
+        return [f'{base}:conns', f'{base}:chan', f'{base}:users', f'{base}:info']
+
+    async def _prune(self, room_name):
+        await self._script('prune')(keys=self._keys(room_name), args=[time.time()])
+
+    async def _add(self, room_name, channel_name, username, info):
+        await self._prune(room_name)
+        return await self._script('add')(
+            keys=self._keys(room_name),
+            args=[
+                channel_name,
+                username,
+                json.dumps(info),
+                time.time() + self.ttl,
+                int(self.ttl * 2000),
+            ],
+        )
+
+    async def _remove(self, room_name, channel_name):
+        return await self._script('remove')(keys=self._keys(room_name), args=[channel_name])
+
+    async def _refresh(self, room_name, channel_names):
+        keys = self._keys(room_name)
+        expires_at = time.time() + self.ttl
+        async with self.client.pipeline(transaction=False) as pipe:
+            # XX : ne ressuscite pas une connexion déjà expirée
+            pipe.zadd(keys[0], {name: expires_at for name in channel_names}, xx=True)
+            for key in keys:
+                pipe.pexpire(key, int(self.ttl * 2000))
+            await pipe.execute()
+
+    async def members(self, room_name):
+        await self._prune(room_name)
+        raw = await self.client.hgetall(self._keys(room_name)[3])
+        return {username: json.loads(info) for username, info in raw.items()}
+
+    async def count(self, room_name):
+        await self._prune(room_name)
+        return await self.client.hlen(self._keys(room_name)[2])
+
+    async def channels_for(self, room_name, username):
+        await self._prune(room_name)
+        raw = await self.client.hgetall(self._keys(room_name)[1])
+        return [channel_name for channel_name, owner in raw.items() if owner == username]
+
+
+class PresenceBroadcaster:
+    """
+    Regroupe les arrivées/départs d'une salle pendant ``debounce`` secondes
+    et les diffuse en un seul événement ``presence_delta``.
+
+    Une arrivée suivie d'un départ dans la même fenêtre (ou l'inverse) ne
+    produit rien. Au plus une fois par ``snapshot_interval``, le delta
+    embarque aussi la liste complète, ce qui efface les fantômes laissés
+    par un worker planté (qui n'a jamais pu annoncer leur départ).
+    """
+
+    def __init__(self, store, debounce=0.25, snapshot_interval=30):
+        self.store = store
+        self.debounce = debounce
+        self.snapshot_interval = snapshot_interval
+        self.pending = {}        # room_name -> {'joined': {username: info}, 'left': set()}
+        self.tasks = {}
+        self.last_snapshot = {}  # room_name -> time.monotonic()
+
+    def joined(self, room_name, username, info):
+        pending = self._pending(room_name)
+        if username in pending['left']:
+            pending['left'].discard(username)  # simple reconnexion
+        else:
+            pending['joined'][username] = info
+        self._schedule(room_name)
+
+    def left(self, room_name, username):
+        pending = self._pending(room_name)
+        if username in pending['joined']:
+            del pending['joined'][username]  # jamais annoncé
+        else:
+            pending['left'].add(username)
+        self._schedule(room_name)
+
+    def _pending(self, room_name):
+        return self.pending.setdefault(room_name, {'joined': {}, 'left': set()})
+
+    def _schedule(self, room_name):
+        task = self.tasks.get(room_name)
+        if task is None or task.done():
+            self.tasks[room_name] = asyncio.ensure_future(self._flush_later(room_name))
+
+    async def _flush_later(self, room_name):
+        await asyncio.sleep(self.debounce)
+        self.tasks.pop(room_name, None)
+        pending = self.pending.pop(room_name, None)
+        if pending is None:
+            return
+        try:
+            await self.flush(room_name, pending)
+        except Exception:
+            logger.exception('Échec de la diffusion de présence pour %s', room_name)
+
+    async def flush(self, room_name, pending):
+        snapshot = None
+        now = time.monotonic()
+        if now - self.last_snapshot.get(room_name, 0) >= self.snapshot_interval:
+            self.last_snapshot[room_name] = now
+            snapshot = member_list(await self.store.members(room_name))
+        if not pending['joined'] and not pending['left'] and snapshot is None:
+            return
+        event = {
+            'type': 'presence_delta',
+            'joined': member_list(pending['joined']),
+            'left': sorted(pending['left']),
+            'snapshot': snapshot,
+        }
+        # Trame identique pour tous les membres : encodée une seule fois
+        event['text'] = json.dumps(event)
+        event['key'] = uuid.uuid4().hex  # mémo d'encodage des autres protocoles
+        from .relay import room_group_send  # relay importe ce module
+        await room_group_send(room_name, event)
+
+
+def _channel_layer_redis_url():
+    """Réutilise l'hôte Redis configuré pour le channel layer par défaut"""
+    config = settings.CHANNEL_LAYERS.get('default', {}).get('CONFIG', {})
+    hosts = config.get('hosts') or ['redis://localhost:6379']
+    host = hosts[0]
+    if isinstance(host, dict):
+        host = host.get('address', 'redis://localhost:6379')
+    if isinstance(host, (list, tuple)):
+        host = f'redis://{host[0]}:{host[1]}'
+    return host
+
+
+_store = None
+_broadcaster = None
+
+
+def _config():
+    return {**DEFAULT_PRESENCE, **getattr(settings, 'CHAT_PRESENCE', {})}
+
+
+def get_presence_store():
+    """Instance unique (par processus) du registre configuré"""
+    global _store
+    if _store is None:
+        config = _config()
+        backend = import_string(config['BACKEND'])
+        _store = backend(**config['OPTIONS'])
+    return _store
+
+
+def get_presence_broadcaster():
+    """Diffuseur de deltas de présence (un par processus)"""
+    global _broadcaster
+    if _broadcaster is None:
+        config = _config()
+        _broadcaster = PresenceBroadcaster(
+            get_presence_store(),
+            debounce=config['DEBOUNCE'],
+            snapshot_interval=config['SNAPSHOT_INTERVAL'],
+        )
+    return _broadcaster
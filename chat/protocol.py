@@ -0,0 +1,292 @@
+# chat/protocol.py
+"""
+Protocoles WebSocket négociés à la connexion (Sec-WebSocket-Protocol).
+
+- ``chat.v1.json``    : JSON verbeux, celui de templates/chat/room.html.
+                        Utilisé aussi quand le client n'annonce rien.
+- ``chat.v1.compact`` : JSON à clés courtes ; les couples (username, avatar)
+                        sont remplacés par un entier ``ui``.
+- ``chat.v1.msgpack`` : comme compact, en trames binaires MessagePack
+                        (proposé seulement si le paquet msgpack est installé).
+
+En mode compact, un utilisateur est d'abord décrit par une trame
+``{"t": "us", "d": [[ui, username, avatar], ...]}``, envoyée une seule fois
+par connexion, avant la première trame qui y fait référence. Les numéros sont
+attribués par le worker, si bien qu'une trame diffusée est encodée une seule
+fois par worker et par protocole (``ENCODE_MEMO``), puis envoyée telle quelle.
+Le client calcule lui-même ``is_current_user`` en comparant ``username``.
+
+Avec la fonctionnalité ``batch`` (``?features=batch``), les trames d'une
+salle très active peuvent arriver regroupées : ``{"type": "batch",
+"frames": [...]}``, à traiter dans l'ordre (voir chat/outbound.py). Le
+regroupement se fait sur les trames déjà encodées, sans les relire.
+
+Une nouvelle version du protocole (``chat.v2...``) s'ajoute à
+supported_protocols() sans changer le comportement des clients existants.
+"""
+import importlib.util
+import json
+from collections import OrderedDict
+
+JSON = 'chat.v1.json'
+COMPACT = 'chat.v1.compact'
+MSGPACK = 'chat.v1.msgpack'
+
+KEYS = {
+    'type': 't',
+    'id': 'i',
+    'cid': 'c',
+    'cids': 'cs',
+    'message': 'm',
+    'messages': 'ms',
+    'timestamp': 'ts',
+    'next_cursor': 'nc',
+    'cursor': 'cu',
+    'limit': 'li',
+    'client_id': 'ci',
+    'online_users': 'ou',
+    'joined': 'j',
+    'left': 'l',
+    'snapshot': 's',
+    'bio': 'b',
+    'updates': 'up',
+    'status': 'st',
+    'up_to': 'ut',
+    'error': 'e',
+    'resume_after': 'ra',
+    'retry_after': 'rt',
+    'reason': 'rs',
+    'frames': 'f',
+}
+
+TYPES = {
+    'chat_message': 'cm',
+    'old_message': 'om',
+    'history_batch': 'hb',
+    'history_page': 'hp',
+    'messages_committed': 'mc',
+    'messages_failed': 'mf',
+    'message_status_batch': 'sb',
+    'presence_delta': 'pd',
+    'online_users': 'ou',
+    'room_deleted': 'rd',
+    'load_before': 'lb',
+    'receipt': 'rc',
+    'error': 'er',
+    'slow_consumer': 'sc',
+    'resume': 're',
+    'resync_required': 'rr',
+    'reconnect': 'rn',
+    'batch': 'ba',
+}
+
+LONG_KEYS = {short: key for key, short in KEYS.items()}
+LONG_TYPES = {short: name for name, short in TYPES.items()}
+
+# Numéros d'utilisateurs retenus par le worker, et trames mémorisées
+MAX_INTERNED_USERS = 20000
+ENCODE_MEMO = 512
+
+
+class UserTable:
+    """(username, avatar) -> numéro, jamais réutilisé (un avatar modifié reçoit un nouveau numéro)"""
+
+    def __init__(self, max_entries=MAX_INTERNED_USERS):
+        self.max_entries = max_entries
+        self.ids = OrderedDict()
+        self.next_id = 1
+
+    def intern(self, username, avatar):
+        key = (username, avatar)
+        user_id = self.ids.get(key)
+        if user_id is None:
+            user_id = self.ids[key] = self.next_id
+            self.next_id += 1
+            while len(self.ids) > self.max_entries:
+                self.ids.popitem(last=False)
+        else:
+            self.ids.move_to_end(key)
+        return user_id
+
+
+class JsonCodec:
+    name = JSON
+    binary = False
+
+    def dumps(self, frame):
+        return json.dumps(frame)
+
+    def loads(self, text_data=None, bytes_data=None):
+        return json.loads(text_data if text_data is not None else bytes_data)
+
+    def join(self, payloads):
+        """Trame batch formée de trames déjà encodées"""
+        return '{"type": "batch", "frames": [' + ', '.join(payloads) + ']}'
+
+
+class CompactCodec(JsonCodec):
+    name = COMPACT
+
+    def __init__(self, users):
+        self.users = users
+
+    def dumps(self, frame):
+        return json.dumps(frame, separators=(',', ':'))
+
+    def compact(self, value, refs):
+        """Clés et types courts, utilisateurs remplacés par leur numéro"""
+        if isinstance(value, list):
+            return [self.compact(item, refs) for item in value]
+        if not isinstance(value, dict):
+            return value
+        out = {}
+        if 'username' in value and 'avatar' in value:
+            user_id = self.users.intern(value['username'], value['avatar'])
+            refs[user_id] = (value['username'], value['avatar'])
+            out['ui'] = user_id
+        for key, item in value.items():
+            if key in ('username', 'avatar') and 'ui' in out:
+                continue
+            if key == 'type':
+                item = TYPES.get(item, item)
+            out[KEYS.get(key, key)] = self.compact(item, refs)
+        return out
+
+    def expand(self, value):
+        """Trame entrante : retour aux clés longues"""
+        if isinstance(value, list):
+            return [self.expand(item) for item in value]
+        if not isinstance(value, dict):
+            return value
+        out = {}
+        for key, item in value.items():
+            key = LONG_KEYS.get(key, key)
+            if key == 'type':
+                item = LONG_TYPES.get(item, item)
+            out[key] = self.expand(item)
+        return out
+
+    def encode(self, frame):
+        """Retourne (trame encodée, {numéro: (username, avatar)} référencés)"""
+        refs = {}
+        return self.dumps(self.compact(frame, refs)), refs
+
+    def encode_users(self, refs):
+        return self.dumps({
+            't': 'us',
+            'd': [[user_id, username, avatar] for user_id, (username, avatar) in refs.items()],
+        })
+
+    def join(self, payloads):
+        return '{"t":"ba","f":[' + ','.join(payloads) + ']}'
+
+    def loads(self, text_data=None, bytes_data=None):
+        return self.expand(super().loads(text_data, bytes_data))
+
+
+class MsgpackCodec(CompactCodec):
+    name = MSGPACK
+    binary = True
+
+    def dumps(self, frame):
+        import msgpack
+        return msgpack.packb(frame, use_bin_type=True)
+
+    def join(self, payloads):
+        # Table {"t": "ba", "f": [...]} écrite à la main : les éléments sont
+        # déjà des objets MessagePack complets, mis bout à bout
+        count = len(payloads)
+        if count < 16:
+            header = bytes([0x90 | count])
+        elif count < 1 << 16:
+            header = b'\xdc' + count.to_bytes(2, 'big')
+        else:
+            header = b'\xdd' + count.to_bytes(4, 'big')
+        return b'\x82\xa1t\xa2ba\xa1f' + header + b''.join(payloads)
+
+    def loads(self, text_data=None, bytes_data=None):
+        import msgpack
+        if bytes_data is None:
+            return super().loads(text_data)
+        return self.expand(msgpack.unpackb(bytes_data, raw=False))
+
+
+def msgpack_available():
+    return importlib.util.find_spec('msgpack') is not None
+
+
+_users = UserTable()
+_memo = OrderedDict()  # (clé de trame, protocole) -> (trame encodée, refs)
+
+
+def supported_protocols():
+    """Protocoles proposés par ce worker"""
+    protocols = [JSON, COMPACT]
+    if msgpack_available():
+        protocols.append(MSGPACK)
+    return protocols
+
+
+def negotiate(offered):
+    """
+    Premier protocole annoncé par le client que le serveur connaît.
+    Aucun protocole annoncé : JSON. Aucun en commun : None (connexion refusée).
+    """
+    if not offered:
+        return None, ProtocolSession(JsonCodec())
+    supported = supported_protocols()
+    for name in offered:
+        if name in supported:
+            return name, ProtocolSession(make_codec(name))
+    return None, None
+
+
+def make_codec(name):
+    if name == MSGPACK:
+        return MsgpackCodec(_users)
+    if name == COMPACT:
+        return CompactCodec(_users)
+    return JsonCodec()
+
+
+class ProtocolSession:
+    """État du protocole pour une connexion : codec et utilisateurs déjà décrits"""
+
+    def __init__(self, codec):
+        self.codec = codec
+        self.is_json = codec.name == JSON
+        self.known_users = set()
+
+    def decode(self, text_data=None, bytes_data=None):
+        return self.codec.loads(text_data, bytes_data)
+
+    def join(self, payloads):
+        """Une trame batch pour plusieurs trames encodées (même ordre)"""
+        return self.codec.join(payloads)
+
+    def encode(self, frame, memo_key=None, text=None):
+        """
+        Trames à envoyer pour ``frame`` (str ou bytes), définitions d'utilisateurs
+        comprises. ``text`` est la version JSON déjà encodée, si elle existe ;
+        ``memo_key`` identifie une trame diffusée, encodée une fois par worker.
+        """
+        if self.is_json:
+            return [text if text is not None else self.codec.dumps(frame)]
+        if memo_key is None:
+            body, refs = self.codec.encode(frame)
+        else:
+            key = (memo_key, self.codec.name)
+            cached = _memo.get(key)
+            if cached is None:
+                cached = _memo[key] = self.codec.encode(frame)
+                while len(_memo) > ENCODE_MEMO:
+                    _memo.popitem(last=False)
+            body, refs = cached
+        unknown = {
+            user_id: ref for user_id, ref in refs.items()
+            if user_id not in self.known_users
+        }
+        if not unknown:
+            return [body]
+        self.known_users.update(unknown)
+        return [self.codec.encode_users(unknown), body]
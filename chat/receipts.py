@@ -0,0 +1,188 @@
+# chat/receipts.py
+"""
+Accusés de réception réels ("Livré" / "Vu").
+
+Les clients envoient ``{"type": "receipt", "status": "seen", "up_to": <id>}``
+pour dire qu'ils ont reçu ou vu tous les messages jusqu'à ``up_to``. Le
+worker regroupe ces accusés par salle pendant WINDOW secondes, puis en une
+seule passe :
+- avance la position de lecture ``RoomReadState`` de chaque lecteur ;
+- envoie à chaque expéditeur concerné une seule trame
+  ``message_status_batch`` avec le plus grand id livré et le plus grand id vu.
+"""
+import asyncio
+import logging
+from collections import OrderedDict
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db.models import Count, Max, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from . import metrics
+from .instrumentation import database_sync_to_async
+from .models import Message, RoomReadState
+from .presence import get_presence_store
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RECEIPTS = {
+    'WINDOW': 0.5,     # secondes de regroupement par salle
+    'BACKFILL': 500,   # nombre maximal de messages marqués par passe
+}
+
+STATUSES = ('delivered', 'seen')
+
+# Dernier id déjà traité par (salle, lecteur), pour ne pas repartir de zéro
+MAX_MARKS = 20000
+
+receipts_received = metrics.counter('chat_receipts_received_total', 'Accusés reçus des clients')
+receipt_frames = metrics.counter('chat_receipt_frames_total', 'Trames de statut envoyées aux expéditeurs')
+
+
+class ReceiptAggregator:
+
+    def __init__(self, window=0.5, backfill=500):
+        self.window = window
+        self.backfill = backfill
+        # room_id -> {'room_name': ..., 'viewers': {viewer_id: {'delivered': id, 'seen': id}}}
+        self.pending = {}
+        self.tasks = {}
+        self.marks = OrderedDict()  # (room_id, viewer_id) -> {'delivered': id, 'seen': id}
+
+    def record(self, room_id, room_name, viewer_id, status, up_to):
+        receipts_received.inc()
+        room = self.pending.setdefault(room_id, {'room_name': room_name, 'viewers': {}})
+        viewer = room['viewers'].setdefault(viewer_id, {'delivered': 0, 'seen': 0})
+        viewer[status] = max(viewer[status], up_to)
+        task = self.tasks.get(room_id)
+        if task is None or task.done():
+            self.tasks[room_id] = asyncio.ensure_future(self._flush_later(room_id))
+
+    async def _flush_later(self, room_id):
+        await asyncio.sleep(self.window)
+        self.tasks.pop(room_id, None)
+        room = self.pending.pop(room_id, None)
+        if room is None:
+            return
+        try:
+            per_sender = await self._apply(room_id, room['viewers'])
+            await self._notify(room['room_name'], per_sender)
+        except Exception:
+            logger.exception('Échec du traitement des accusés pour la salle %s', room_id)
+
+    @database_sync_to_async
+    def _apply(self, room_id, viewers):
+        """Avance les positions de lecture et calcule, par expéditeur, les id livrés/vus"""
+        # up_to vient du client : jamais au-delà du dernier message de la salle,
+        # sinon la position de lecture bloquerait toutes les avances suivantes
+        latest = Message.objects.filter(room_id=room_id).aggregate(latest=Max('id'))['latest'] or 0
+        for ups in viewers.values():
+            ups['seen'] = min(ups['seen'], latest)
+            ups['delivered'] = min(max(ups['delivered'], ups['seen']), latest)  # vu implique livré
+        unknown = [v for v in viewers if (room_id, v) not in self.marks]
+        if unknown:
+            stored = dict(
+                RoomReadState.objects.filter(room_id=room_id, user_id__in=unknown)
+                .values_list('user_id', 'last_read_message_id')
+            )
+            for viewer_id in unknown:
+                last_read = stored.get(viewer_id, 0)
+                self.marks[(room_id, viewer_id)] = {'delivered': last_read, 'seen': last_read}
+        lows = {viewer_id: self.marks[(room_id, viewer_id)] for viewer_id in viewers}
+
+        high = max(ups['delivered'] for ups in viewers.values())
+        low = min(min(mark.values()) for mark in lows.values())
+        low = max(low, high - self.backfill)
+        rows = list(
+            Message.objects.filter(room_id=room_id, id__gt=low, id__lte=high)
+            .values_list('id', 'user_id', 'user__username')
+        )
+
+        per_sender = {}
+        advanced = {}
+        for viewer_id, ups in viewers.items():
+            mark = lows[viewer_id]
+            if ups['seen'] > mark['seen']:
+                advanced[viewer_id] = ups['seen']
+            for message_id, author_id, author in rows:
+                if author_id == viewer_id:
+                    continue
+                sender = per_sender.setdefault(author, {'delivered': 0, 'seen': 0})
+                if mark['seen'] < message_id <= ups['seen']:
+                    sender['seen'] = max(sender['seen'], message_id)
+                if mark['delivered'] < message_id <= ups['delivered']:
+                    sender['delivered'] = max(sender['delivered'], message_id)
+            self._set_mark(room_id, viewer_id, {
+                status: max(mark[status], ups[status]) for status in STATUSES
+            })
+
+        self._advance_read_states(room_id, advanced)
+        return per_sender
+
+    def _advance_read_states(self, room_id, seen):
+        """
+        Positions de lecture : création groupée, puis avance sans jamais
+        reculer. Le compteur de non-lus est recalculé dans la même requête ;
+        le lecteur étant à jour, il ne reste que quelques messages à compter.
+        """
+        if not seen:
+            return
+        RoomReadState.objects.bulk_create(
+            [RoomReadState(user_id=viewer_id, room_id=room_id) for viewer_id in seen],
+            ignore_conflicts=True,
+        )
+        for viewer_id, up_to in seen.items():
+            unread = (
+                Message.objects
+                .filter(room_id=room_id, id__gt=up_to)
+                .exclude(user_id=viewer_id)
+                .order_by()
+                .values('room')
+                .annotate(count=Count('id'))
+                .values('count')
+            )
+            RoomReadState.objects.filter(
+                user_id=viewer_id, room_id=room_id, last_read_message_id__lt=up_to
+            ).update(
+                last_read_message_id=up_to,
+                unread_count=Coalesce(Subquery(unread), 0),
+                updated_at=timezone.now(),
+            )
+
+    def _set_mark(self, room_id, viewer_id, mark):
+        self.marks[(room_id, viewer_id)] = mark
+        self.marks.move_to_end((room_id, viewer_id))
+        while len(self.marks) > MAX_MARKS:
+            self.marks.popitem(last=False)
+
+    async def _notify(self, room_name, per_sender):
+        """Une trame par expéditeur (et par connexion ouverte), quel que soit le nombre d'accusés"""
+        store = get_presence_store()
+        channel_layer = get_channel_layer()
+        for sender, ups in per_sender.items():
+            updates = [
+                {'status': status, 'up_to': ups[status]}
+                for status in STATUSES if ups[status]
+            ]
+            if not updates:
+                continue
+            for channel_name in await store.channels_for(room_name, sender):
+                receipt_frames.inc()
+                await channel_layer.send(channel_name, {
+                    'type': 'message_status_batch',
+                    'updates': updates,
+                })
+
+
+_aggregator = None
+
+
+def get_receipt_aggregator():
+    """Agrégateur unique (par processus) configuré via settings.CHAT_RECEIPTS"""
+    global _aggregator
+    if _aggregator is None:
+        config = {**DEFAULT_RECEIPTS, **getattr(settings, 'CHAT_RECEIPTS', {})}
+        _aggregator = ReceiptAggregator(window=config['WINDOW'], backfill=config['BACKFILL'])
+    return _aggregator
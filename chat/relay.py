@@ -0,0 +1,172 @@
+# chat/relay.py
+"""
+Diffusion hiérarchique pour les grandes salles.
+
+Chaque consumer reste membre du groupe direct ``chat_<salle>`` ; en plus,
+chaque worker abonne UN canal relais au groupe ``chat_<salle>__relay`` tant
+qu'il a au moins une connexion locale dans la salle. Pour une salle de plus
+de RELAY_THRESHOLD membres, ``room_group_send`` publie dans le groupe relais :
+le channel layer livre alors un seul message par worker, que le relais
+distribue lui-même à ses consumers locaux, en mémoire.
+
+Comme les deux chemins sont toujours en place, le choix se fait côté
+émetteur sans coordination ; il est mis en cache DECISION_TTL secondes, avec
+une hystérésis (retour au groupe direct sous la moitié du seuil) pour éviter
+les bascules répétées autour du seuil.
+"""
+import asyncio
+import logging
+import time
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from . import metrics
+from .presence import get_presence_store
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FANOUT = {
+    'RELAY_THRESHOLD': 200,   # membres à partir desquels le relais est utilisé
+    'DECISION_TTL': 5,        # secondes
+}
+
+# Lecture du canal relais en échec (Redis déconnecté...) : nouvel essai après
+# un délai qui double jusqu'au plafond
+RETRY_MIN_DELAY = 0.1
+RETRY_MAX_DELAY = 5.0
+
+relay_publishes = metrics.counter('chat_relay_publishes_total', 'Événements publiés via les relais de worker')
+relay_deliveries = metrics.counter('chat_relay_local_deliveries_total', 'Livraisons locales par les relais')
+
+
+def direct_group(room_name):
+    return f'chat_{room_name}'
+
+
+def relay_group(room_name):
+    return f'chat_{room_name}__relay'
+
+
+class RoomRelay:
+    """Relais d'un worker : un canal, abonné aux groupes relais de ses salles"""
+
+    def __init__(self, threshold=200, decision_ttl=5, channel_layer=None, store=None):
+        self.threshold = threshold
+        self.decision_ttl = decision_ttl
+        self._channel_layer = channel_layer
+        self._store = store
+        self.local = {}       # room_name -> set de consumers locaux
+        self.decisions = {}   # room_name -> (expire_at, grande salle ?)
+        self.channel_name = None
+        self._task = None
+        self._ready = None
+        self._loop = None
+
+    @property
+    def channel_layer(self):
+        return self._channel_layer or get_channel_layer()
+
+    @property
+    def store(self):
+        return self._store or get_presence_store()
+
+    async def _ensure_channel(self):
+        """Canal relais ouvert une seule fois par boucle d'événements"""
+        loop = asyncio.get_running_loop()
+        if self._ready is None or self._loop is not loop:
+            self._loop = loop
+            self._ready = asyncio.ensure_future(self._open_channel())
+        await self._ready
+        if self._task.done():
+            # Boucle de lecture arrêtée malgré tout : la relancer
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _open_channel(self):
+        self.channel_name = await self.channel_layer.new_channel(prefix='relay.')
+        self._task = asyncio.ensure_future(self._run())
+        # Nouveau canal : se réabonner aux salles déjà suivies
+        for room_name in self.local:
+            await self.channel_layer.group_add(relay_group(room_name), self.channel_name)
+
+    async def attach(self, room_name, consumer):
+        await self._ensure_channel()
+        consumers = self.local.setdefault(room_name, set())
+        consumers.add(consumer)
+        # Réabonnement à chaque arrivée : prolonge aussi l'expiration du groupe
+        await self.channel_layer.group_add(relay_group(room_name), self.channel_name)
+
+    async def detach(self, room_name, consumer):
+        consumers = self.local.get(room_name)
+        if not consumers:
+            return
+        consumers.discard(consumer)
+        if not consumers:
+            del self.local[room_name]
+            if self.channel_name is not None:
+                await self.channel_layer.group_discard(relay_group(room_name), self.channel_name)
+
+    async def _run(self):
+        channel_layer = self.channel_layer
+        delay = RETRY_MIN_DELAY
+        while True:
+            try:
+                event = await channel_layer.receive(self.channel_name)
+            except Exception:
+                logger.exception('Lecture du canal relais impossible, nouvel essai dans %.1f s', delay)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, RETRY_MAX_DELAY)
+                continue
+            delay = RETRY_MIN_DELAY
+            try:
+                await self.deliver(event)
+            except Exception:
+                logger.exception('Échec de la distribution locale pour %s', event.get('room'))
+
+    async def deliver(self, event):
+        """Distribue un événement relayé aux consumers locaux de la salle"""
+        for consumer in list(self.local.get(event['room'], ())):
+            relay_deliveries.inc()
+            try:
+                await consumer.relay_event(event)
+            except Exception:
+                logger.exception('Échec de la livraison relayée à %s', consumer)
+
+    async def is_large(self, room_name):
+        now = time.monotonic()
+        decision = self.decisions.get(room_name)
+        if decision is not None and decision[0] > now:
+            return decision[1]
+        count = await self.store.count(room_name)
+        was_large = decision is not None and decision[1]
+        large = count >= self.threshold or (was_large and count >= self.threshold // 2)
+        self.decisions[room_name] = (now + self.decision_ttl, large)
+        return large
+
+    async def group_send(self, room_name, event):
+        """group_send vers la salle, via les relais de worker si elle est grande"""
+        event['room'] = room_name
+        if await self.is_large(room_name):
+            relay_publishes.inc()
+            await self.channel_layer.group_send(relay_group(room_name), event)
+        else:
+            await self.channel_layer.group_send(direct_group(room_name), event)
+
+
+_relay = None
+
+
+def get_room_relay():
+    """Relais unique (par processus) configuré via settings.CHAT_FANOUT"""
+    global _relay
+    if _relay is None:
+        config = {**DEFAULT_FANOUT, **getattr(settings, 'CHAT_FANOUT', {})}
+        _relay = RoomRelay(
+            threshold=config['RELAY_THRESHOLD'],
+            decision_ttl=config['DECISION_TTL'],
+        )
+    return _relay
+
+
+async def room_group_send(room_name, event):
+    await get_room_relay().group_send(room_name, event)
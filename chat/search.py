@@ -0,0 +1,252 @@
+# chat/search.py
+"""
+Recherche plein texte dans les messages des salles visibles par l'utilisateur.
+
+S'appuie sur l'index créé par la migration 0008 :
+- SQLite : FTS5 (classement bm25) ;
+- PostgreSQL : colonne ``search_vector`` + GIN (ts_rank_cd, ts_headline) ;
+- autres bases : ``icontains`` sans classement, du plus récent au plus ancien.
+
+Tous les mots doivent apparaître, le dernier comme préfixe (recherche au fil
+de la frappe). Les résultats sont triés par pertinence puis par id décroissant
+et paginés par clé : le curseur porte (score, id) du dernier résultat, si bien
+qu'une page suivante ne relit pas les précédentes. Les extraits ne sont
+calculés que pour les résultats de la page (ts_headline sous PostgreSQL,
+make_snippet ailleurs : snippet() de FTS5 relirait toutes les correspondances).
+
+Seules les MAX_CANDIDATES correspondances les plus récentes sont classées :
+l'index les fournit dans l'ordre des id sans calcul de score, si bien qu'un
+mot présent dans des millions de messages coûte autant qu'un mot rare. Au-delà,
+les messages plus anciens ne sont trouvés qu'avec des mots plus précis ou
+le filtre par salle.
+"""
+import base64
+import binascii
+import json
+import re
+import unicodedata
+
+from django.db import connection
+from django.db.models import Q
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+
+from accounts.profiles import DEFAULT_AVATAR_URL, get_profile_cache
+
+SEARCH_PAGE_SIZE = 20
+SEARCH_PAGE_MAX = 50
+MAX_TERMS = 8
+MIN_TERM_LENGTH = 2
+# Correspondances classées au plus par recherche : les plus récentes
+MAX_CANDIDATES = 5000
+
+# Délimiteurs des passages trouvés, remplacés par <mark> après échappement HTML
+START_MARK = '\x02'
+STOP_MARK = '\x03'
+
+WORD_RE = re.compile(r'\w+')
+SNIPPET_WORDS = 16
+
+
+def parse_terms(text):
+    """Mots de la requête ; la syntaxe propre à chaque moteur est ignorée"""
+    terms = [term.lower() for term in WORD_RE.findall(text or '')]
+    return [term for term in terms if len(term) >= MIN_TERM_LENGTH][:MAX_TERMS]
+
+
+def encode_cursor(rank, message_id):
+    raw = json.dumps([rank, message_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """(score, id) ; ValueError si le curseur est invalide"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        rank, message_id = json.loads(base64.urlsafe_b64decode(padded))
+        return float(rank), int(message_id)
+    except (binascii.Error, TypeError, ValueError, UnicodeDecodeError):
+        raise ValueError('Curseur de recherche invalide')
+
+
+def fold(word):
+    """Minuscules sans accents, comme le tokenizer FTS5 (remove_diacritics)"""
+    decomposed = unicodedata.normalize('NFKD', word.lower())
+    return ''.join(char for char in decomposed if not unicodedata.combining(char))
+
+
+def make_snippet(content, terms):
+    """
+    Extrait de SNIPPET_WORDS mots autour du premier passage trouvé, passages
+    délimités par START_MARK / STOP_MARK (calculé seulement pour la page).
+    """
+    folded = [fold(term) for term in terms]
+    words = list(WORD_RE.finditer(content))
+
+    def matches(word):
+        value = fold(word)
+        return any(value == term for term in folded) or value.startswith(folded[-1])
+
+    hits = [index for index, word in enumerate(words) if matches(word.group())]
+    if not hits:
+        return content[:200]
+    first = max(0, hits[0] - SNIPPET_WORDS // 4)
+    last = min(len(words), first + SNIPPET_WORDS) - 1
+    start = 0 if first == 0 else words[first].start()
+    end = len(content) if last == len(words) - 1 else words[last].end()
+    parts, position = [], start
+    for index in hits:
+        if first <= index <= last:
+            word = words[index]
+            parts += [content[position:word.start()], START_MARK, word.group(), STOP_MARK]
+            position = word.end()
+    parts.append(content[position:end])
+    return ('…' if start else '') + ''.join(parts) + ('…' if end < len(content) else '')
+
+
+def highlight(snippet):
+    """Extrait échappé, passages trouvés entre <mark>"""
+    html = escape(snippet).replace(START_MARK, '<mark>').replace(STOP_MARK, '</mark>')
+    return mark_safe(html)
+
+
+def visible_rooms(user):
+    """Salles publiques et salles privées créées par l'utilisateur"""
+    from .models import ChatRoom
+
+    return ChatRoom.objects.filter(Q(is_private=False) | Q(creator=user))
+
+
+def _rooms_sql(user, room_name):
+    rooms = visible_rooms(user)
+    if room_name:
+        rooms = rooms.filter(name=room_name)
+    return rooms.values('id').query.sql_with_params()
+
+
+def _search_sqlite(terms, rooms_sql, rooms_params, after, limit):
+    # CROSS JOIN : l'index FTS mène la boucle, dans l'ordre des id décroissants.
+    # bm25 : plus petit = plus pertinent
+    match = ' '.join('"{}"'.format(term) for term in terms) + '*'
+    keyset, keyset_params = '', []
+    if after is not None:
+        keyset = 'WHERE rank > %s OR (rank = %s AND id < %s)'
+        keyset_params = [after[0], after[0], after[1]]
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            SELECT id, rank FROM (
+                SELECT chat_message_fts.rowid AS id, bm25(chat_message_fts) AS rank
+                FROM chat_message_fts
+                CROSS JOIN chat_message m ON m.id = chat_message_fts.rowid
+                WHERE chat_message_fts MATCH %s AND m.room_id IN ({rooms_sql})
+                ORDER BY chat_message_fts.rowid DESC
+                LIMIT %s
+            ) {keyset}
+            ORDER BY rank, id DESC
+            LIMIT %s
+            """,
+            [match, *rooms_params, MAX_CANDIDATES, *keyset_params, limit + 1],
+        )
+        rows = cursor.fetchall()
+    return rows, {}
+
+
+def _search_postgres(terms, rooms_sql, rooms_params, after, limit):
+    # ts_rank_cd : plus grand = plus pertinent
+    query = ' & '.join(terms) + ':*'
+    keyset, keyset_params = '', []
+    if after is not None:
+        keyset = 'WHERE rank < %s OR (rank = %s AND id < %s)'
+        keyset_params = [after[0], after[0], after[1]]
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            SELECT id, rank, ts_headline(
+                'simple', content, query,
+                'StartSel="{START_MARK}", StopSel="{STOP_MARK}", MaxWords=24, MinWords=8'
+            )
+            FROM (
+                SELECT m.id, m.content, q.query, ts_rank_cd(m.search_vector, q.query) AS rank
+                FROM (
+                    SELECT id, content, search_vector
+                    FROM chat_message
+                    WHERE search_vector @@ to_tsquery('simple', %s) AND room_id IN ({rooms_sql})
+                    ORDER BY id DESC
+                    LIMIT %s
+                ) m, to_tsquery('simple', %s) AS q(query)
+            ) found
+            {keyset}
+            ORDER BY rank DESC, id DESC
+            LIMIT %s
+            """,
+            [query, *rooms_params, MAX_CANDIDATES, query, *keyset_params, limit + 1],
+        )
+        rows = cursor.fetchall()
+    return [row[:2] for row in rows], {row[0]: row[2] for row in rows}
+
+
+def _search_fallback(user, terms, room_name, after, limit):
+    from .models import Message
+
+    queryset = Message.objects.filter(room__in=visible_rooms(user))
+    if room_name:
+        queryset = queryset.filter(room__name=room_name)
+    for term in terms:
+        queryset = queryset.filter(content__icontains=term)
+    if after is not None:
+        queryset = queryset.filter(id__lt=after[1])
+    ids = queryset.order_by('-id').values_list('id', flat=True)[:limit + 1]
+    return [(message_id, 0.0) for message_id in ids], {}
+
+
+def search_messages(user, text, cursor=None, limit=SEARCH_PAGE_SIZE, room_name=None):
+    """
+    Page de résultats et curseur de la page suivante (ou None).
+    Chaque résultat : id, room, username, avatar, timestamp, message et
+    snippet (HTML sûr). ValueError si le curseur est invalide.
+    """
+    from .models import Message
+
+    terms = parse_terms(text)
+    if not terms:
+        return [], None
+    limit = max(1, min(int(limit), SEARCH_PAGE_MAX))
+    after = decode_cursor(cursor) if cursor else None
+
+    vendor = connection.vendor
+    if vendor in ('sqlite', 'postgresql'):
+        rooms_sql, rooms_params = _rooms_sql(user, room_name)
+        backend = _search_sqlite if vendor == 'sqlite' else _search_postgres
+        rows, snippets = backend(terms, rooms_sql, rooms_params, after, limit)
+    else:
+        rows, snippets = _search_fallback(user, terms, room_name, after, limit)
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    messages = {
+        message['id']: message
+        for message in Message.objects.filter(id__in=[row[0] for row in rows]).values(
+            'id', 'content', 'timestamp', 'user__username', 'room__name',
+        )
+    }
+    profiles = get_profile_cache().get_many({m['user__username'] for m in messages.values()})
+    results = []
+    for message_id, rank in rows:
+        message = messages.get(message_id)
+        if message is None:  # supprimé entre les deux requêtes
+            continue
+        username = message['user__username']
+        results.append({
+            'id': message_id,
+            'room': message['room__name'],
+            'username': username,
+            'avatar': profiles.get(username, {}).get('avatar', DEFAULT_AVATAR_URL),
+            'timestamp': message['timestamp'],
+            'message': message['content'],
+            'snippet': highlight(
+                snippets.get(message_id) or make_snippet(message['content'], terms)
+            ),
+        })
+    next_cursor = encode_cursor(rows[-1][1], rows[-1][0]) if has_more else None
+    return results, next_cursor
@@ -1,3 +1,1955 @@
-from django.test import TestCase
+import asyncio
+import csv
+import gzip
+import hashlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+import uuid
+from contextlib import asynccontextmanager
+from datetime import timedelta
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings as django_settings
+from django.core.cache import caches
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from accounts import last_seen, profiles
+from accounts.models import CustomUser
+from chat import (
+    admission, archive, attachments, consumers, export, history, ingest, instrumentation, metrics,
+    presence, receipts, relay,
+)
+from chat.admission import AdmissionController, AdmissionMiddleware, Rejected
+from chat.archive import archive_expired_messages
+from chat.consumers import ChatConsumer
+from chat.history import fetch_page
+from chat.management.commands.bench_fanout import SinkConsumer
+from chat.models import Attachment, ChatRoom, Message, RoomReadState
+from chat.outbound import OutboundQueue
+from chat.protocol import COMPACT, MSGPACK, ProtocolSession, make_codec, negotiate
+from chat.relay import RoomRelay, direct_group, relay_group
+from chat.search import search_messages
+from chat.routing import websocket_urlpatterns
+
+
+class CountStore:
+    """Registre de présence réduit au nombre de membres"""
+
+    def __init__(self, members):
+        self.members = members
+
+    async def count(self, room_name):
+        return self.members
+
+
+class RecordingConsumer:
+    def __init__(self):
+        self.events = []
+
+    async def relay_event(self, event):
+        self.events.append(event)
+
+
+async def settle():
+    # Laisse les tâches de relais lire leur canal
+    await asyncio.sleep(0.05)
+
+
+class FlakyChannelLayer(InMemoryChannelLayer):
+    """Channel layer dont les premières lectures échouent (Redis déconnecté)"""
+
+    def __init__(self, failures=1, **kwargs):
+        super().__init__(**kwargs)
+        self.failures = failures
+
+    async def receive(self, channel):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError('déconnecté')
+        return await super().receive(channel)
+
+
+class RoomRelayTests(SimpleTestCase):
+    """Plusieurs workers simulés par plusieurs relais sur un même channel layer"""
+
+    def setUp(self):
+        self.layer = InMemoryChannelLayer()
+        self.store = CountStore(members=500)
+
+    def make_worker(self, threshold=100):
+        return RoomRelay(
+            threshold=threshold,
+            decision_ttl=0,
+            channel_layer=self.layer,
+            store=self.store,
+        )
+
+    async def attach(self, worker, count, room_name='big'):
+        consumers = [RecordingConsumer() for _ in range(count)]
+        for consumer in consumers:
+            await worker.attach(room_name, consumer)
+        return consumers
+
+    async def test_large_room_publishes_once_per_worker(self):
+        first, second = self.make_worker(), self.make_worker()
+        local_first = await self.attach(first, 3)
+        local_second = await self.attach(second, 2)
+
+        await first.group_send('big', {'type': 'chat_message_all', 'cid': 'a'})
+        await settle()
+
+        self.assertEqual(len(self.layer.groups[relay_group('big')]), 2)
+        for consumer in local_first + local_second:
+            self.assertEqual([e['cid'] for e in consumer.events], ['a'])
+
+    async def test_small_room_uses_direct_group(self):
+        self.store.members = 3
+        worker = self.make_worker()
+        local = await self.attach(worker, 1)
+        channel = await self.layer.new_channel()
+        await self.layer.group_add(direct_group('big'), channel)
+
+        await worker.group_send('big', {'type': 'chat_message_all', 'cid': 'a'})
+        await settle()
+
+        self.assertEqual((await self.layer.receive(channel))['cid'], 'a')
+        self.assertEqual(local[0].events, [])
+
+    async def test_worker_leaving_stops_its_subscription(self):
+        first, second = self.make_worker(), self.make_worker()
+        local_first = await self.attach(first, 1)
+        local_second = await self.attach(second, 2)
+
+        for consumer in local_second:
+            await second.detach('big', consumer)
+        await first.group_send('big', {'type': 'chat_message_all', 'cid': 'a'})
+        await settle()
+
+        self.assertEqual(list(self.layer.groups[relay_group('big')]), [first.channel_name])
+        self.assertEqual(len(local_first[0].events), 1)
+        self.assertTrue(all(not consumer.events for consumer in local_second))
+        self.assertNotIn('big', second.local)
+
+    async def test_worker_stays_subscribed_while_it_has_local_consumers(self):
+        worker = self.make_worker()
+        staying, leaving = await self.attach(worker, 2)
+
+        await worker.detach('big', leaving)
+        await worker.group_send('big', {'type': 'chat_message_all', 'cid': 'a'})
+        await settle()
+
+        self.assertEqual(len(staying.events), 1)
+        self.assertEqual(leaving.events, [])
+
+    async def test_worker_joining_receives_only_later_events(self):
+        first, second = self.make_worker(), self.make_worker()
+        local_first = await self.attach(first, 1)
+        await first.group_send('big', {'type': 'chat_message_all', 'cid': 'before'})
+        await settle()
+
+        local_second = await self.attach(second, 1)
+        await first.group_send('big', {'type': 'chat_message_all', 'cid': 'after'})
+        await settle()
+
+        self.assertEqual([e['cid'] for e in local_first[0].events], ['before', 'after'])
+        self.assertEqual([e['cid'] for e in local_second[0].events], ['after'])
+
+    async def test_rooms_are_isolated(self):
+        worker = self.make_worker()
+        big = await self.attach(worker, 1, 'big')
+        other = await self.attach(worker, 1, 'other')
+
+        await worker.group_send('big', {'type': 'chat_message_all', 'cid': 'a'})
+        await settle()
+
+        self.assertEqual(len(big[0].events), 1)
+        self.assertEqual(other[0].events, [])
+
+    async def test_relay_survives_a_failed_receive(self):
+        self.layer = FlakyChannelLayer(failures=2)
+        worker = self.make_worker()
+        with self.assertLogs('chat.relay', 'ERROR') as logs:
+            local = await self.attach(worker, 1)
+            await worker.group_send('big', {'type': 'chat_message_all', 'cid': 'a'})
+            await asyncio.sleep(0.5)
+
+        self.assertEqual(len(logs.records), 2)
+        self.assertEqual([e['cid'] for e in local[0].events], ['a'])
+
+    async def test_threshold_hysteresis(self):
+        worker = self.make_worker(threshold=10)
+        self.store.members = 12
+        self.assertTrue(await worker.is_large('big'))
+        self.store.members = 7
+        self.assertTrue(await worker.is_large('big'))
+        self.store.members = 4
+        self.assertFalse(await worker.is_large('big'))
+        self.store.members = 7
+        self.assertFalse(await worker.is_large('big'))
+
+
+class UserScopeMiddleware:
+    def __init__(self, app, user):
+        self.app, self.user = app, user
+
+    async def __call__(self, scope, receive, send):
+        return await self.app(dict(scope, user=self.user), receive, send)
+
+
+async def receive_frames(communicator, timeout=0.3):
+    frames = []
+    while not await communicator.receive_nothing(timeout=timeout):
+        frames.append(json.loads(await communicator.receive_from()))
+    return frames
+
+
+@override_settings(CHAT_FANOUT={'RELAY_THRESHOLD': 1, 'DECISION_TTL': 0})
+class LargeRoomConsumerTests(TransactionTestCase):
+    """Consumers réels en mode relais : chaque trame arrive une seule fois"""
+
+    def setUp(self):
+        relay._relay = None
+        self.room = ChatRoom.objects.create(name='large')
+        self.alice = CustomUser.objects.create_user('alice', password='x')
+        self.bob = CustomUser.objects.create_user('bob', password='x')
+
+    def tearDown(self):
+        relay._relay = None
+
+    async def connect(self, user):
+        app = UserScopeMiddleware(URLRouter(websocket_urlpatterns), user)
+        communicator = WebsocketCommunicator(app, f'/ws/chat/{self.room.name}/')
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        await receive_frames(communicator)
+        return communicator
+
+    async def test_messages_are_delivered_once_through_the_relay(self):
+        alice = await self.connect(self.alice)
+        bob = await self.connect(self.bob)
+        await receive_frames(alice)
+
+        await alice.send_to(text_data=json.dumps({'message': 'bonjour'}))
+        for communicator, is_current_user in ((alice, True), (bob, False)):
+            frames = await receive_frames(communicator)
+            chat = [f for f in frames if f['type'] == 'chat_message']
+            committed = [f for f in frames if f['type'] == 'messages_committed']
+            self.assertEqual(len(chat), 1)
+            self.assertEqual(chat[0]['is_current_user'], is_current_user)
+            self.assertEqual(len(committed), 1)
+
+        self.assertGreater(relay.relay_publishes.value, 0)
+        await alice.disconnect()
+        await bob.disconnect()
+        self.assertEqual(relay.get_room_relay().local, {})
+
+
+# Budgets de requêtes SQL, caches froids : les mêmes quel que soit le volume
+# de données. Un dépassement signale une requête par message, par salle ou
+# par membre (N+1).
+MESSAGE_SIZES = (10, 1000, 100000)
+USER_SIZES = (10, 1000)
+VIEW_BUDGETS = {
+    'lobby': 4,          # session, utilisateur, présents, salles annotées
+    'room': 3,           # session, utilisateur, salle (historique via le WebSocket)
+    'room_history': 4,
+}
+CONSUMER_BUDGETS = {
+    'connect': 2,        # id de la salle, historique
+    'message': 3,        # écriture groupée, non-lus de la salle (transaction comprise)
+    'load_before': 2,    # page, profils des auteurs absents du cache
+    'receipt': 6,        # dernier id, positions de lecture, messages, mise à jour groupée
+    'resume': 1,
+    'disconnect': 0,
+}
+# CHAT_QUERY_BUDGET_REPORT=1 : affiche requêtes et durée de chaque mesure
+REPORT = bool(os.environ.get('CHAT_QUERY_BUDGET_REPORT'))
+
+
+def reset_singletons():
+    """Caches et files par processus repartent à vide (mesures à froid)"""
+    history._cache = None
+    ingest._queue = None
+    presence._store = None
+    presence._broadcaster = None
+    receipts._aggregator = None
+    relay._relay = None
+    profiles._cache = None
+    admission._controller = None
+    # Utilisateurs créés « actifs » : aucune écriture last_seen n'est attendue
+    last_seen.get_last_seen_buffer().pending.clear()
+    caches['profiles'].clear()
+
+
+def populate(message_count, user_count, room_count=5):
+    """Salles, utilisateurs récemment actifs et messages d'auteurs variés"""
+    now = timezone.now()
+    CustomUser.objects.bulk_create([
+        CustomUser(username=f'user{index}', password='!', last_seen=now)
+        for index in range(user_count)
+    ])
+    users = list(CustomUser.objects.order_by('id'))
+    rooms = ChatRoom.objects.bulk_create([
+        ChatRoom(name=f'room{index}', creator=users[index % user_count])
+        for index in range(room_count)
+    ])
+    room = rooms[0]
+    start = now - timedelta(seconds=message_count)
+    Message.objects.bulk_create(
+        (
+            Message(
+                # Un message sur dix dans les autres salles du lobby
+                room=room if index % 10 else rooms[index % room_count],
+                user=users[index % user_count],
+                content=f'message {index}',
+                timestamp=start + timedelta(seconds=index),
+            )
+            for index in range(message_count)
+        ),
+        batch_size=5000,
+    )
+    return room, users
+
+
+def clear():
+    Message.objects.all().delete()
+    RoomReadState.objects.all().delete()
+    ChatRoom.objects.all().delete()
+    CustomUser.objects.all().delete()
+
+
+class BudgetMixin:
+
+    def check_budget(self, budgets, name, size, queries, elapsed):
+        if REPORT:
+            sys.stderr.write(f'\n{name:>14} size={size:<7} queries={len(queries):<3} {elapsed * 1000:8.1f} ms')
+        self.assertLessEqual(
+            len(queries), budgets[name],
+            f'{name} ({size}) : {len(queries)} requêtes, budget {budgets[name]}\n'
+            + '\n'.join(queries),
+        )
+
+
+class ViewQueryBudgetTests(BudgetMixin, TestCase):
+    """Nombre de requêtes des vues HTTP constant quand les données grossissent"""
+
+    def setUp(self):
+        reset_singletons()
+
+    def measure(self, size, room):
+        cursor = fetch_page(room.id, limit=50)[1]
+        urls = {
+            'lobby': reverse('chat:lobby'),
+            'room': reverse('chat:room', args=[room.name]),
+            'room_history': reverse('chat:room_history', args=[room.name])
+            + (f'?before={cursor}' if cursor else ''),
+        }
+        for name, url in urls.items():
+            with CaptureQueriesContext(connection) as context:
+                started = time.perf_counter()
+                response = self.client.get(url)
+                elapsed = time.perf_counter() - started
+            self.assertEqual(response.status_code, 200)
+            queries = [query['sql'] for query in context.captured_queries]
+            self.check_budget(VIEW_BUDGETS, name, size, queries, elapsed)
+
+    def run_sizes(self, sizes, make):
+        for size in sizes:
+            with self.subTest(size=size):
+                reset_singletons()
+                room, users = populate(*make(size))
+                try:
+                    self.client.force_login(users[0])
+                    self.measure(size, room)
+                finally:
+                    clear()
+
+    def test_views_with_growing_history(self):
+        self.run_sizes(MESSAGE_SIZES, lambda size: (size, 10))
+
+    def test_views_with_growing_user_base(self):
+        self.run_sizes(USER_SIZES, lambda size: (1000, size))
+
+
+class QueryRecorder:
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        self.queries.append(sql)
+        return execute(sql, params, many, context)
+
+
+@asynccontextmanager
+async def record_queries():
+    """Requêtes du thread de database_sync_to_async (le thread principal en test)"""
+    recorder = QueryRecorder()
+
+    def install():
+        connection.execute_wrappers.append(recorder)
+
+    def uninstall():
+        connection.execute_wrappers.remove(recorder)
+
+    await sync_to_async(install)()
+    try:
+        yield recorder.queries
+    finally:
+        await sync_to_async(uninstall)()
+
+
+async def receive_until(communicator, frame_type, timeout=5):
+    while True:
+        frame = json.loads(await communicator.receive_from(timeout=timeout))
+        if frame['type'] == frame_type:
+            return frame
+
+
+async def receive_until_close(communicator, timeout=5):
+    """Ignore les trames restantes ; retourne le message de fermeture"""
+    while True:
+        output = await communicator.receive_output(timeout)
+        if output['type'] == 'websocket.close':
+            return output
+
+
+@override_settings(CHAT_RECEIPTS={'WINDOW': 0.01, 'BACKFILL': 500})
+class ConsumerQueryBudgetTests(BudgetMixin, TransactionTestCase):
+    """Nombre de requêtes par événement WebSocket constant quand les données grossissent"""
+
+    def setUp(self):
+        reset_singletons()
+
+    def tearDown(self):
+        reset_singletons()
+
+    @asynccontextmanager
+    async def measure(self, name, size):
+        async with record_queries() as queries:
+            started = time.perf_counter()
+            yield
+            elapsed = time.perf_counter() - started
+        self.check_budget(CONSUMER_BUDGETS, name, size, queries, elapsed)
+
+    def communicator(self, user, room, query=''):
+        app = UserScopeMiddleware(URLRouter(websocket_urlpatterns), user)
+        return WebsocketCommunicator(app, f'/ws/chat/{room.name}/{query}')
+
+    async def run_events(self, size, room, users):
+        alice, bob = users[0], users[1]
+        # Autres membres présents : la liste envoyée à l'arrivée les contient tous
+        store = presence.get_presence_store()
+        for user in users[2:]:
+            await store.add(room.name, f'test.{user.username}', user.username, {
+                'avatar': profiles.DEFAULT_AVATAR_URL, 'bio': '',
+            })
+        cursor = (await sync_to_async(fetch_page)(room.id, limit=50))[1]
+
+        async with self.measure('connect', size):
+            first = self.communicator(alice, room)
+            self.assertTrue((await first.connect())[0])
+            await receive_until(first, 'online_users')
+        second = self.communicator(bob, room)
+        self.assertTrue((await second.connect())[0])
+        await receive_until(second, 'online_users')
+
+        async with self.measure('message', size):
+            await first.send_to(text_data=json.dumps({'message': 'bonjour', 'client_id': 'c1'}))
+            committed = await receive_until(first, 'messages_committed')
+        last_id = committed['messages'][-1]['id']
+
+        async with self.measure('load_before', size):
+            await first.send_to(text_data=json.dumps({'type': 'load_before', 'cursor': cursor}))
+            await receive_until(first, 'history_page')
+
+        async with self.measure('receipt', size):
+            await second.send_to(text_data=json.dumps({
+                'type': 'receipt', 'status': 'seen', 'up_to': last_id,
+            }))
+            await receive_until(first, 'message_status_batch')
+
+        await second.disconnect()
+        async with self.measure('resume', size):
+            second = self.communicator(bob, room, f'?resume_after={last_id - 1}')
+            self.assertTrue((await second.connect())[0])
+            await receive_until(second, 'online_users')
+
+        async with self.measure('disconnect', size):
+            await first.disconnect()
+            await second.disconnect()
+
+    async def run_sizes(self, sizes, make):
+        for size in sizes:
+            with self.subTest(size=size):
+                reset_singletons()
+                room, users = await sync_to_async(populate)(*make(size))
+                try:
+                    await self.run_events(size, room, users)
+                finally:
+                    await sync_to_async(clear)()
+
+    async def test_events_with_growing_history(self):
+        await self.run_sizes(MESSAGE_SIZES, lambda size: (size, 10))
+
+    async def test_events_with_growing_user_base(self):
+        await self.run_sizes(USER_SIZES, lambda size: (1000, size))
+
+
+class SearchTests(TestCase):
+    """Index FTS5 tenu à jour par les triggers de la migration 0008"""
+
+    def setUp(self):
+        self.alice = CustomUser.objects.create_user('alice', password='x')
+        self.bob = CustomUser.objects.create_user('bob', password='x')
+        self.public = ChatRoom.objects.create(name='public')
+        self.secret = ChatRoom.objects.create(name='secret', is_private=True, creator=self.bob)
+
+    def post(self, content, room=None, user=None):
+        return Message.objects.create(room=room or self.public, user=user or self.alice, content=content)
+
+    def test_matches_all_words_with_prefix_and_accents(self):
+        match = self.post('Réunion demain à la cafétéria')
+        self.post('Réunion annulée')
+
+        results, _ = search_messages(self.alice, 'reunion cafet')
+
+        self.assertEqual([r['id'] for r in results], [match.id])
+        self.assertIn('<mark>Réunion</mark>', results[0]['snippet'])
+
+    def test_snippets_are_escaped(self):
+        self.post('<script>alert(1)</script> piège')
+
+        results, _ = search_messages(self.alice, 'piège')
+
+        self.assertNotIn('<script>', results[0]['snippet'])
+        self.assertIn('&lt;script&gt;', results[0]['snippet'])
+
+    def test_private_rooms_of_others_are_hidden(self):
+        self.post('plan secret', room=self.secret, user=self.bob)
+
+        self.assertEqual(search_messages(self.alice, 'plan')[0], [])
+        self.assertEqual(len(search_messages(self.bob, 'plan')[0]), 1)
+
+    def test_keyset_pagination_covers_every_match_once(self):
+        ids = {self.post(f'annonce numéro {index}').id for index in range(7)}
+        self.post('autre chose')
+
+        seen, cursor = [], None
+        while True:
+            results, cursor = search_messages(self.alice, 'annonce', cursor=cursor, limit=3)
+            seen.extend(r['id'] for r in results)
+            if cursor is None:
+                break
+        self.assertEqual(len(seen), 7)
+        self.assertEqual(set(seen), ids)
+
+    def test_index_follows_updates_and_deletes(self):
+        message = self.post('ancien texte')
+        message.content = 'nouveau texte'
+        message.save()
+        self.assertEqual(search_messages(self.alice, 'ancien')[0], [])
+        self.assertEqual(len(search_messages(self.alice, 'nouveau')[0]), 1)
+
+        message.delete()
+        self.assertEqual(search_messages(self.alice, 'nouveau')[0], [])
+
+    def test_search_view(self):
+        self.post('bonjour tout le monde')
+        self.client.force_login(self.alice)
+
+        response = self.client.get(reverse('chat:search'), {'q': 'bonjour'})
+        self.assertContains(response, '<mark>bonjour</mark>')
+        bad = self.client.get(reverse('chat:search'), {'q': 'bonjour', 'cursor': '!!'})
+        self.assertEqual(bad.status_code, 400)
+
+
+class ArchiveTests(TestCase):
+    """Segments d'archive et pagination continue table -> archives"""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        settings = override_settings(CHAT_ARCHIVE={'ROOT': self.root, 'BLOCK_MESSAGES': 4, 'BATCH_SIZE': 10})
+        settings.enable()
+        self.addCleanup(settings.disable)
+        archive._archive = None
+        self.addCleanup(setattr, archive, '_archive', None)
+
+        self.user = CustomUser.objects.create_user('alice', password='x')
+        self.room = ChatRoom.objects.create(name='old', retention_days=30)
+        self.now = timezone.now()
+        start = self.now - timedelta(days=60)
+        self.messages = Message.objects.bulk_create([
+            Message(room=self.room, user=self.user, content=f'message {index}',
+                    timestamp=start + timedelta(days=index))
+            for index in range(45)
+        ])
+
+    def all_pages(self, limit):
+        ids, cursor = [], None
+        while True:
+            page, cursor = fetch_page(self.room.id, before=cursor, limit=limit)
+            ids = [message['id'] for message in page] + ids
+            if cursor is None:
+                return ids
+
+    def test_moves_messages_older_than_the_room_horizon(self):
+        results = archive_expired_messages(now=self.now)
+
+        self.assertEqual(results, {'old': 30})
+        self.assertEqual(Message.objects.count(), 15)
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.archived_message_count, 30)
+        self.assertEqual(self.room.get_message_count(), 45)
+        # Lots de 10 : trois segments, chacun avec son index
+        self.assertEqual(len(archive.get_archive().segments(self.room.id)), 3)
+
+    def test_scrollback_continues_into_the_archive(self):
+        expected = [message.id for message in self.messages]
+        archive_expired_messages(now=self.now)
+
+        for limit in (1, 7, 15, 50):
+            with self.subTest(limit=limit):
+                self.assertEqual(self.all_pages(limit), expected)
+
+        page, _ = fetch_page(self.room.id, limit=20)
+        self.assertEqual(page[0]['content'], 'message 25')
+        self.assertEqual(page[0]['username'], 'alice')
+
+    def test_interrupted_run_does_not_duplicate_messages(self):
+        store = archive.get_archive()
+        rows = list(
+            Message.objects.order_by('timestamp', 'id')
+            .values_list('id', 'timestamp', 'user__username', 'content')[:10]
+        )
+        # Index écrit mais messages encore en base
+        directory = store.room_dir(self.room.id)
+        directory.mkdir()
+        store._write_segment(directory, rows)
+
+        archive_expired_messages(now=self.now)
+
+        self.assertEqual(self.all_pages(50), [message.id for message in self.messages])
+        # Les messages supprimés au rattrapage sont comptés comme archivés
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.archived_message_count, 30)
+        self.assertEqual(self.room.get_message_count(), 45)
+
+    def test_recovery_boundary_is_exact_to_the_microsecond(self):
+        store = archive.get_archive()
+        moment = self.now - timedelta(days=90, microseconds=123457)
+        twins = Message.objects.bulk_create([
+            Message(room=self.room, user=self.user, content=f'twin {index}', timestamp=moment)
+            for index in range(2)
+        ])
+        rows = list(
+            Message.objects.filter(id=twins[0].id)
+            .values_list('id', 'timestamp', 'user__username', 'content')
+        )
+        directory = store.room_dir(self.room.id)
+        directory.mkdir()
+        store._write_segment(directory, rows)
+        self.assertEqual(store.last_archived_key(self.room.id), (archive.to_micros(moment), twins[0].id))
+
+        archive_expired_messages(now=self.now)
+
+        ids = self.all_pages(50)
+        self.assertEqual(ids[:2], [twin.id for twin in twins])
+        self.assertEqual(len(ids), len(set(ids)))
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.archived_message_count, 32)
+
+    def test_rooms_without_retention_are_kept(self):
+        self.room.retention_days = None
+        self.room.save()
+
+        self.assertEqual(archive_expired_messages(now=self.now), {})
+        self.assertEqual(Message.objects.count(), 45)
+
+    def test_platform_without_fcntl_fails_clearly(self):
+        with unittest.mock.patch.object(archive, 'fcntl', None):
+            with self.assertRaisesMessage(CommandError, 'fcntl'):
+                call_command('archive_messages', stdout=io.StringIO())
+        self.assertEqual(Message.objects.count(), 45)
+
+
+class ExportTests(TestCase):
+    """Export en flux : archives puis table, formats, filtres de dates"""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        settings = override_settings(CHAT_ARCHIVE={'ROOT': self.root, 'BLOCK_MESSAGES': 4, 'BATCH_SIZE': 10})
+        settings.enable()
+        self.addCleanup(settings.disable)
+        archive._archive = None
+        self.addCleanup(setattr, archive, '_archive', None)
+
+        self.user = CustomUser.objects.create_user('alice', password='x')
+        self.room = ChatRoom.objects.create(name='compliance', creator=self.user, retention_days=30)
+        self.start = timezone.now().replace(microsecond=0) - timedelta(days=60)
+        self.messages = Message.objects.bulk_create([
+            Message(room=self.room, user=self.user, content=f'ligne {index}, "citée"',
+                    timestamp=self.start + timedelta(days=index))
+            for index in range(45)
+        ])
+        archive_expired_messages(now=self.start + timedelta(days=60))
+        self.url = reverse('chat:export_room', args=['compliance'])
+
+    def test_jsonl_streams_archived_then_live_messages(self):
+        self.client.force_login(self.user)
+        response = self.client.get(self.url)
+
+        self.assertTrue(response.streaming)
+        lines = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual([line['id'] for line in lines], [message.id for message in self.messages])
+        self.assertEqual(lines[0]['username'], 'alice')
+        self.assertEqual(lines[0]['content'], 'ligne 0, "citée"')
+
+    def test_csv_gzip_with_date_range(self):
+        self.client.force_login(self.user)
+        since = (self.start + timedelta(days=25)).isoformat()
+        until = (self.start + timedelta(days=35)).isoformat()
+        response = self.client.get(self.url, {'format': 'csv', 'gzip': '1', 'since': since, 'until': until})
+
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        self.assertIn('compliance.csv.gz', response['Content-Disposition'])
+        text = gzip.decompress(b''.join(response.streaming_content)).decode()
+        rows = list(csv.reader(io.StringIO(text)))
+        self.assertEqual(rows[0], ['id', 'timestamp', 'username', 'content'])
+        # Du 25e au 34e jour : à cheval sur les archives et la table
+        self.assertEqual([int(row[0]) for row in rows[1:]], [m.id for m in self.messages[25:35]])
+        self.assertEqual(rows[1][3], 'ligne 25, "citée"')
+
+    def test_requires_room_creator_or_staff_and_valid_dates(self):
+        other = CustomUser.objects.create_user('bob', password='x')
+        self.client.force_login(other)
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(self.url, {'since': 'hier'}).status_code, 400)
+        self.assertEqual(self.client.get(self.url, {'format': 'xml'}).status_code, 400)
+
+    async def test_asgi_response_streams_asynchronously(self):
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.get(self.url)
+
+        self.assertTrue(response.is_async)
+        content = b''.join([chunk async for chunk in response.streaming_content])
+        self.assertEqual(len(content.splitlines()), 45)
+
+    def test_live_rows_are_read_in_independent_pages(self):
+        # Aucun curseur ouvert entre deux pages : une requête par page
+        with CaptureQueriesContext(connection) as queries:
+            ids = [message['id'] for message in export.iter_messages(self.room, chunk_size=4)]
+        self.assertEqual(ids, [message.id for message in self.messages])
+        pages = [q for q in queries.captured_queries if 'FROM "chat_message"' in q['sql']]
+        self.assertEqual(len(pages), 4)  # 15 messages en table
+
+    async def test_asgi_export_interleaved_with_consumer_queries(self):
+        self.addCleanup(setattr, export, 'CHUNK_SIZE', export.CHUNK_SIZE)
+        self.addCleanup(setattr, export, 'CHUNK_BYTES', export.CHUNK_BYTES)
+        export.CHUNK_SIZE, export.CHUNK_BYTES = 4, 1  # une ligne par morceau
+        consumer = ChatConsumer()
+        consumer.room_name = 'compliance'
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.get(self.url)
+
+        lines = []
+        async for chunk in response.streaming_content:
+            lines.append(json.loads(chunk))
+            # Appel d'un consumer sur le même thread (close_old_connections avant et après)
+            self.assertEqual(await consumer.get_room_id(), self.room.id)
+        self.assertEqual([line['id'] for line in lines], [message.id for message in self.messages])
+
+
+def upload(client, room_name, content, chunk_size, name='notes.txt'):
+    """Envoi par morceaux complet ; retourne l'id de la pièce jointe"""
+    created = client.post(reverse('chat:attachment_create', args=[room_name]), {
+        'filename': name, 'size': len(content), 'content_type': 'text/plain',
+    }).json()
+    for start in range(0, len(content), chunk_size):
+        end = min(start + chunk_size, len(content))
+        client.generic(
+            'PUT', created['upload_url'], content[start:end],
+            HTTP_CONTENT_RANGE=f'bytes {start}-{end - 1}/{len(content)}',
+        )
+    return created['id']
+
+
+class AttachmentTests(TestCase):
+    """Envoi par morceaux avec reprise, dédoublonnage, téléchargement par plages"""
+
+    def setUp(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media, ignore_errors=True)
+        settings = override_settings(MEDIA_ROOT=media, CHAT_ATTACHMENTS={'CHUNK_SIZE': 4})
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.user = CustomUser.objects.create_user('alice', password='x')
+        self.room = ChatRoom.objects.create(name='files')
+        self.client.force_login(self.user)
+
+    def put(self, url, data, start, total):
+        return self.client.generic(
+            'PUT', url, data, HTTP_CONTENT_RANGE=f'bytes {start}-{start + len(data) - 1}/{total}',
+        )
+
+    def test_upload_resumes_from_the_server_offset(self):
+        content = b'0123456789'
+        created = self.client.post(reverse('chat:attachment_create', args=['files']), {
+            'filename': '../notes.txt', 'size': len(content),
+        })
+        self.assertEqual(created.status_code, 201)
+        url = created.json()['upload_url']
+
+        self.assertEqual(self.put(url, content[:4], 0, 10).json()['offset'], 4)
+        # Morceau perdu puis renvoyé trop loin : le serveur indique où reprendre
+        conflict = self.put(url, content[8:], 8, 10)
+        self.assertEqual((conflict.status_code, conflict.json()['offset']), (409, 4))
+        self.assertEqual(self.client.get(url).json()['offset'], 4)
+        self.assertEqual(self.put(url, b'toolarge', 4, 10).status_code, 400)
+        self.put(url, content[4:8], 4, 10)
+        done = self.put(url, content[8:], 8, 10).json()
+
+        self.assertTrue(done['complete'])
+        self.assertEqual(done['attachment']['name'], 'notes.txt')
+        attachment = Attachment.objects.get()
+        self.assertEqual(attachment.sha256, hashlib.sha256(content).hexdigest())
+        with open(attachments.blob_path(attachment.sha256), 'rb') as blob:
+            self.assertEqual(blob.read(), content)
+
+    def test_identical_uploads_share_one_file(self):
+        first = upload(self.client, 'files', b'same content', 4)
+        second = upload(self.client, 'files', b'same content', 4, name='copy.txt')
+
+        blobs = {a.sha256 for a in Attachment.objects.filter(id__in=[first, second])}
+        self.assertEqual(len(blobs), 1)
+        directory = os.path.dirname(attachments.blob_path(blobs.pop()))
+        self.assertEqual(len(os.listdir(directory)), 1)
+        partial = os.path.join(django_settings.MEDIA_ROOT, 'attachments', 'partial')
+        self.assertEqual(os.listdir(partial), [])
+
+    def test_download_supports_ranges(self):
+        attachment_id = upload(self.client, 'files', b'0123456789', 4)
+        url = reverse('chat:attachment_download', args=[attachment_id])
+
+        full = self.client.get(url)
+        self.assertEqual((full.status_code, b''.join(full.streaming_content)), (200, b'0123456789'))
+        self.assertIn('attachment', full['Content-Disposition'])
+        partial = self.client.get(url, HTTP_RANGE='bytes=2-5')
+        self.assertEqual(partial.status_code, 206)
+        self.assertEqual(b''.join(partial.streaming_content), b'2345')
+        self.assertEqual(partial['Content-Range'], 'bytes 2-5/10')
+        self.assertEqual(self.client.get(url, HTTP_RANGE='bytes=-3').getvalue(), b'789')
+        self.assertEqual(self.client.get(url, HTTP_RANGE='bytes=20-').status_code, 416)
+
+    def test_private_room_attachments_are_hidden(self):
+        owner = CustomUser.objects.create_user('owner', password='x')
+        ChatRoom.objects.create(name='secret', is_private=True, creator=owner)
+        self.client.force_login(owner)
+        attachment_id = upload(self.client, 'secret', b'hidden', 4)
+
+        self.client.force_login(self.user)
+        url = reverse('chat:attachment_download', args=[attachment_id])
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_hash_survives_chunks_from_another_worker(self):
+        content = b'0123456789'
+        created = self.client.post(reverse('chat:attachment_create', args=['files']), {
+            'filename': 'notes.txt', 'size': len(content),
+        }).json()
+        self.put(created['upload_url'], content[:4], 0, 10)
+        # Morceau suivant reçu par un worker sans l'état de l'empreinte
+        attachments._hash_states.clear()
+        self.put(created['upload_url'], content[4:8], 4, 10)
+        self.put(created['upload_url'], content[8:], 8, 10)
+
+        self.assertEqual(Attachment.objects.get().sha256, hashlib.sha256(content).hexdigest())
+
+    def test_cleanup_removes_abandoned_uploads(self):
+        created = self.client.post(reverse('chat:attachment_create', args=['files']), {
+            'filename': 'notes.txt', 'size': 10,
+        }).json()
+        self.put(created['upload_url'], b'0123', 0, 10)
+        attachment = Attachment.objects.get()
+        later = timezone.now() + timedelta(seconds=attachments.get_attachments_config()['UPLOAD_TTL'] + 1)
+
+        self.assertEqual(attachments.cleanup_attachments(now=later, dry_run=True)['uploads'], 1)
+        self.assertTrue(Attachment.objects.exists())
+        self.assertEqual(attachments.cleanup_attachments(now=later)['uploads'], 1)
+        self.assertFalse(Attachment.objects.exists())
+        self.assertFalse(os.path.exists(attachments.partial_path(attachment)))
+
+    def test_expired_upload_rejects_chunks(self):
+        created = self.client.post(reverse('chat:attachment_create', args=['files']), {
+            'filename': 'notes.txt', 'size': 10,
+        }).json()
+        Attachment.objects.update(created_at=timezone.now() - timedelta(days=2))
+
+        self.assertEqual(self.put(created['upload_url'], b'0123', 0, 10).status_code, 400)
+
+    def test_cleanup_removes_unreferenced_blobs_only(self):
+        attachment_id = upload(self.client, 'files', b'kept', 4)
+        kept = attachments.blob_path(Attachment.objects.get(id=attachment_id).sha256)
+        orphan = attachments.blob_path(hashlib.sha256(b'orphan').hexdigest())
+        os.makedirs(os.path.dirname(orphan), exist_ok=True)
+        with open(orphan, 'wb') as blob:
+            blob.write(b'orphan')
+        later = timezone.now() + timedelta(days=2)
+
+        self.assertEqual(attachments.cleanup_attachments(now=later)['blobs'], 1)
+        self.assertTrue(os.path.exists(kept))
+        self.assertFalse(os.path.exists(orphan))
+
+
+class AttachmentConsumerTests(TransactionTestCase):
+    """La trame diffusée ne porte que les métadonnées de la pièce jointe"""
+
+    def setUp(self):
+        reset_singletons()
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media, ignore_errors=True)
+        settings = override_settings(MEDIA_ROOT=media)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.user = CustomUser.objects.create_user('alice', password='x')
+        self.room = ChatRoom.objects.create(name='files')
+        self.client.force_login(self.user)
+        self.attachment_id = upload(self.client, 'files', b'x' * 1000, 256, name='photo.png')
+
+    def tearDown(self):
+        reset_singletons()
+
+    async def test_message_with_attachment(self):
+        app = UserScopeMiddleware(URLRouter(websocket_urlpatterns), self.user)
+        communicator = WebsocketCommunicator(app, '/ws/chat/files/')
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+
+        await communicator.send_to(text_data=json.dumps({'attachment': 'not-a-uuid'}))
+        self.assertEqual((await receive_until(communicator, 'error'))['error'], 'invalid_attachment')
+
+        await communicator.send_to(text_data=json.dumps({'message': '', 'attachment': self.attachment_id}))
+        frame = await receive_until(communicator, 'chat_message')
+        self.assertEqual(frame['attachment']['id'], self.attachment_id)
+        self.assertEqual(frame['attachment']['name'], 'photo.png')
+        self.assertEqual(frame['attachment']['size'], 1000)
+        self.assertTrue(frame['attachment']['url'].endswith('/download/'))
+        await receive_until(communicator, 'messages_committed')
+        await communicator.disconnect()
+
+        page, _ = await sync_to_async(fetch_page)(self.room.id)
+        self.assertEqual(page[-1]['attachment']['id'], self.attachment_id)
+
+
+class AdmissionControllerTests(SimpleTestCase):
+    """Ouvertures limitées, reprises prioritaires, refus avec délai"""
+
+    async def test_waiters_are_admitted_as_slots_free_up_resumes_first(self):
+        controller = AdmissionController(max_concurrent=1, queue_timeout=1)
+        first = await controller.admit()
+        join = asyncio.ensure_future(controller.admit())
+        resume = asyncio.ensure_future(controller.admit(resume=True))
+        await asyncio.sleep(0)
+        self.assertFalse(join.done() or resume.done())
+
+        first.release()
+        second = await resume
+        self.assertFalse(join.done())
+        second.release()
+        (await join).release()
+        self.assertEqual(controller.active, 0)
+
+    async def test_rejects_when_queue_is_full_or_wait_too_long(self):
+        controller = AdmissionController(max_concurrent=1, max_queue=1, queue_timeout=0.05)
+        ticket = await controller.admit()
+        waiter = asyncio.ensure_future(controller.admit())
+        await asyncio.sleep(0)
+
+        with self.assertRaises(Rejected):
+            await controller.admit()  # file pleine
+        with self.assertRaises(Rejected):
+            await waiter  # attente trop longue
+        ticket.release()
+        self.assertEqual(controller.active, 0)
+
+    async def test_drain_rejects_waiters_and_new_connections(self):
+        controller = AdmissionController(max_concurrent=1, queue_timeout=1)
+        ticket = await controller.admit()
+        waiter = asyncio.ensure_future(controller.admit())
+        await asyncio.sleep(0)
+
+        await controller.drain()
+        with self.assertRaises(Rejected):
+            await waiter
+        with self.assertRaises(Rejected):
+            await controller.admit()
+        ticket.release()
+        self.assertEqual(controller.active, 0)
+
+
+class AdmissionConsumerTests(TransactionTestCase):
+    """Refus avec trame reconnect (1013) et départ progressif à l'arrêt (1012)"""
+
+    def setUp(self):
+        reset_singletons()
+        admission._controller = AdmissionController(max_concurrent=1, queue_timeout=0.05, drain_window=10)
+        self.room = ChatRoom.objects.create(name='storm')
+        self.user = CustomUser.objects.create_user('alice', password='x')
+
+    def tearDown(self):
+        reset_singletons()
+
+    def communicator(self):
+        app = AdmissionMiddleware(UserScopeMiddleware(URLRouter(websocket_urlpatterns), self.user))
+        return WebsocketCommunicator(app, '/ws/chat/storm/?resume_after=0')
+
+    async def test_busy_worker_rejects_with_retry_hint(self):
+        ticket = await admission._controller.admit()
+        communicator = self.communicator()
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+
+        frame = await communicator.receive_json_from()
+        self.assertEqual((frame['type'], frame['reason']), ('reconnect', 'busy'))
+        self.assertGreaterEqual(frame['retry_after'], 2)
+        self.assertEqual((await communicator.receive_output())['code'], 1013)
+        ticket.release()
+
+    async def test_connect_frees_its_slot_and_shutdown_drains(self):
+        communicators = [self.communicator() for _ in range(2)]
+        for communicator in communicators:
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            await receive_frames(communicator, timeout=0.1)
+        self.assertEqual(admission._controller.active, 0)
+
+        await admission._controller.drain()
+        delays = []
+        for communicator in communicators:
+            frame = await receive_until(communicator, 'reconnect')
+            self.assertEqual(frame['reason'], 'restart')
+            delays.append(frame['retry_after'])
+            self.assertEqual((await communicator.receive_output())['code'], 1012)
+        self.assertEqual(sorted(delays), [0, 5])
+
+
+class OutboundBatchTests(SimpleTestCase):
+    """Trames regroupées seulement quand la connexion est très sollicitée"""
+
+    async def writes(self, frames, batch_rate, pause=0):
+        written = []
+
+        async def write(payload):
+            written.append(payload)
+
+        queue = OutboundQueue(write, join=negotiate(None)[1].join, batch_rate=batch_rate)
+        for index, frame in enumerate(frames, start=1):
+            queue.put(json.dumps(frame), last_id=index)
+            if pause:
+                await asyncio.sleep(pause)
+        await queue.drain()
+        queue.close()
+        return written, queue.last_written_id
+
+    async def test_quiet_connection_sends_frames_one_by_one(self):
+        frames = [{'type': 'chat_message', 'id': i} for i in range(3)]
+        written, last_id = await self.writes(frames, batch_rate=50, pause=0.01)
+        self.assertEqual([json.loads(payload) for payload in written], frames)
+        self.assertEqual(last_id, 3)
+
+    async def test_busy_connection_coalesces_frames_in_order(self):
+        frames = [{'type': 'chat_message', 'id': i} for i in range(20)]
+        written, last_id = await self.writes(frames, batch_rate=5)
+        self.assertEqual(len(written), 1)
+        self.assertEqual(json.loads(written[0]), {'type': 'batch', 'frames': frames})
+        self.assertEqual(last_id, 20)
+
+    def test_compact_codecs_join_encoded_frames(self):
+        frames = [{'type': 'receipt', 'status': 'seen', 'id': i} for i in range(20)]
+        for name in (COMPACT, MSGPACK):
+            session = ProtocolSession(make_codec(name))
+            payloads = [session.encode(frame)[0] for frame in frames]
+            joined = session.join(payloads)
+            decoded = session.decode(**{'bytes_data' if isinstance(joined, bytes) else 'text_data': joined})
+            self.assertEqual(decoded, {'type': 'batch', 'frames': frames})
+
+
+@override_settings(CHAT_BACKPRESSURE={'BATCH_RATE': 1})
+class OutboundBatchConsumerTests(TransactionTestCase):
+    """Trames batch réservées aux clients qui annoncent la fonctionnalité"""
+
+    def setUp(self):
+        reset_singletons()
+        self.user = CustomUser.objects.create_user('alice', password='x')
+        self.room = ChatRoom.objects.create(name='busy')
+
+    def tearDown(self):
+        reset_singletons()
+
+    async def test_consumer_batches_only_for_clients_announcing_the_feature(self):
+        app = UserScopeMiddleware(URLRouter(websocket_urlpatterns), self.user)
+        for features, batched in (('history_batch', False), ('history_batch,batch', True)):
+            communicator = WebsocketCommunicator(app, f'/ws/chat/busy/?features={features}')
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            frames = await receive_frames(communicator)
+            self.assertEqual(frames[0]['type'] == 'batch', batched)
+            if batched:
+                frames = frames[0]['frames'] + frames[1:]
+            self.assertEqual([f['type'] for f in frames[:2]], ['history_batch', 'online_users'])
+            await communicator.disconnect()
+
+
+class BackpressureTests(SimpleTestCase):
+    """File d'envoi bornée : seules les trames éphémères sont abandonnées"""
+
+    async def test_user_definitions_survive_shedding(self):
+        gate = asyncio.Event()
+        written = []
+
+        async def write(payload):
+            await gate.wait()
+            written.append(json.loads(payload))
+
+        consumer = ChatConsumer()
+        consumer.protocol = ProtocolSession(make_codec(COMPACT))
+        consumer.outbound = OutboundQueue(write, max_frames=4)
+        # Première trame en cours d'écriture : les suivantes s'accumulent
+        await consumer.send_frame({'type': 'resync_required'})
+        await asyncio.sleep(0)
+        await consumer.send_frame({
+            'type': 'presence_delta',
+            'joined': [{'username': 'shed-bob', 'avatar': '/b.png'}],
+            'left': [],
+            'snapshot': False,
+        }, ephemeral=True)
+        for message_id in range(3):
+            await consumer.send_frame({
+                'type': 'chat_message', 'id': message_id, 'message': 'x',
+                'username': 'shed-bob', 'avatar': '/b.png', 'timestamp': 't',
+            })
+        gate.set()
+        await consumer.outbound.drain()
+        consumer.outbound.close()
+
+        types = [frame['t'] for frame in written]
+        self.assertNotIn('pd', types)
+        self.assertEqual(types.count('cm'), 3)
+        defined = {entry[0] for frame in written if frame['t'] == 'us' for entry in frame['d']}
+        first_chat = types.index('cm')
+        self.assertIn('us', types[:first_chat])
+        self.assertIn(written[first_chat]['ui'], defined)
+
+
+@override_settings(CHAT_BACKPRESSURE={'MAX_FRAME_BYTES': 200})
+class FrameSizeTests(TransactionTestCase):
+    """MAX_FRAME_BYTES compte des octets UTF-8, pas des caractères"""
+
+    def setUp(self):
+        reset_singletons()
+        self.user = CustomUser.objects.create_user('alice', password='x')
+        ChatRoom.objects.create(name='sizes')
+
+    def tearDown(self):
+        reset_singletons()
+
+    async def test_multibyte_text_is_measured_in_bytes(self):
+        app = UserScopeMiddleware(URLRouter(websocket_urlpatterns), self.user)
+        for content, closed in (('e' * 150, False), ('é' * 150, True)):
+            communicator = WebsocketCommunicator(app, '/ws/chat/sizes/')
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            await receive_frames(communicator)
+            await communicator.send_to(text_data=json.dumps({'message': content}, ensure_ascii=False))
+            if closed:
+                output = await receive_until_close(communicator)
+                self.assertEqual(output['code'], 1009)
+            else:
+                await receive_until(communicator, 'messages_committed')
+            await communicator.disconnect()
+
+
+class ClientIdTests(TransactionTestCase):
+    """cid attribué par le serveur ; client_id renvoyé au seul expéditeur"""
+
+    def setUp(self):
+        reset_singletons()
+        self.alice = CustomUser.objects.create_user('alice', password='x')
+        self.bob = CustomUser.objects.create_user('bob', password='x')
+        ChatRoom.objects.create(name='ids')
+
+    def tearDown(self):
+        reset_singletons()
+
+    async def connect(self, user):
+        app = UserScopeMiddleware(URLRouter(websocket_urlpatterns), user)
+        communicator = WebsocketCommunicator(app, '/ws/chat/ids/')
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        await receive_frames(communicator)
+        return communicator
+
+    async def test_client_cannot_reuse_another_members_cid(self):
+        alice = await self.connect(self.alice)
+        bob = await self.connect(self.bob)
+
+        await alice.send_to(text_data=json.dumps({'message': 'un', 'client_id': 'mine'}))
+        own = await receive_until(alice, 'chat_message')
+        seen = await receive_until(bob, 'chat_message')
+        self.assertEqual(own['client_id'], 'mine')
+        self.assertNotEqual(own['cid'], 'mine')
+        self.assertNotIn('client_id', seen)
+
+        # Bob reprend le cid d'Alice : son message reçoit le sien
+        await bob.send_to(text_data=json.dumps({'message': 'deux', 'client_id': own['cid']}))
+        replay = await receive_until(alice, 'chat_message')
+        self.assertNotEqual(replay['cid'], own['cid'])
+
+        committed = {}
+        while len(committed) < 2:
+            frame = await receive_until(alice, 'messages_committed')
+            committed.update((m['cid'], m['id']) for m in frame['messages'])
+        self.assertEqual(set(committed), {own['cid'], replay['cid']})
+        await alice.disconnect()
+        await bob.disconnect()
+
+
+class UnreadCountTests(TestCase):
+    """Non-lus du lobby : compteurs tenus par l'écriture et les accusés"""
+
+    def setUp(self):
+        self.alice = CustomUser.objects.create_user('alice', password='x')
+        self.bob = CustomUser.objects.create_user('bob', password='x')
+        self.room = ChatRoom.objects.create(name='unread')
+        self.messages = Message.objects.bulk_create([
+            Message(room=self.room, user=user, content=str(index))
+            for index, user in enumerate([self.bob, self.bob, self.alice])
+        ])
+
+    def lobby_unread(self, user):
+        self.client.force_login(user)
+        rooms = self.client.get(reverse('chat:lobby')).context['rooms']
+        return {room.name: room.unread_count for room in rooms}['unread']
+
+    def pending(self, user):
+        return ingest.PendingMessage(
+            room_id=self.room.id, room_name='unread', user_id=user.id,
+            content='x', timestamp=timezone.now(), cid='c',
+        )
+
+    def write(self, *users):
+        """Messages écrits comme par la file d'écriture, non-lus compris"""
+        batch = [self.pending(user) for user in users]
+        messages = Message.objects.bulk_create([
+            Message(room=self.room, user=user, content='x') for user in users
+        ])
+        ingest.count_unread(batch, messages)
+        return messages
+
+    def test_receipts_reset_and_ingest_increments_counters(self):
+        # Jamais lue : tous les messages des autres
+        self.assertEqual(self.lobby_unread(self.alice), 2)
+
+        receipts.ReceiptAggregator()._advance_read_states(self.room.id, {self.alice.id: self.messages[0].id})
+        self.assertEqual(self.lobby_unread(self.alice), 1)  # le 2e message de Bob
+
+        self.write(self.bob, self.bob, self.alice)
+        self.assertEqual(self.lobby_unread(self.alice), 3)
+        self.assertEqual(RoomReadState.objects.get(user=self.alice).last_read_message_id, self.messages[0].id)
+
+    def test_read_position_ahead_of_the_batch_is_recounted(self):
+        receipts.ReceiptAggregator()._advance_read_states(self.room.id, {self.alice.id: self.messages[-1].id})
+        self.assertEqual(self.lobby_unread(self.alice), 0)
+        # Position déjà sur le 1er message du lot quand les non-lus sont comptés
+        first, second = Message.objects.bulk_create([
+            Message(room=self.room, user=self.bob, content=str(index)) for index in range(2)
+        ])
+        RoomReadState.objects.filter(user=self.alice).update(last_read_message_id=first.id)
+        ingest.count_unread([self.pending(self.bob), self.pending(self.bob)], [first, second])
+        self.assertEqual(self.lobby_unread(self.alice), 1)
+
+
+def redis_url():
+    """Redis de test (CHAT_TEST_REDIS_URL), ou None s'il ne répond pas"""
+    url = os.environ.get('CHAT_TEST_REDIS_URL', 'redis://localhost:6379/15')
+    try:
+        import redis
+        redis.Redis.from_url(url, socket_connect_timeout=0.2).ping()
+    except Exception:
+        return None
+    return url
+
+
+class PresenceExpiryTests(SimpleTestCase):
+    """Les connexions d'un worker planté expirent après le TTL"""
+
+    async def assert_crashed_worker_expires(self, crashed, alive):
+        await crashed.add('lobby', 'c1', 'alice', {'avatar': None})
+        await alive.add('lobby', 'c2', 'bob', {'avatar': None})
+        self.assertEqual(await alive.count('lobby'), 2)
+
+        # Worker planté : plus de battement de cœur, aucun départ annoncé
+        crashed._heartbeat_task.cancel()
+        crashed.local_connections.clear()
+        await asyncio.sleep(crashed.ttl * 3)
+
+        self.assertEqual(list(await alive.members('lobby')), ['bob'])
+        self.assertEqual(await alive.channels_for('lobby', 'alice'), [])
+        await alive.remove('lobby', 'c2')
+        self.assertEqual(await alive.count('lobby'), 0)
+
+    async def test_memory_store(self):
+        store = presence.MemoryPresenceStore(ttl=0.1, heartbeat_interval=0.02)
+        # Un seul processus : le même registre voit les deux « workers »
+        other = presence.MemoryPresenceStore(ttl=0.1, heartbeat_interval=0.02)
+        other.connections, other.users = store.connections, store.users
+        await self.assert_crashed_worker_expires(store, other)
+
+    @unittest.skipUnless(redis_url(), 'Redis indisponible')
+    async def test_redis_store(self):
+        prefix = f'presence-test-{uuid.uuid4().hex}'
+        crashed, alive = (
+            presence.RedisPresenceStore(url=redis_url(), prefix=prefix, ttl=0.3, heartbeat_interval=0.05)
+            for _ in range(2)
+        )
+        try:
+            await self.assert_crashed_worker_expires(crashed, alive)
+        finally:
+            await alive.client.delete(*alive._keys('lobby'))
+            for store in (crashed, alive):
+                await store.client.aclose()
+
+
+class HistoryCacheTests(TestCase):
+    """Tampon circulaire par salle, éviction LRU et invalidation"""
+
+    def message(self, message_id, content='x'):
+        return {'id': message_id, 'content': content, 'username': 'alice',
+                'avatar': None, 'timestamp': '2026-01-01T00:00:00+00:00'}
+
+    def test_ring_buffer_keeps_the_latest_messages(self):
+        cache = history.HistoryCache(messages_per_room=3)
+        cache.fill('room', [self.message(i) for i in range(1, 3)])
+        for message_id in range(3, 6):
+            cache.append('room', self.message(message_id))
+
+        self.assertEqual([m['id'] for m in cache.get('room')], [3, 4, 5])
+        self.assertEqual(cache.total_bytes, sum(history.estimate_size(m) for m in cache.get('room')))
+
+    def test_least_recently_used_rooms_are_evicted(self):
+        cache = history.HistoryCache(max_rooms=2)
+        cache.fill('a', [self.message(1)])
+        cache.fill('b', [self.message(2)])
+        cache.get('a')
+        cache.fill('c', [self.message(3)])
+
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(list(cache.rooms), ['a', 'c'])
+
+        cache = history.HistoryCache(max_bytes=history.estimate_size(self.message(1, 'y' * 100)))
+        cache.fill('a', [self.message(1, 'y' * 100)])
+        cache.fill('b', [self.message(2)])
+        self.assertEqual(list(cache.rooms), ['b'])
+
+    def test_deleting_a_room_invalidates_its_history(self):
+        history._cache = None
+        self.addCleanup(setattr, history, '_cache', None)
+        owner = CustomUser.objects.create_user('owner', password='x')
+        ChatRoom.objects.create(name='doomed', creator=owner)
+        cache = history.get_history_cache()
+        cache.fill('doomed', [self.message(1)])
+        cache.get_batch_frame('doomed', cache.get('doomed'))
+
+        self.client.force_login(owner)
+        self.client.post(reverse('chat:delete_room', args=['doomed']))
+
+        self.assertIsNone(cache.get('doomed'))
+        self.assertNotIn('doomed', cache.frames)
+        self.assertEqual(cache.total_bytes, 0)
+
+
+class KeysetPaginationTests(TestCase):
+    """Curseurs (timestamp, id) et pages de l'historique"""
+
+    def setUp(self):
+        self.user = CustomUser.objects.create_user('alice', password='x')
+        self.room = ChatRoom.objects.create(name='scroll')
+        # Horodatages en double : l'id départage les messages
+        now = timezone.now()
+        self.messages = Message.objects.bulk_create([
+            Message(room=self.room, user=self.user, content=str(index),
+                    timestamp=now - timedelta(seconds=index // 3))
+            for index in range(10)
+        ])
+
+    def test_cursor_round_trip(self):
+        message = {'id': 42, 'timestamp': timezone.now().isoformat()}
+        timestamp, message_id = history.decode_cursor(history.encode_cursor(message))
+        self.assertEqual((timestamp.isoformat(), message_id), (message['timestamp'], 42))
+        for invalid in ('', 'not base64!', history.encode_cursor({'id': 'x', 'timestamp': 'y'})):
+            with self.assertRaises(ValueError):
+                history.decode_cursor(invalid)
+
+    def test_pages_cover_every_message_once_in_order(self):
+        seen, cursor = [], None
+        while True:
+            page, cursor = fetch_page(self.room.id, before=cursor, limit=3)
+            seen = [message['id'] for message in page] + seen
+            if cursor is None:
+                break
+
+        expected = Message.objects.filter(room=self.room).order_by('timestamp', 'id')
+        self.assertEqual(seen, list(expected.values_list('id', flat=True)))
+
+    def test_view_rejects_invalid_cursor(self):
+        self.client.force_login(self.user)
+        url = reverse('chat:room_history', args=['scroll'])
+        first = self.client.get(url, {'limit': 4}).json()
+        self.assertEqual(len(first['messages']), 4)
+        second = self.client.get(url, {'limit': 4, 'before': first['next_cursor']}).json()
+        self.assertLess(second['messages'][-1]['id'], first['messages'][0]['id'])
+        self.assertEqual(self.client.get(url, {'before': 'garbage'}).status_code, 400)
+
+
+class IngestQueueTests(TransactionTestCase):
+    """Écriture groupée des messages et accusés par salle"""
+
+    def setUp(self):
+        reset_singletons()
+        self.user = CustomUser.objects.create_user('alice', password='x')
+        self.room = ChatRoom.objects.create(name='ingest')
+
+    def tearDown(self):
+        reset_singletons()
+
+    def pending(self, index, user_id=None):
+        return ingest.PendingMessage(
+            room_id=self.room.id, room_name='ingest', user_id=user_id or self.user.id,
+            content=str(index), timestamp=timezone.now(), cid=f'c{index}',
+        )
+
+    async def events(self, queue, batch):
+        layer = get_channel_layer()
+        channel = await layer.new_channel()
+        await layer.group_add(direct_group('ingest'), channel)
+        for pending in batch:
+            queue.submit(pending)
+        await queue._task
+        events = []
+        while True:
+            try:
+                events.append(await asyncio.wait_for(layer.receive(channel), 0.1))
+            except asyncio.TimeoutError:
+                return events
+
+    async def test_messages_are_written_in_batches(self):
+        queue = ingest.MessageIngestQueue(batch_size=2, flush_interval=0.01)
+        events = await self.events(queue, [self.pending(index) for index in range(5)])
+
+        self.assertEqual([event['type'] for event in events], ['messages_committed'] * 3)
+        self.assertEqual(
+            [[message['cid'] for message in event['messages']] for event in events],
+            [['c0', 'c1'], ['c2', 'c3'], ['c4']],
+        )
+        ids = [message['id'] for event in events for message in event['messages']]
+        stored = await sync_to_async(list)(Message.objects.order_by('id').values_list('id', 'content'))
+        self.assertEqual(stored, [(message_id, str(index)) for index, message_id in enumerate(ids)])
+
+    async def test_write_error_reports_failed_messages(self):
+        queue = ingest.MessageIngestQueue(batch_size=10, flush_interval=0.01)
+        # Auteur inexistant : la contrainte de clé étrangère fait échouer le lot
+        with self.assertLogs('chat.ingest', 'ERROR'):
+            events = await self.events(queue, [self.pending(0), self.pending(1, user_id=10**6)])
+
+        self.assertEqual(
+            [(event['type'], event['messages']) for event in events],
+            [('messages_failed', [{'cid': 'c0'}, {'cid': 'c1'}])],
+        )
+        self.assertEqual(await sync_to_async(Message.objects.count)(), 0)
+
+
+class ProtocolNegotiationTests(SimpleTestCase):
+    """Choix du protocole annoncé par le client et repli"""
+
+    def test_first_supported_offer_wins(self):
+        name, session = negotiate(['chat.v9.json', COMPACT, 'chat.v1.json'])
+        self.assertEqual((name, session.codec.name), (COMPACT, COMPACT))
+
+    def test_no_offer_falls_back_to_json_and_unknown_offers_are_refused(self):
+        for offered in (None, []):
+            name, session = negotiate(offered)
+            self.assertEqual((name, session.codec.name), (None, 'chat.v1.json'))
+        self.assertEqual(negotiate(['chat.v9.json']), (None, None))
+
+    def test_msgpack_is_skipped_without_the_package(self):
+        with unittest.mock.patch('chat.protocol.msgpack_available', return_value=False):
+            self.assertEqual(negotiate([MSGPACK, COMPACT])[0], COMPACT)
+            self.assertEqual(negotiate([MSGPACK]), (None, None))
+
+    def test_users_are_described_once_per_connection(self):
+        frame = {'type': 'chat_message', 'message': 'hi', 'username': 'alice', 'avatar': '/a.png'}
+        for name in (COMPACT, MSGPACK):
+            session = ProtocolSession(make_codec(name))
+            definition, body = session.encode(frame)
+            self.assertEqual(session.encode(frame), [body])
+            users = session.decode(**{'bytes_data' if isinstance(definition, bytes) else 'text_data': definition})
+            decoded = session.decode(**{'bytes_data' if isinstance(body, bytes) else 'text_data': body})
+            self.assertEqual(users['d'], [[decoded['ui'], 'alice', '/a.png']])
+            self.assertEqual((decoded['type'], decoded['message']), ('chat_message', 'hi'))
+
+
+class ProtocolConsumerTests(TransactionTestCase):
+    """Le consumer accepte le protocole négocié et encode ses trames avec"""
+
+    def setUp(self):
+        reset_singletons()
+        self.user = CustomUser.objects.create_user('alice', password='x')
+        ChatRoom.objects.create(name='wire')
+
+    def tearDown(self):
+        reset_singletons()
+
+    async def test_negotiated_protocol_is_used(self):
+        app = UserScopeMiddleware(URLRouter(websocket_urlpatterns), self.user)
+        communicator = WebsocketCommunicator(app, '/ws/chat/wire/', subprotocols=['chat.v9.json', COMPACT])
+        connected, subprotocol = await communicator.connect()
+        self.assertEqual((connected, subprotocol), (True, COMPACT))
+        self.assertIn('t', json.loads(await communicator.receive_from()))
+        await communicator.disconnect()
+
+        refused = WebsocketCommunicator(app, '/ws/chat/wire/', subprotocols=['chat.v9.json'])
+        self.assertFalse((await refused.connect())[0])
+
+
+class ResumeTests(TransactionTestCase):
+    """Reconnexion avec ?resume_after=<id> : messages manqués ou resync"""
+
+    def setUp(self):
+        reset_singletons()
+        self.user = CustomUser.objects.create_user('alice', password='x')
+        room = ChatRoom.objects.create(name='resume')
+        self.ids = [
+            message.id for message in Message.objects.bulk_create([
+                Message(room=room, user=self.user, content=str(index))
+                for index in range(consumers.RESUME_MAX_GAP + 60)
+            ])
+        ]
+
+    def tearDown(self):
+        reset_singletons()
+
+    async def resume(self, after):
+        app = UserScopeMiddleware(URLRouter(websocket_urlpatterns), self.user)
+        communicator = WebsocketCommunicator(app, f'/ws/chat/resume/?resume_after={after}')
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        frames = await receive_frames(communicator)
+        await communicator.disconnect()
+        return [frame for frame in frames if frame['type'] in ('resume', 'resync_required', 'history_batch')]
+
+    async def test_small_gap_is_resent_from_the_cache(self):
+        [frame] = await self.resume(self.ids[-4])
+        self.assertEqual(frame['type'], 'resume')
+        self.assertEqual([message['id'] for message in frame['messages']], self.ids[-3:])
+
+    async def test_gap_older_than_the_cache_is_read_from_the_database(self):
+        [frame] = await self.resume(self.ids[-101])
+        self.assertEqual(frame['type'], 'resume')
+        self.assertEqual([message['id'] for message in frame['messages']], self.ids[-100:])
+
+    async def test_gap_too_large_requires_a_resync(self):
+        [frame] = await self.resume(self.ids[0])
+        self.assertEqual(frame, {'type': 'resync_required'})
+
+
+class ReadStateMigrationTests(TransactionTestCase):
+    """0006 : seen_by devient une position de lecture par salle, et retour"""
+
+    before = [('chat', '0005_alter_message_timestamp')]
+    after = [('chat', '0006_roomreadstate')]
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.migrate(targets)
+        # État complet des comptes, déjà migrés jusqu'au bout en base
+        targets = targets + executor.loader.graph.leaf_nodes('accounts')
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def test_forward_and_reverse(self):
+        apps = self.migrate(self.before)
+        User = apps.get_model('accounts', 'CustomUser')
+        Room = apps.get_model('chat', 'ChatRoom')
+        Message = apps.get_model('chat', 'Message')
+        alice, bob = (
+            User.objects.create(username=name, password='!', last_seen=timezone.now())
+            for name in ('alice', 'bob')
+        )
+        first, second = Room.objects.create(name='first'), Room.objects.create(name='second')
+        messages = [Message.objects.create(room=first, user=alice, content=str(i)) for i in range(3)]
+        other = Message.objects.create(room=second, user=alice, content='x')
+        messages[1].seen_by.add(bob)
+        other.seen_by.add(bob)
+
+        apps = self.migrate(self.after)
+        RoomReadState = apps.get_model('chat', 'RoomReadState')
+        self.assertEqual(
+            set(RoomReadState.objects.values_list('user_id', 'room_id', 'last_read_message_id')),
+            {(bob.id, first.id, messages[1].id), (bob.id, second.id, other.id)},
+        )
+
+        # Retour arrière : tout ce qui précède la position est marqué vu
+        apps = self.migrate(self.before)
+        Message = apps.get_model('chat', 'Message')
+        seen = Message.seen_by.through.objects.values_list('message_id', 'customuser_id')
+        self.assertEqual(
+            set(seen),
+            {(messages[0].id, bob.id), (messages[1].id, bob.id), (other.id, bob.id)},
+        )
+
+
+class RecordingSink(SinkConsumer):
+    """Consumer sans connexion qui garde les trames envoyées"""
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.sent = []
+
+    async def send(self, text_data=None, bytes_data=None, close=False, ephemeral=False, last_id=None):
+        self.sent.append(text_data)
+
+
+class FanoutEncodingTests(SimpleTestCase):
+    """Trame chat_message encodée une fois, personnalisée par destinataire"""
+
+    async def test_only_recipient_fields_differ(self):
+        history_cache = history.HistoryCache()
+        recipients = [RecordingSink('room', f'chan.{index}', history_cache) for index in range(3)]
+        event = {
+            'type': 'chat_message_all', 'id': None, 'cid': 'c1', 'message': 'hi',
+            'username': 'alice', 'avatar': '/a.png', 'timestamp': '2026-01-01T00:00:00+00:00',
+            'sender_channel': 'chan.0',
+        }
+        event['text'] = consumers.encode_chat_message(event)
+        recipients[0].client_ids['c1'] = 'local-1'
+
+        with unittest.mock.patch('chat.consumers.encode_chat_message') as encode:
+            for recipient in recipients:
+                await recipient.chat_message_all(event)
+        encode.assert_not_called()
+
+        shared = json.loads(event['text'])
+        frames = [json.loads(recipient.sent[0]) for recipient in recipients]
+        self.assertEqual(frames[0], {**shared, 'client_id': 'local-1', 'is_current_user': True})
+        for frame in frames[1:]:
+            self.assertEqual(frame, {**shared, 'is_current_user': False})
+        self.assertTrue(all(recipient.sent[0].startswith(event['text'][:-1]) for recipient in recipients))
+        self.assertEqual(recipients[0].client_ids, {})
+
+    def test_bench_fanout_runs(self):
+        out = io.StringIO()
+        call_command('bench_fanout', members=20, messages=3, stdout=out)
+        self.assertIn('gain', out.getvalue())
+
+
+class ReceiptAggregatorTests(TransactionTestCase):
+    """Accusés regroupés par salle : une trame par expéditeur, positions de lecture"""
+
+    def setUp(self):
+        reset_singletons()
+        self.bob = CustomUser.objects.create_user('bob', password='x')
+        self.readers = [CustomUser.objects.create_user(name, password='x') for name in ('alice', 'carol')]
+        self.room = ChatRoom.objects.create(name='receipts')
+        self.ids = [
+            message.id for message in Message.objects.bulk_create([
+                Message(room=self.room, user=self.bob, content=str(index)) for index in range(5)
+            ])
+        ]
+
+    def tearDown(self):
+        reset_singletons()
+
+    async def flush(self, receipts_sent):
+        """Envoie les accusés, puis retourne les trames reçues par Bob"""
+        layer = get_channel_layer()
+        channel = await layer.new_channel()
+        store = presence.get_presence_store()
+        await store.add('receipts', channel, 'bob', {})
+        aggregator = receipts.ReceiptAggregator(window=0.01)
+        for reader, status, up_to in receipts_sent:
+            aggregator.record(self.room.id, 'receipts', reader.id, status, up_to)
+        await aggregator.tasks[self.room.id]
+        await store.remove('receipts', channel)
+        frames = []
+        while True:
+            try:
+                frames.append(await asyncio.wait_for(layer.receive(channel), 0.1))
+            except asyncio.TimeoutError:
+                return frames
+
+    def read_states(self):
+        return dict(RoomReadState.objects.values_list('user__username', 'last_read_message_id'))
+
+    async def test_burst_of_receipts_sends_one_frame_per_sender(self):
+        alice, carol = self.readers
+        frames = await self.flush(
+            [(alice, 'delivered', message_id) for message_id in self.ids]
+            + [(alice, 'seen', message_id) for message_id in self.ids[:3]]
+            + [(carol, 'seen', self.ids[1])]
+        )
+
+        self.assertEqual(frames, [{'type': 'message_status_batch', 'updates': [
+            {'status': 'delivered', 'up_to': self.ids[4]},
+            {'status': 'seen', 'up_to': self.ids[2]},
+        ]}])
+        self.assertEqual(
+            await sync_to_async(self.read_states)(),
+            {'alice': self.ids[2], 'carol': self.ids[1]},
+        )
+
+    async def test_read_position_is_clamped_to_existing_messages(self):
+        alice = self.readers[0]
+        await self.flush([(alice, 'seen', 10**15)])
+        self.assertEqual(await sync_to_async(self.read_states)(), {'alice': self.ids[-1]})
+
+        # Les messages suivants restent comptés, puis lus normalement
+        later = await sync_to_async(Message.objects.create)(room=self.room, user=self.bob, content='later')
+        await sync_to_async(ingest.count_unread)([ingest.PendingMessage(
+            room_id=self.room.id, room_name='receipts', user_id=self.bob.id,
+            content='later', timestamp=timezone.now(), cid='c',
+        )], [later])
+        state = await sync_to_async(RoomReadState.objects.get)(user=alice)
+        self.assertEqual(state.unread_count, 1)
+
+        await self.flush([(alice, 'seen', later.id)])
+        state = await sync_to_async(RoomReadState.objects.get)(user=alice)
+        self.assertEqual((state.last_read_message_id, state.unread_count), (later.id, 0))
+
+
+class PresenceBroadcasterTests(SimpleTestCase):
+    """Arrivées et départs regroupés sur la fenêtre de debounce"""
+
+    def setUp(self):
+        reset_singletons()
+        self.addCleanup(reset_singletons)
+        self.store = presence.MemoryPresenceStore()
+        self.broadcaster = presence.PresenceBroadcaster(self.store, debounce=0.02, snapshot_interval=60)
+
+    async def sent(self, actions, snapshot_due=False):
+        """Applique les arrivées/départs, puis retourne les trames diffusées"""
+        layer = get_channel_layer()
+        channel = await layer.new_channel()
+        await layer.group_add(direct_group('lobby'), channel)
+        if not snapshot_due:
+            self.broadcaster.last_snapshot['lobby'] = time.monotonic()
+        for action, username in actions:
+            if action == 'join':
+                self.broadcaster.joined('lobby', username, {'avatar': None})
+            else:
+                self.broadcaster.left('lobby', username)
+        await asyncio.sleep(0.1)
+        frames = []
+        while True:
+            try:
+                frames.append(await asyncio.wait_for(layer.receive(channel), 0.05))
+            except asyncio.TimeoutError:
+                return [json.loads(frame['text']) for frame in frames]
+
+    async def test_burst_of_joins_is_one_delta(self):
+        frames = await self.sent([('join', 'alice'), ('join', 'bob'), ('leave', 'carol')])
+        self.assertEqual(frames, [{
+            'type': 'presence_delta',
+            'joined': [{'username': 'alice', 'avatar': None, 'bio': ''},
+                       {'username': 'bob', 'avatar': None, 'bio': ''}],
+            'left': ['carol'],
+            'snapshot': None,
+        }])
+
+    async def test_join_and_leave_in_one_window_cancel_out(self):
+        self.assertEqual(await self.sent([('join', 'alice'), ('leave', 'alice')]), [])
+        # Reconnexion : départ puis retour
+        self.assertEqual(await self.sent([('leave', 'bob'), ('join', 'bob')]), [])
+
+    async def test_snapshot_is_attached_when_due(self):
+        await self.store.add('lobby', 'c1', 'alice', {'avatar': None})
+        frames = await self.sent([('join', 'alice')], snapshot_due=True)
+        self.assertEqual([frame['snapshot'] for frame in frames], [
+            [{'username': 'alice', 'avatar': None, 'bio': ''}],
+        ])
+        await self.store.remove('lobby', 'c1')
+
+
+@override_settings(CHAT_METRICS={'TOKEN': 'secret'})
+class MetricsViewTests(TestCase):
+    """Accès à /metrics : staff ou jeton Bearer"""
+
+    def setUp(self):
+        self.url = reverse('metrics')
+
+    def test_anonymous_and_wrong_token_are_unauthorized(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 401)
+        self.assertIn('Bearer', response['WWW-Authenticate'])
+        self.assertEqual(self.client.get(self.url, HTTP_AUTHORIZATION='Bearer wrong').status_code, 401)
+        self.assertEqual(self.client.get(self.url, HTTP_AUTHORIZATION='Basic secret').status_code, 401)
+
+    def test_token_grants_access(self):
+        response = self.client.get(self.url, HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('# TYPE chat_ws_connects_total counter', response.content.decode())
+
+    def test_only_staff_users_are_allowed(self):
+        user = CustomUser.objects.create_user('alice', password='x')
+        self.client.force_login(user)
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+        user.is_staff = True
+        user.save()
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+
+    @override_settings(CHAT_METRICS={'TOKEN': ''})
+    def test_empty_token_is_never_accepted(self):
+        self.assertEqual(self.client.get(self.url, HTTP_AUTHORIZATION='Bearer ').status_code, 401)
+
+
+class MetricsThreadSafetyTests(SimpleTestCase):
+    """Histogrammes et compteurs alimentés depuis plusieurs threads"""
+
+    def test_concurrent_updates_are_not_lost(self):
+        histogram = metrics.Histogram('test_seconds', labelnames=('function',))
+        counter = metrics.Counter('test_total')
+
+        def work():
+            for _ in range(5000):
+                histogram.observe(0.002, 'f')
+                counter.inc()
+
+        threads = [threading.Thread(target=work) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(histogram.value, {'f': {'count': 40000, 'sum': 80.0}})
+        self.assertEqual(counter.value, 40000)
+
+
+class MetricsMiddlewareTests(TransactionTestCase):
+    """Compteurs de connexions, de trames et durée des handlers"""
+
+    def setUp(self):
+        reset_singletons()
+        self.user = CustomUser.objects.create_user('alice', password='x')
+        ChatRoom.objects.create(name='metrics')
+
+    def tearDown(self):
+        reset_singletons()
+
+    async def test_websocket_counters(self):
+        counters = (
+            instrumentation.ws_connects, instrumentation.ws_disconnects,
+            instrumentation.ws_messages_in, instrumentation.ws_open,
+        )
+        before = [counter.value for counter in counters]
+        handled = instrumentation.handler_seconds.value.get('chat_message_all', {}).get('count', 0)
+        app = instrumentation.MetricsMiddleware(
+            UserScopeMiddleware(URLRouter(websocket_urlpatterns), self.user)
+        )
+        communicator = WebsocketCommunicator(app, '/ws/chat/metrics/')
+        self.assertTrue((await communicator.connect())[0])
+        self.assertEqual(instrumentation.ws_open.value, before[3] + 1)
+        await communicator.send_to(text_data=json.dumps({'message': 'bonjour'}))
+        await receive_until(communicator, 'messages_committed')
+        await communicator.disconnect()
+
+        after = [counter.value for counter in counters]
+        self.assertEqual([a - b for a, b in zip(after, before)], [1, 1, 1, 0])
+        self.assertGreater(instrumentation.ws_messages_out.value, 0)
+        self.assertEqual(
+            instrumentation.handler_seconds.value['chat_message_all']['count'], handled + 1,
+        )
+        self.assertIn('ChatConsumer.get_room_id', instrumentation.db_seconds.value)
+
+
+class HistoryBatchConsumerTests(TransactionTestCase):
+    """Premier chargement : une seule trame history_batch pour les clients qui l'annoncent"""
+
+    def setUp(self):
+        reset_singletons()
+        self.user = CustomUser.objects.create_user('alice', password='x')
+        room = ChatRoom.objects.create(name='batch')
+        self.ids = [
+            message.id for message in Message.objects.bulk_create([
+                Message(room=room, user=self.user, content=str(index)) for index in range(5)
+            ])
+        ]
+
+    def tearDown(self):
+        reset_singletons()
+
+    async def history_frames(self, query=''):
+        app = UserScopeMiddleware(URLRouter(websocket_urlpatterns), self.user)
+        communicator = WebsocketCommunicator(app, f'/ws/chat/batch/{query}')
+        self.assertTrue((await communicator.connect())[0])
+        frames = await receive_frames(communicator)
+        await communicator.disconnect()
+        return [frame for frame in frames if frame['type'] in ('history_batch', 'old_message')]
+
+    async def test_feature_flag_sends_one_history_batch(self):
+        [frame] = await self.history_frames('?features=history_batch')
+        self.assertEqual(frame['type'], 'history_batch')
+        self.assertEqual([message['id'] for message in frame['messages']], self.ids)
+        self.assertEqual(history.decode_cursor(frame['next_cursor'])[1], self.ids[0])
+
+        # Deuxième connexion : même trame, servie par le cache du worker
+        self.assertEqual(await self.history_frames('?features=history_batch'), [frame])
+
+    async def test_legacy_clients_get_one_frame_per_message(self):
+        frames = await self.history_frames()
+        self.assertEqual([(frame['type'], frame['id']) for frame in frames], [('old_message', i) for i in self.ids])
+
+
+class HistoryOrderTests(TestCase):
+    """Cache rempli dans l'ordre des id, même si les horodatages le contredisent"""
+
+    def test_fill_and_append_agree_on_id_order(self):
+        user = CustomUser.objects.create_user('alice', password='x')
+        room = ChatRoom.objects.create(name='skew')
+        now = timezone.now()
+        # Horloges en désaccord : les id croissent, les horodatages décroissent
+        ids = [
+            message.id for message in Message.objects.bulk_create([
+                Message(room=room, user=user, content=str(index), timestamp=now - timedelta(seconds=index))
+                for index in range(4)
+            ])
+        ]
+        cache = history.HistoryCache(messages_per_room=3)
+        cache.fill('skew', history.fetch_latest(room.id, 3))
+        self.assertEqual([m['id'] for m in cache.get('skew')], ids[1:])
+
+        later = Message.objects.create(room=room, user=user, content='later', timestamp=now - timedelta(hours=1))
+        cache.append('skew', history.serialize_rows(
+            Message.objects.filter(id=later.id).values(*history.MESSAGE_FIELDS)
+        )[0])
+        self.assertEqual([m['id'] for m in cache.get('skew')], ids[2:] + [later.id])
@@ -6,7 +6,14 @@ app_name = 'chat'
 urlpatterns = [
     path('', views.lobby_view, name='lobby'),
     path('create/', views.create_room_view, name='create_room'),
+    # Avant <room_name>/ : sinon « search » ou « attachments » seraient pris pour un nom de salle
+    path('search/', views.search_view, name='search'),
+    path('attachments/<uuid:attachment_id>/', views.attachment_upload_view, name='attachment_upload'),
+    path('attachments/<uuid:attachment_id>/download/', views.attachment_download_view, name='attachment_download'),
     path('<str:room_name>/', views.room_view, name='room'),
+    path('<str:room_name>/history/', views.room_history_view, name='room_history'),
+    path('<str:room_name>/export/', views.export_room_view, name='export_room'),
+    path('<str:room_name>/attachments/', views.attachment_create_view, name='attachment_create'),
     
     path('<str:room_name>/delete/', views.delete_room_view, name='delete_room'),
 ]
\ No newline at end of file
@@ -1,16 +1,75 @@
 from django.shortcuts import render, redirect, get_object_or_404
+from django.urls import reverse
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
-from django.http import HttpResponseForbidden
+from django.core.handlers.asgi import ASGIRequest
+from django.http import (
+    HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, JsonResponse, StreamingHttpResponse,
+)
+from django.views.decorators.http import require_http_methods, require_POST
+from django.utils.http import content_disposition_header
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
 from django.utils import timezone
 from datetime import timedelta
-from .models import ChatRoom, Message
+import hmac
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from .models import Attachment, ChatRoom, Message, RoomReadState
+from .archive import get_archive
+from .attachments import (
+    UploadConflict, append_chunk, blob_path, create_upload, describe_attachment,
+    get_attachments_config, parse_range, read_range, sendfile_path,
+)
+from .export import FORMATS, as_async, parse_bound, stream_export
+from .history import get_history_cache, fetch_page, wire_message
+from .instrumentation import get_metrics_config
+from .search import search_messages, visible_rooms
+from . import metrics
 from accounts.models import CustomUser
+from accounts.profiles import DEFAULT_AVATAR_URL, get_profile_cache
+
+
+def with_unread_counts(rooms, user):
+    """
+    Annote chaque salle avec ``unread_count`` (messages des autres au-delà de
+    la position de lecture de ``user``) : compteur tenu à jour par l'écriture
+    des messages et les accusés, lu par une sous-requête sur (user, room).
+    Salle jamais lue : ses messages écrits par d'autres, comptés comme le fait
+    ingest.count_unread (les messages archivés n'en font plus partie).
+    """
+    unread = RoomReadState.objects.filter(
+        user=user, room=OuterRef('pk')
+    ).values('unread_count')[:1]
+    never_read = (
+        Message.objects
+        .filter(room=OuterRef('pk'))
+        .exclude(user=user)
+        .order_by()
+        .values('room')
+        .annotate(count=Count('id'))
+        .values('count')
+    )
+    return rooms.annotate(unread_count=Coalesce(Subquery(unread), Subquery(never_read), 0))
 
 
 @login_required
 def lobby_view(request):
-    rooms = ChatRoom.objects.filter(is_private=False)
+    # Compteurs et créateur calculés dans la requête des salles (pas de N+1)
+    message_count = (
+        Message.objects
+        .filter(room=OuterRef('pk'))
+        .order_by()
+        .values('room')
+        .annotate(count=Count('id'))
+        .values('count')
+    )
+    rooms = with_unread_counts(
+        ChatRoom.objects.filter(is_private=False)
+        .select_related('creator')
+        .annotate(message_count=Coalesce(Subquery(message_count), 0) + F('archived_message_count')),
+        request.user,
+    )
     
     # Utilisateurs actifs dans les 5 dernières minutes
     five_minutes_ago = timezone.now() - timedelta(minutes=5)
@@ -18,9 +77,13 @@ def lobby_view(request):
         last_seen__gte=five_minutes_ago
     ).exclude(id=request.user.id)
     
-    # Marquer comme en ligne pour la compatibilité
+    # Marquer comme en ligne pour la compatibilité, avec l'avatar du cache de
+    # profils (les instances sont déjà chargées : aucune requête de plus)
+    online_users = list(online_users)
+    profiles = get_profile_cache().get_many_loaded(online_users)
     for user in online_users:
         user.is_online = True
+        user.avatar_url = profiles.get(user.username, {}).get('avatar', DEFAULT_AVATAR_URL)
     
     return render(request, 'chat/lobby.html', {
         'rooms': rooms,
@@ -35,25 +98,165 @@ def room_view(request, room_name):
     # Récupérer la salle ou 404
     room = get_object_or_404(ChatRoom, name=room_name)
     
-    # Récupérer les 50 derniers messages POUR LES AFFICHER DIRECTEMENT
-    messages = Message.objects.filter(room=room).select_related('user').order_by('timestamp')[:50]
-    
-    # Préparer les messages pour le template
-    message_list = []
-    for msg in messages:
-        message_list.append({
-            'id': msg.id,
-            'content': msg.content,
-            'username': msg.user.username,
-            'avatar': msg.user.avatar.url if msg.user.avatar else '/media/avatars/default.png',
-            'timestamp': msg.timestamp.isoformat(),
-            'is_current_user': msg.user == request.user,
-        })
-    
+    # Pas d'historique dans la page : la première connexion WebSocket le
+    # reçoit en une trame history_batch, servie par le cache du worker
     return render(request, 'chat/room.html', {
         'room_name': room_name,
         'room': room,
-        'initial_messages': message_list,  # Ajout des messages initiaux
+    })
+
+@login_required
+def room_history_view(request, room_name):
+    """Historique paginé par curseur : ?before=<curseur>&limit=50"""
+    room = get_object_or_404(ChatRoom, name=room_name)
+    
+    try:
+        limit = max(1, min(int(request.GET.get('limit', 50)), 100))
+        messages, next_cursor = fetch_page(
+            room.id,
+            before=request.GET.get('before') or None,
+            limit=limit,
+        )
+    except ValueError:
+        return JsonResponse({'error': 'Curseur ou limite invalide.'}, status=400)
+    
+    return JsonResponse({
+        'messages': [wire_message(msg) for msg in messages],
+        'next_cursor': next_cursor,
+    })
+
+@login_required
+def export_room_view(request, room_name):
+    """Export intégral en flux : ?format=jsonl|csv&since=<date>&until=<date>&gzip=1"""
+    room = get_object_or_404(ChatRoom, name=room_name)
+    if room.creator != request.user and not request.user.is_staff:
+        return HttpResponseForbidden()
+    
+    export_format = request.GET.get('format', 'jsonl')
+    compress = request.GET.get('gzip') == '1'
+    try:
+        since = parse_bound(request.GET.get('since'))
+        until = parse_bound(request.GET.get('until'))
+        chunks = stream_export(room, export_format, since, until, compress)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    
+    # Sous ASGI, un itérateur synchrone serait lu en entier avant l'envoi
+    if isinstance(request, ASGIRequest):
+        chunks = as_async(chunks)
+    filename = f'{room.name}.{export_format}' + ('.gz' if compress else '')
+    response = StreamingHttpResponse(
+        chunks,
+        content_type='application/gzip' if compress else FORMATS[export_format],
+    )
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+@login_required
+@require_POST
+def attachment_create_view(request, room_name):
+    """Début d'un envoi par morceaux : filename, size, content_type"""
+    room = get_object_or_404(visible_rooms(request.user), name=room_name)
+    try:
+        attachment = create_upload(
+            request.user,
+            room,
+            request.POST.get('filename'),
+            request.POST.get('size'),
+            request.POST.get('content_type'),
+        )
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse({
+        'id': str(attachment.id),
+        'upload_url': reverse('chat:attachment_upload', args=[attachment.id]),
+        'offset': 0,
+        'chunk_size': get_attachments_config()['CHUNK_SIZE'],
+    }, status=201)
+
+@login_required
+@require_http_methods(['GET', 'PUT'])
+def attachment_upload_view(request, attachment_id):
+    """GET : position atteinte (reprise) ; PUT : morceau suivant (Content-Range)"""
+    attachment = get_object_or_404(Attachment, id=attachment_id, user=request.user)
+    if request.method == 'PUT':
+        try:
+            append_chunk(attachment, request.headers.get('Content-Range'), request)
+        except UploadConflict as e:
+            return JsonResponse({'error': 'offset_mismatch', 'offset': e.received}, status=409)
+        except ValueError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+    
+    status = {
+        'offset': attachment.received,
+        'size': attachment.size,
+        'complete': attachment.is_complete,
+    }
+    if attachment.is_complete:
+        status['attachment'] = describe_attachment(attachment)
+    return JsonResponse(status)
+
+@login_required
+def attachment_download_view(request, attachment_id):
+    """Contenu d'une pièce jointe complète, par plages (Range) ou via le serveur frontal"""
+    attachment = get_object_or_404(
+        Attachment,
+        id=attachment_id,
+        completed_at__isnull=False,
+        room__in=visible_rooms(request.user),
+    )
+    # Images affichées dans la page ; tout le reste est téléchargé
+    inline = attachment.content_type.startswith('image/') and 'svg' not in attachment.content_type
+    headers = {
+        'Content-Disposition': content_disposition_header(not inline, attachment.filename),
+        'Cache-Control': 'private, max-age=86400',
+        'Accept-Ranges': 'bytes',
+    }
+    config = get_attachments_config()
+    if config['SENDFILE_HEADER']:
+        headers[config['SENDFILE_HEADER']] = sendfile_path(attachment.sha256)
+        return HttpResponse(content_type=attachment.content_type, headers=headers)
+    
+    try:
+        byte_range = parse_range(request.headers.get('Range'), attachment.size)
+    except ValueError:
+        return HttpResponse(status=416, headers={'Content-Range': f'bytes */{attachment.size}'})
+    start, end = byte_range or (0, attachment.size)
+    chunks = read_range(blob_path(attachment.sha256), start, end)
+    # Sous ASGI, un itérateur synchrone serait lu en entier avant l'envoi
+    if isinstance(request, ASGIRequest):
+        chunks = as_async(chunks)
+    response = StreamingHttpResponse(
+        chunks,
+        status=206 if byte_range else 200,
+        content_type=attachment.content_type,
+        headers=headers,
+    )
+    response['Content-Length'] = end - start
+    if byte_range:
+        response['Content-Range'] = f'bytes {start}-{end - 1}/{attachment.size}'
+    return response
+
+@login_required
+def search_view(request):
+    """Recherche dans les salles visibles : ?q=<mots>&room=<salle>&cursor=<curseur>"""
+    query = request.GET.get('q', '').strip()
+    room_name = request.GET.get('room') or None
+    try:
+        results, next_cursor = search_messages(
+            request.user,
+            query,
+            cursor=request.GET.get('cursor') or None,
+            room_name=room_name,
+        )
+    except ValueError:
+        return HttpResponseBadRequest('Curseur invalide.')
+    
+    return render(request, 'chat/search.html', {
+        'query': query,
+        'room_filter': room_name,
+        'results': results,
+        'next_cursor': next_cursor,
     })
 
 @login_required
@@ -108,12 +311,42 @@ def delete_room_view(request, room_name):
             messages.error(request, 'Vous ne pouvez supprimer que les salles que vous avez créées.')
             return redirect('chat:lobby')
         
-        # Supprimer
+        # Supprimer (avec ses archives)
         room_name_display = room.name
+        room_id = room.id
         room.delete()
+        get_archive().delete_room(room_id)
+        
+        # Vider le cache d'historique de ce worker et prévenir les autres
+        get_history_cache().invalidate(room_name_display)
+        async_to_sync(get_channel_layer().group_send)(
+            f'chat_{room_name_display}',
+            {'type': 'room_deleted'}
+        )
         messages.success(request, f'Salle "{room_name_display}" supprimée avec succès.')
         
     except ChatRoom.DoesNotExist:
         messages.error(request, 'Cette salle n\'existe pas.')
     
-    return redirect('chat:lobby')
\ No newline at end of file
+    return redirect('chat:lobby')
+
+def metrics_view(request):
+    """
+    Métriques du processus au format Prometheus (staff ou jeton Bearer).
+    Sans identifiants valables : 401 ; utilisateur connecté non staff : 403.
+    """
+    token = get_metrics_config()['TOKEN']
+    header = request.headers.get('Authorization', '')
+    authorized = request.user.is_authenticated and request.user.is_staff
+    if not authorized and token and header.startswith('Bearer '):
+        authorized = hmac.compare_digest(header[len('Bearer '):].encode(), token.encode())
+    if not authorized:
+        if request.user.is_authenticated and not header:
+            return HttpResponseForbidden()
+        response = HttpResponse(status=401)
+        response['WWW-Authenticate'] = 'Bearer realm="metrics"'
+        return response
+    return HttpResponse(
+        metrics.render_prometheus(),
+        content_type='text/plain; version=0.0.4; charset=utf-8',
+    )
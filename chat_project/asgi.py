@@ -12,14 +12,19 @@ django.setup()
 # Now import Django's ASGI application and your routing
 from django.core.asgi import get_asgi_application
 import chat.routing
+from chat.admission import AdmissionMiddleware
+from chat.instrumentation import MetricsMiddleware
 
 django_asgi_app = get_asgi_application()
 
-application = ProtocolTypeRouter({
+# MetricsMiddleware : connexions, trames, durée des requêtes, retard de la boucle
+# AdmissionMiddleware : ouvertures de connexion limitées (avant l'authentification)
+# et départ progressif des clients à l'arrêt (lifespan)
+application = MetricsMiddleware(AdmissionMiddleware(ProtocolTypeRouter({
     "http": django_asgi_app,
     "websocket": AuthMiddlewareStack(
         URLRouter(
             chat.routing.websocket_urlpatterns
         )
     ),
-})
\ No newline at end of file
+})))
\ No newline at end of file
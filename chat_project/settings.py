@@ -62,6 +62,12 @@ ASGI_APPLICATION = 'chat_project.asgi.application'
 CHANNEL_LAYERS = {
     'default': {
         'BACKEND': 'channels.layers.InMemoryChannelLayer',  # Pour développement
+        'CONFIG': {
+            # File bornée par canal : les consumers la vident sans attendre
+            # leurs clients (voir chat/outbound.py)
+            'capacity': 500,
+            'expiry': 60,
+        },
         # 'BACKEND': 'channels_redis.core.RedisChannelLayer',  # Pour production
         # 'CONFIG': {
         #     "hosts": [('127.0.0.1', 6379)],
@@ -69,6 +75,133 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Registre de présence des salles (voir chat/presence.py)
+# MemoryPresenceStore ne voit que les connexions du processus courant :
+# utiliser RedisPresenceStore dès qu'il y a plusieurs workers.
+CHAT_PRESENCE = {
+    'BACKEND': 'chat.presence.MemoryPresenceStore',
+    'OPTIONS': {
+        'ttl': 30,                 # secondes sans battement avant expiration
+        'heartbeat_interval': 10,  # secondes entre deux battements
+    },
+    'DEBOUNCE': 0.25,              # fenêtre de regroupement des arrivées/départs
+    'SNAPSHOT_INTERVAL': 30,       # liste complète au plus toutes les N secondes
+}
+
+# Cache des derniers messages par salle (voir chat/history.py)
+CHAT_HISTORY_CACHE = {
+    'MESSAGES_PER_ROOM': 50,
+    'MAX_ROOMS': 500,                # au-delà, éviction LRU des salles froides
+    'MAX_BYTES': 8 * 1024 * 1024,    # plafond mémoire approximatif par worker
+}
+
+# Écriture différée des messages (voir chat/ingest.py)
+CHAT_INGEST = {
+    'BATCH_SIZE': 200,         # taille maximale d'un bulk_create
+    'FLUSH_INTERVAL': 0.005,   # attente maximale avant écriture (secondes)
+}
+
+# Limites par connexion WebSocket (voir chat/outbound.py)
+CHAT_BACKPRESSURE = {
+    'MAX_QUEUE_FRAMES': 1000,        # trames en attente d'envoi
+    'MAX_QUEUE_BYTES': 1024 * 1024,  # octets en attente d'envoi
+    'SEND_TIMEOUT': 10,              # secondes pour écrire une trame
+    'MAX_FRAME_BYTES': 64 * 1024,    # trame reçue
+    'MAX_MESSAGE_LENGTH': 4000,      # caractères d'un message
+    'BATCH_RATE': 50,                # trames/s avant regroupement (fonctionnalité batch)
+    'BATCH_DELAY': 0.005,            # attente des trames suivantes
+    'BATCH_MAX_FRAMES': 100,
+}
+
+# Diffusion par relais de worker pour les grandes salles (voir chat/relay.py)
+CHAT_FANOUT = {
+    'RELAY_THRESHOLD': 200,   # membres
+    'DECISION_TTL': 5,        # secondes
+}
+
+# Accusés de réception (Livré / Vu), regroupés par salle
+CHAT_RECEIPTS = {
+    'WINDOW': 0.5,     # secondes de regroupement
+    'BACKFILL': 500,   # messages marqués au plus par passe
+}
+
+# Archivage des anciens messages en segments compressés (voir chat/archive.py),
+# lancé par "manage.py archive_messages" ou chat.archive.archive_expired_messages
+CHAT_ARCHIVE = {
+    'ROOT': os.path.join(BASE_DIR, 'media', 'chat_archive'),
+    # Sans retention_days sur la salle : None = conservée en table (archivage
+    # à activer salle par salle, ou globalement avec un nombre de jours)
+    'DEFAULT_RETENTION_DAYS': None,
+    'BLOCK_MESSAGES': 256,          # messages par bloc compressé
+    'BATCH_SIZE': 5000,             # messages déplacés par transaction
+}
+
+# Admission des connexions WebSocket par worker (voir chat/admission.py)
+CHAT_ADMISSION = {
+    'MAX_CONCURRENT': 32,   # ouvertures simultanées (auth, historique, présence)
+    'MAX_QUEUE': 1000,
+    'QUEUE_TIMEOUT': 5,     # au-delà : refus avec délai de reconnexion
+    'RETRY_AFTER': 2,
+    'RETRY_JITTER': 8,
+    'DRAIN_WINDOW': 30,     # arrêt : reconnexions réparties sur 30 s
+}
+
+# Pièces jointes envoyées par morceaux (voir chat/attachments.py)
+CHAT_ATTACHMENTS = {
+    'MAX_SIZE': 50 * 1024 * 1024,
+    'CHUNK_SIZE': 1024 * 1024,      # octets par requête PUT
+    # Derrière nginx : 'X-Accel-Redirect' et une location interne
+    # /protected/ pointant vers MEDIA_ROOT
+    'SENDFILE_HEADER': os.environ.get('CHAT_SENDFILE_HEADER') or None,
+    'SENDFILE_PREFIX': '/protected/',
+    # Envois non terminés supprimés après ce délai (manage.py cleanup_attachments)
+    'UPLOAD_TTL': 24 * 3600,
+}
+
+# Métriques Prometheus sur /metrics (voir chat/instrumentation.py) : accès
+# réservé au staff, ou à qui présente "Authorization: Bearer <TOKEN>"
+CHAT_METRICS = {
+    'TOKEN': os.getenv('CHAT_METRICS_TOKEN', ''),
+    'LOOP_LAG_INTERVAL': 0.5,   # secondes entre deux mesures du retard de la boucle
+}
+
+# Caches : "profiles" contient les profils publics (avatar, bio courte)
+# partagés entre les vues et le consumer (voir accounts/profiles.py)
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'profiles': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'profiles',
+        'TIMEOUT': 600,
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
+}
+
+PROFILE_CACHE = {
+    'ALIAS': 'profiles',
+    'LOCAL_TTL': 30,            # cache local (invalidé par le channel layer sous ASGI)
+    'LOCAL_MAX_ENTRIES': 5000,
+}
+
+# Miniatures d'avatar (voir accounts/avatars.py)
+AVATARS = {
+    'SIZES': (32, 64, 128),
+    'SMALL_SIZE': 64,       # taille envoyée dans les messages et la présence
+    'QUALITY': 80,
+    'WORKERS': 2,           # threads de calcul par processus
+    # Cache-Control des miniatures en DEBUG ; en production, le serveur web sert
+    # MEDIA_URL et doit poser le même en-tête sur avatars/thumbs/
+    'MAX_AGE': 365 * 24 * 3600,
+}
+
+# Écriture groupée de CustomUser.last_seen (voir accounts/last_seen.py)
+LAST_SEEN = {
+    'THRESHOLD': 60,        # ne pas réécrire une valeur plus récente que ça
+    'FLUSH_INTERVAL': 30,   # un bulk_update au plus toutes les N secondes
+}
+
 # Base de données SQLite
 DATABASES = {
     'default': {
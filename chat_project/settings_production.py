@@ -42,10 +42,39 @@ CHANNEL_LAYERS = {
         'BACKEND': 'channels_redis.core.RedisChannelLayer',
         'CONFIG': {
             "hosts": [REDIS_URL],
+            # File bornée par canal ; le retard d'un client lent est absorbé
+            # par sa file d'envoi (chat/outbound.py), pas par Redis
+            "capacity": 500,
+            "expiry": 30,
         },
     },
 }
 
+# Présence partagée entre les workers, dans le même Redis
+CHAT_PRESENCE = {
+    'BACKEND': 'chat.presence.RedisPresenceStore',
+    'OPTIONS': {
+        'url': REDIS_URL,
+        'ttl': 30,
+        'heartbeat_interval': 10,
+    },
+    'DEBOUNCE': 0.25,
+    'SNAPSHOT_INTERVAL': 30,
+}
+
+# Profils partagés entre les workers (invalidation visible par tous)
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'profiles': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': REDIS_URL,
+        'KEY_PREFIX': 'chat',
+        'TIMEOUT': 600,
+    },
+}
+
 # Security settings
 SECURE_BROWSER_XSS_FILTER = True
 SECURE_CONTENT_TYPE_NOSNIFF = True
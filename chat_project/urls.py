@@ -4,12 +4,23 @@ from django.urls import path, include
 from django.views.generic import RedirectView
 from django.conf import settings
 from django.conf.urls.static import static
+from accounts.avatars import THUMBNAIL_DIR
+from accounts.views import avatar_thumbnail_view
+from chat.views import metrics_view
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('', RedirectView.as_view(pattern_name='login', permanent=False)),  # Redirige vers login
     path('accounts/', include('accounts.urls')),
     path('chat/', include('chat.urls')),
+    path('metrics', metrics_view, name='metrics'),
+    # Avant le service des médias en DEBUG, pour les en-têtes de cache (404 hors
+    # DEBUG : le serveur web sert MEDIA_URL, miniatures comprises)
+    path(
+        f"{settings.MEDIA_URL.lstrip('/')}{THUMBNAIL_DIR}<str:name>",
+        avatar_thumbnail_view,
+        name='avatar_thumbnail',
+    ),
 ]
 
 if settings.DEBUG: